@@ -12,58 +12,388 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 
-#credit to http://tools.cherrypy.org/wiki/BackgroundTaskQueue
-#adapted here for py3.4
+#originally based on http://tools.cherrypy.org/wiki/BackgroundTaskQueue
+#reworked into a multi-worker job scheduler with job IDs, status, and cancellation
 
-import queue
+import collections
+import math
+import os
 import threading
-import cherrypy
+import time
+from multiprocessing import Pool
 from cherrypy.process import plugins
+import metrics
+from profiling import request_profiler
 
-class BackgroundTaskQueue(plugins.SimplePlugin):
+class JobCancelled(Exception):
+    """Raised from inside a job function when the job has been cancelled"""
+
+class Job(object):
+    """A unit of background work. The job function is called with the job as the 'job' keyword argument,
+       and can report progress with set_progress() and should call check_cancelled() regularly"""
+    
+    save_interval = 5 #min seconds between writes of the progress counter to the DB
+    
+    def __init__(self, job_id, owner, job_type, description, func, args, kwargs, data_mgr):
+        self.job_id = job_id
+        self.owner = owner
+        self.job_type = job_type
+        self.description = description
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.progress = 0
+        self.message = None
+        self.tm_id = None
+        self.created_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.started_datetime = None
+        self.finished_datetime = None
+        self.cancel_requested = False
+        self.data_mgr = data_mgr
+        self.last_saved = 0
+    
+    def set_progress(self, progress, message=None, tm_id=None):
+        self.progress = progress
+        if message is not None:
+            self.message = message
+        if tm_id is not None:
+            self.tm_id = tm_id
+        #persisted now and then, so a restart can report how far the job got
+        if time.time() - self.last_saved >= self.save_interval:
+            self.data_mgr.update_job(self.job_id, progress=self.progress, message=self.message, tm_id=self.tm_id)
+            self.last_saved = time.time()
+    
+    def check_cancelled(self):
+        if self.cancel_requested:
+            raise JobCancelled()
     
-    thread = None
+    def info(self):
+        """Returns a JSON-serializable dict of the job's state"""
+        return {'job_id' : self.job_id, 'owner' : self.owner, 'job_type' : self.job_type,
+                'description' : self.description, 'status' : self.status, 'progress' : self.progress,
+                'message' : self.message, 'tm_id' : self.tm_id, 'created_datetime' : self.created_datetime,
+                'started_datetime' : self.started_datetime, 'finished_datetime' : self.finished_datetime}
+
+class JobScheduler(plugins.SimplePlugin):
+    """Runs background jobs (e.g. TMX imports) on a pool of worker threads.
+       Pending jobs are queued per user, and the next job goes to the user with the fewest jobs running,
+       then the one served longest ago, so one user queueing several large imports doesn't hold up everyone else's.
+       Job state is persisted through data_mgr so that jobs interrupted by a restart are reported as failed"""
     
-    def __init__(self, bus, qsize=100, qwait=2, safe_stop=True):
+    def __init__(self, bus, data_mgr, workers=2, safe_stop=True):
         plugins.SimplePlugin.__init__(self, bus)
-        self.q = queue.Queue(qsize)
-        self.qwait = qwait
+        self.data_mgr = data_mgr
+        self.num_workers = workers
         self.safe_stop = safe_stop
+        self.threads = []
+        self.running = False
+        self.pending = {} #owner: deque of queued jobs
+        self.jobs = {} #job_id: job, for queued and running jobs
+        self.running_per_owner = collections.Counter()
+        self.last_served = {} #owner: sequence number of the last job started for them
+        self.served_count = 0
+        self.condition = threading.Condition()
     
     def start(self):
-        self.running = True
-        if not self.thread:
-            self.thread = threading.Thread(target=self.run)
-            self.thread.start()
+        #anything still queued or running in the DB was interrupted by the last shutdown
+        self.data_mgr.fail_unfinished_jobs("interrupted by a server restart")
+        removed = self.data_mgr.delete_unfinished_imports()
+        if removed:
+            self.bus.log("Removed the partially imported TMs {0}, left by an interrupted import".format(removed))
+        with self.condition:
+            self.running = True
+        if not self.threads:
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self.run, name="JobScheduler worker {0}".format(i))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
     
     def stop(self):
-        if self.safe_stop:
-            self.running = "draining"
-        else:
-            self.running = False
-        
-        if self.thread:
-            self.thread.join()
-            self.thread = None
+        with self.condition:
+            self.running = "draining" if self.safe_stop else False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
         self.running = False
+        #whatever is left in the queues (i.e. not safe_stop) won't run
+        with self.condition:
+            for queued in self.pending.values():
+                for job in queued:
+                    self.finish(job, 'failed', "server stopped before the job started")
+            self.pending.clear()
+    
+    def submit(self, owner, job_type, description, func, *args, **kwargs):
+        """Schedules func(*args, job=job, **kwargs) to run and returns the new job's ID"""
+        job_id = self.data_mgr.add_job(owner, job_type, description)
+        job = Job(job_id, owner, job_type, description, func, args, kwargs, self.data_mgr)
+        with self.condition:
+            self.jobs[job_id] = job
+            self.pending.setdefault(owner, collections.deque()).append(job)
+            self.condition.notify()
+        return job_id
+    
+    def next_job(self):
+        """Blocks until a job is available and returns it, or returns None when the workers should exit"""
+        with self.condition:
+            while True:
+                if self.pending and self.running:
+                    owner = min(self.pending, key=lambda o: (self.running_per_owner[o], self.last_served.get(o, -1)))
+                    queued = self.pending[owner]
+                    job = queued.popleft()
+                    if not queued:
+                        del self.pending[owner]
+                    self.running_per_owner[owner] += 1
+                    self.served_count += 1
+                    self.last_served[owner] = self.served_count
+                    return job
+                if self.running != True:
+                    return None
+                self.condition.wait()
     
     def run(self):
-        while self.running:
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            job.status = 'running'
+            job.started_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
+            self.data_mgr.update_job(job.job_id, status=job.status, started_datetime=job.started_datetime)
             try:
-                try:
-                    func, args, kwargs = self.q.get(block=True, timeout=self.qwait)
-                except queue.Empty:
-                    if self.running == "draining":
-                        return
-                    continue
-                else:
-                    func(*args, **kwargs)
-                    if hasattr(self.q, 'task_done'):
-                        self.q.task_done()
-            except:
-                self.bus.log("Error in BackgroundTaskQueue %r." % self,
+                result = request_profiler.run(job.job_type, job.owner, job.func, *job.args, job=job, **job.kwargs)
+                if isinstance(result, dict):
+                    job.tm_id = result.get('tm_id', job.tm_id)
+                    if result.get('status'):
+                        job.message = result['status']
+                self.finish(job, 'finished', job.message)
+            except JobCancelled:
+                self.finish(job, 'cancelled', "cancelled by user")
+            except Exception as e:
+                self.bus.log("Error in JobScheduler job {0}.".format(job.job_id),
                              level=40, traceback=True)
+                self.finish(job, 'failed', str(e) or type(e).__name__)
+            with self.condition:
+                self.running_per_owner[job.owner] -= 1
+    
+    def finish(self, job, status, message=None):
+        job.status = status
+        job.message = message
+        job.finished_datetime = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.data_mgr.update_job(job.job_id, status=job.status, progress=job.progress, message=job.message,
+                                 tm_id=job.tm_id, finished_datetime=job.finished_datetime)
+        self.jobs.pop(job.job_id, None)
+    
+    def cancel(self, job_id):
+        """Cancels a queued job right away, or asks a running job to stop.
+           Returns the job's status, or None if the job is not queued or running"""
+        with self.condition:
+            job = self.jobs.get(int(job_id))
+            if not job:
+                return None
+            job.cancel_requested = True
+            if job.status == 'queued':
+                queued = self.pending.get(job.owner)
+                queued.remove(job)
+                if not queued:
+                    del self.pending[job.owner]
+                self.finish(job, 'cancelled', "cancelled by user")
+            return job.status
+    
+    def job_status(self, job_id):
+        """Returns the job's info, from memory if it is queued or running, otherwise from the DB"""
+        job = self.jobs.get(int(job_id))
+        if job:
+            return job.info()
+        return self.data_mgr.get_job(job_id)
+    
+    def active_count(self):
+        """The number of jobs queued or running"""
+        return len(self.jobs)
+    
+    def queued_count(self):
+        """The number of jobs waiting for a worker"""
+        with self.condition:
+            return sum(len(queued) for queued in self.pending.values())
+
+class SearchRejected(Exception):
+    """Raised when a search isn't admitted, because too many are waiting or it waited too long.
+       retry_after is a suggested number of seconds to wait before trying again"""
+    
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+class SearchTicket(object):
+    """A search's place in the SearchScheduler: its priority, which promote can raise until it starts, 
+       and until when it can wait to start"""
+    
+    def __init__(self, priority):
+        self.priority = priority
+        self.deadline = None #set once it is queued
+        self.started = False
+
+
+class SearchScheduler(plugins.SimplePlugin):
+    """Bounds the number of searches computed at once, server-wide, to slots.
+       Searches beyond that wait their turn, interactive ones ahead of batch ones (which, when there
+       is more than one slot, never take the last free one), for up to queue_timeout seconds.
+       Once max_queue searches are waiting, new ones are rejected at once, so a saturated server
+       answers quickly instead of tying up all its threads.
+       Also holds the process pool used by scorers that aren't batched, shared by all searches"""
+    
+    priorities = ('interactive', 'batch')
+    
+    def __init__(self, bus, slots=0, queue_timeout=10, max_queue=8, processes=0):
+        plugins.SimplePlugin.__init__(self, bus)
+        self.slots = slots or os.cpu_count() or 1
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.processes = processes or None #None uses all cores
+        self.pool = None
+        self.condition = threading.Condition()
+        self.waiting = dict((priority, collections.deque()) for priority in self.priorities)
+        self.running = collections.Counter() #priority: searches running
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.avg_duration = 0.1 #moving average of search time in seconds, for Retry-After
+    
+    def stop(self):
+        with self.condition:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.terminate()
+    
+    def get_pool(self):
+        with self.condition:
+            if self.pool is None:
+                self.pool = Pool(self.processes)
+            return self.pool
+    
+    def can_start(self, priority):
+        """Whether a search of the given priority can start now; called holding the condition"""
+        if sum(self.running.values()) >= self.slots:
+            return False
+        if priority == 'batch':
+            if self.waiting['interactive']:
+                return False
+            if self.slots > 1 and self.running['batch'] >= self.slots - 1:
+                return False
+        return True
+    
+    def retry_after(self):
+        queued = sum(len(waiting) for waiting in self.waiting.values())
+        return max(1, int(math.ceil(self.avg_duration * (queued + 1) / self.slots)))
     
-    def put(self, func, *args, **kwargs):
-        """Schedule the given func to be run."""
-        self.q.put((func, args, kwargs))
\ No newline at end of file
+    def run(self, ticket, func, *args):
+        """Calls func(*args) once a slot is free for the ticket (a SearchTicket, or just the priority), 
+           and returns its result. Raises SearchRejected if the queue is full, or if no slot came free 
+           within queue_timeout (or longer, if the ticket is promoted meanwhile)"""
+        if not isinstance(ticket, SearchTicket):
+            ticket = SearchTicket(ticket)
+        queued_at = time.time()
+        with self.condition:
+            if self.waiting[ticket.priority] or not self.can_start(ticket.priority):
+                if sum(len(w) for w in self.waiting.values()) >= self.max_queue:
+                    self.rejected_full += 1
+                    raise SearchRejected("the server is busy: too many searches waiting", self.retry_after())
+                self.waiting[ticket.priority].append(ticket)
+                ticket.deadline = queued_at + self.queue_timeout
+                #the priority is looked up on each check, as promote may move the ticket to another queue
+                while not (self.waiting[ticket.priority][0] is ticket and self.can_start(ticket.priority)):
+                    remaining = ticket.deadline - time.time()
+                    if remaining <= 0:
+                        self.waiting[ticket.priority].remove(ticket)
+                        self.rejected_timeout += 1
+                        self.condition.notify_all() #the ones behind it may be able to start
+                        raise SearchRejected("the server is busy: the search waited too long to start", self.retry_after())
+                    self.condition.wait(remaining)
+                self.waiting[ticket.priority].popleft()
+                self.condition.notify_all() #more than one slot may have come free
+            ticket.started = True
+            priority = ticket.priority
+            self.running[priority] += 1
+            self.admitted += 1
+            wait = time.time() - queued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        metrics.search_phase_seconds.observe(wait, 'queue')
+        started = time.time()
+        try:
+            return func(*args)
+        finally:
+            with self.condition:
+                self.running[priority] -= 1
+                self.avg_duration = .8*self.avg_duration + .2*(time.time() - started)
+                self.condition.notify_all()
+    
+    def promote(self, ticket, priority):
+        """Raises a search's priority to the given one, e.g. for an interactive search sharing the result 
+           of a batch one. If it is waiting, it moves to the back of that priority's queue, and can wait 
+           at least queue_timeout from now. Does nothing once it has started, or if it already has that priority"""
+        with self.condition:
+            if ticket.started or self.priorities.index(priority) >= self.priorities.index(ticket.priority):
+                return
+            waiting = self.waiting[ticket.priority]
+            if ticket in waiting: #otherwise it isn't queued yet, and will be at the new priority
+                waiting.remove(ticket)
+                self.waiting[priority].append(ticket)
+                ticket.deadline = max(ticket.deadline, time.time() + self.queue_timeout)
+                self.condition.notify_all()
+            ticket.priority = priority
+    
+    def stats(self):
+        with self.condition:
+            return {'slots' : self.slots, 'running' : sum(self.running.values()), 
+                    'queued' : dict((priority, len(waiting)) for priority, waiting in self.waiting.items()),
+                    'admitted' : self.admitted, 'rejected_full' : self.rejected_full, 'rejected_timeout' : self.rejected_timeout,
+                    'wait_seconds_total' : self.wait_total, 'wait_seconds_max' : self.wait_max,
+                    'wait_seconds_avg' : self.wait_total/self.admitted if self.admitted else 0.0}
+
+class LastUsedRecorder(plugins.Monitor):
+    """Write-behind buffer for tus.last_used_date. Searches record the tu_ids they return,
+       which only takes a lock long enough to update a dict, and a background thread writes
+       the buffered dates to the DB in one batched update every frequency seconds.
+       A failed flush is logged and its entries are kept for the next one; if the buffer fills up
+       (max_pending) new hits are dropped rather than letting it grow without bound"""
+    
+    def __init__(self, bus, data_mgr, frequency=30, max_pending=100000):
+        plugins.Monitor.__init__(self, bus, self.flush, frequency, name="LastUsedRecorder")
+        self.data_mgr = data_mgr
+        self.max_pending = max_pending
+        self.pending = {} #tu_id: last used datetime
+        self.lock = threading.Lock()
+        self.dropped = 0
+    
+    def record(self, tu_ids):
+        used_date = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            for tu_id in tu_ids:
+                if tu_id in self.pending or len(self.pending) < self.max_pending:
+                    self.pending[tu_id] = used_date
+                else:
+                    self.dropped += 1
+    
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            self.data_mgr.set_last_used_dates(pending.items())
+        except Exception:
+            self.bus.log("Error flushing {0} last_used_date updates.".format(len(pending)),
+                         level=40, traceback=True)
+            #put them back for the next try, without overwriting any newer hits
+            with self.lock:
+                for tu_id, used_date in pending.items():
+                    if tu_id not in self.pending and len(self.pending) < self.max_pending:
+                        self.pending[tu_id] = used_date
+    
+    def stop(self):
+        plugins.Monitor.stop(self)
+        self.flush() #don't lose the last interval's hits on shutdown
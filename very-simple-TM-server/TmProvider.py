@@ -12,53 +12,86 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 
-import xml.etree.ElementTree as ET
 import logging
 import json
 import time
-import Levenshtein
 from functools import partial
 from multiprocessing import Pool
 import os
 import glob
 import subprocess
 from operator import itemgetter
+import queue
+import threading
+import shutil
 import datamodel
+import tmx
+from snapshot import TmSnapshot, ShardedDict
+import scorers
+import metrics
+from BackgroundTask import SearchTicket
 
 localDir = os.path.dirname(__file__)
 absDir = os.path.join(os.getcwd(), localDir)
 
 
+class TmxImportFailed(Exception):
+    """Raised when a TMX import fails partway through, after the partially imported TM has been removed"""
 
 
-def get_lev_ratio(searchstring, minscore, casecost, comparestring):
-        """Uses python-Levenshtein and performs a character-based Levenshtein distance calculation and returns a percentage score
-           minscore should be a float between 0 and 1; casecost represents the cost of
-           replacements that merely involve a change in case frome lower to upper or vice versa
-           A casecost of less than 1 warps results in favor of strings differing only by case.
-           The algorithm performs 2 lookups through the matrix..one with the actual strings,
-           and one with both strings lowercased, calculating the case difference based on the
-           difference between the two scores.
-        """
-        searchstring = str.strip(searchstring) #don't want to leave spaces and returns at ends
-        comparestring = str.strip(comparestring) #don't want to leave spaces and returns at ends
-        sumlen = len(searchstring) + len(comparestring)
-        d1 = Levenshtein.distance(searchstring, comparestring)
-        d2 = Levenshtein.distance(str.lower(searchstring), str.lower(comparestring))
-        #d1 = editdistance.eval(searchstring, comparestring) 
-        #d2 = editdistance.eval(str.lower(searchstring), str.lower(comparestring)) #editdistance library is slightly slower than python-Levenshtein
-        diff = d1-d2
-        dresult = d2 + (diff*casecost)
-        ratio = (sumlen-dresult) / sumlen
-        if ratio >= minscore:
-            return tuple([comparestring, ratio])
-        else:
-            return
+
+class SingleFlight(object):
+    """Runs a function once for concurrent calls with the same key: calls that arrive while one with
+       their key is running wait for it and get its result (or exception). Nothing is kept once it is done,
+       so a later call always runs again. on_join, if given, is called with the running call's args when a call joins it"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {} #key: [event set when done, result, exception, args]
+        self.executed = 0
+        self.coalesced = 0
+    
+    def do(self, key, func, *args, on_join=None):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = [threading.Event(), None, None, args]
+                self.executed += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            if on_join is not None:
+                on_join(*flight[3])
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+        try:
+            flight[1] = func(*args)
+        except Exception as e:
+            flight[2] = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight[0].set()
+        return flight[1]
+    
+    def stats(self):
+        return {'executed' : self.executed, 'coalesced' : self.coalesced, 'in_flight' : len(self.flights)}
 
 class TmProvider(object):
     """Provides methods for searching a set of string data for exact and fuzzy matches,
        as well as for loading, deleting, and otherwise maintaining the data"""
     
+    usage_recorder = None #set by the server to a LastUsedRecorder; class-level so it isn't pickled with the session
+    search_flights = SingleFlight() #shared by all sessions, so identical concurrent searches on the same TUs run once
+    scorer = None #the Levenshtein backend (see scorers.py), set by the server...picked on the first search otherwise
+    search_scheduler = None #set by the server to a SearchScheduler, which bounds the searches computed at once
+    slow_search_log = None #set by the server to a SlowSearchLog, which records slow searches for replaying
+    
     def __init__(self, config):
         """cores is the max number of processor cores that will be used for
            Levenshtein calculation during search.
@@ -66,12 +99,40 @@ class TmProvider(object):
            but if set to True will use MySql (DB must be already created/configured)"""
         self.num_cores = config['numcores']
         self.use_mysql=config['use_mysql']
-        self.data = {}
-        self.tms = {}
+        #TUs per batch the TMX parser hands to the DB inserter...each batch is committed when inserted, if not before
+        self.import_batch_size = int(config.get('import_batch_size', 10000))
+        #TUs per executemany during TMX import...the import commits after any of them once import_commit_seconds have passed
+        self.import_commit_rows = int(config.get('import_commit_rows', 1000))
+        self.import_queue_size = int(config.get('import_queue_size', 4)) #parsed batches waiting for DB insertion during TMX import
+        self.import_commit_seconds = float(config.get('import_commit_seconds', .25)) #longest a TMX import holds the DB's write lock without committing
+        self.save_uploads = config.get('save_uploads', False) #keep a copy of uploaded TMX files in upload/
+        self.export_chunk_size = int(config.get('export_chunk_size', 10000)) #TUs fetched from the DB at a time during TMX export
+        self.batch_search_chars = int(config.get('batch_search_chars', 500)) #searches for longer texts are scheduled as batch ones
+        #target_index also indexes the loaded TUs by target text (sharing the same TU objects), for target to source searches
+        target_index = True if str.lower(str(config.get('target_index', False)))=='true' else False
+        self.snapshot = TmSnapshot(target_data=ShardedDict() if target_index else None) #the loaded TMs and TUs...replaced, never changed, so searches are never affected by writes
         self.currently_loading = False
         self.loaded = False
         self.data_mgr = datamodel.TmData(config)
     
+    @property
+    def data(self):
+        """sourcetext: tuple of TUs, in the current snapshot"""
+        return self.snapshot.data
+    
+    @property
+    def tms(self):
+        """tm_id: TM, for the TMs loaded in the current snapshot"""
+        return self.snapshot.tms
+    
+    @property
+    def tu_index(self):
+        return self.snapshot.tu_index
+    
+    @property
+    def tm_index(self):
+        return self.snapshot.tm_index
+    
     def load_tm_to_memory(self, tm_id):
         """Loads data for a given translation memory document from DB to memory for faster searching"""
         tm_id=int(tm_id) #type conversion to int in case not done before passing
@@ -86,18 +147,9 @@ class TmProvider(object):
         status = "success"
 
         if tm:
-            self.tms[tm_id]=tm
-            #load the TUs to this instance's dict of loaded TUs
-            #by passing the current dict it adds the new items to the current dict
-            #otherwise a new dict is created
-
-            #test
-            #size1 = len(self.data)
-        
-            self.data = self.data_mgr.get_tus(tm_id, self.data)
-        
-            #test
-            #size2 = len(self.data)
+            #the TM and its TUs are swapped in together, once all are read
+            #TUs already in memory (e.g. when re-syncing) are skipped
+            self.snapshot = self.snapshot.with_tm(tm).with_tus(datamodel.TranslationUnit(*x) for x in self.data_mgr.iter_tus(tm_id))
         else:
             status = "no TM with ID of '{0}' exists".format(tm_id)
         
@@ -106,49 +158,42 @@ class TmProvider(object):
         self.loaded=True
         return {'status' : status}
         
-    def list_tms(self, user):
+    def list_tms(self, user, sourcelang=None, targetlang=None, name_prefix=None, cursor=None, limit=0):
         """Lists the translation memory documents (TMX files) that have been imported into the database
-           and are available for loading into memory and searching"""
-        all_tms = self.data_mgr.get_tms()
-        results = []
-        for tm in all_tms: #only return the TMs that the user can read and indicate whether read-only
-            can_read = False
-            can_write = False
-            if ((self.data_mgr.get_owner(tm) == user) or
-            (user in self.data_mgr.get_tm_read_write_group_users(tm)) or 
-            (user in self.data_mgr.get_admin_users())):
-                can_read = True
-                can_write = True
-            if user in self.data_mgr.get_tm_read_group_users(tm):
-                can_read = True
-            if can_read or can_write:
-                result = all_tms[tm]
-                result['can_read'] = can_read
-                result['can_write'] = can_write
-                results.append(result)
-        return results
+           and are available for loading into memory and searching, i.e. the ones the user can read, 
+           indicating whether read-only. With a limit, returns one page and the cursor for the next one 
+           (None on the last page): ([tms], next_cursor)"""
+        limit = int(limit or 0)
+        results = self.data_mgr.get_readable_tms(user, sourcelang, targetlang, name_prefix, cursor, 
+                                                 limit + 1 if limit else 0) #one extra to tell if there's another page
+        if not limit:
+            return results, None
+        if len(results) > limit:
+            results = results[:limit]
+            return results, results[-1]['tm_id']
+        return results, None
+        
+    def concordance(self, user, query, fields='both', tm_ids=None, cursor=None, limit=50):
+        """Finds the TUs whose source and/or target text contain all the words and phrases of the query,
+           through the DB's full-text index, in the given TMs or all the TMs the user can read. 
+           The TMs don't have to be loaded. Returns one page and the cursor for the next one 
+           (None on the last page): ([matches], next_cursor)"""
+        limit = int(limit)
+        if tm_ids is None and not self.data_mgr.get_tm_permissions(None, user)['is_admin']:
+            tm_ids = [tm['tm_id'] for tm in self.data_mgr.get_readable_tms(user)]
+        tus = self.data_mgr.search_concordance(query, fields, tm_ids, cursor, limit + 1) #one extra to tell if there's another page
+        matches = [{'tu_id':tu['tu_id'], 'tm_id':tu['tm_id'], 'sourcetext':tu['sourcetext'], 'targettext':tu['targettext'],
+                    'created_by':tu['created_by'], 'created_date':str(tu['created_date']), 
+                    'changed_by':tu['changed_by'], 'changed_date':str(tu['changed_date']),
+                    'last_used_date':str(tu['last_used_date'])} for tu in tus[:limit]]
+        return matches, matches[-1]['tu_id'] if len(tus) > limit else None
         
     def delete_tm_from_db(self, tm_id):
         """Permanently deletes all the data related to a previously-loaded
            translation memory document from the DB.  Careful..no going back unless
            the DB has been backed up."""
-        deleted_sourcetexts={}
-        for sourcetext in self.data.keys():
-            delete_items=[]
-            for item in self.data[sourcetext]:
-                if str(item['tm_id'])==tm_id:
-                    delete_items.append(item)
-                    deleted_sourcetexts[sourcetext]=item['tu_id'] #to pop from the dict after iterating, if empty 
-            #now after iterating we can remove the list items
-            for item in delete_items:
-                self.data[sourcetext].remove(item) #remove all items whose tm_id matches the one deleted from the DB
-                    
-        #now after iterating we can remove sourcetext keys that have no TU items left
-        for item in deleted_sourcetexts.keys():
-            if len(self.data[item])==0:
-                self.data.pop(item)
-        #now delete TM from in-memory TM list
-        self.tms.pop(int(tm_id))
+        #remove the TM and its TUs from memory, found through the tm_id index
+        self.snapshot = self.snapshot.without_tm(tm_id)
           
         #now delete from disk
         self.data_mgr.delete_tm_by_id(tm_id)
@@ -159,14 +204,8 @@ class TmProvider(object):
         """Permanently deletes a TU based on sourcetext/targettext pair from the specified TM"""
         
         #delete from memory
-        if source in self.data: #only do if actually in memory 
-            sourcematches = self.data[source]
-            for item in sourcematches:
-                if str(item['tm_id']) == tm_id and item['targettext']==target:
-                    self.data[source].remove(item) #remove all items whose tm_id matches the one deleted from the DB
-            #now if the sourcetext key has no TU items left, remove the key
-            if len(self.data[source])==0:
-                self.data.pop(source)
+        self.remove_tus_from_memory([item for item in self.data.get(source, ()) 
+                                     if str(item['tm_id']) == str(tm_id) and item['targettext']==target])
         
         #now from DB
         existing_tus = self.data_mgr.get_tus_from_sourcetext(tm_id, source)
@@ -175,222 +214,380 @@ class TmProvider(object):
             for item in existing_tus[source]:
                 if item['targettext']==target:
                     tu_ids.append(item['tu_id'])
-            for tu_id in tu_ids:
-                self.data_mgr.delete_tu_by_tu_id(tu_id)
+            with datamodel.write_turns.short_write():
+                for tu_id in tu_ids:
+                    self.data_mgr.delete_tu_by_tu_id(tu_id)
         return {'status' : 'success'}
         
     def add_or_update_tu(self, tm_id, source, target, user, allow_multiple=False, overwrite_with_new=True):
         """Adds a source text/target text pair to the specified translation memory, 
         in the DB as well as the in-memory TM"""
-        
-        existing_tus = self.data_mgr.get_tus_from_sourcetext(tm_id, source)
-        existing_targets = [x['targettext'] for x in existing_tus[source]] if existing_tus else []
-        if target in existing_targets: #skip if there is a TU with the same source and target
-            return {'status' : 'tu not added or updated because one with the same source text and target text already exists'}
-        elif (not existing_tus) or (not allow_multiple):
-            status = 'TU added'
-            if existing_tus and overwrite_with_new: #if the source exists and overwrite = true, we are going to delete all existing TUs with that source and add this as new
-                for i in range(len(existing_tus[source])):
-                    self.data_mgr.delete_tu_by_tu_id(existing_tus[source][i]['tu_id'])
-                status = 'TU(s) updated'
-            #now add to DB and in-memory tm
-            tu_id = self.data_mgr.add_tu(tm_id, source, target, user, user)
-            self.data[source] = {'tm_id':tm_id, 'tu_id':tu_id, 'sourcetext':source, 'targettext':target,
-                                      'created_by':user, 'changed_by':user, 'created_date':time.strftime("%Y-%m-%d %H:%M:%S"),
-                                      'changed_date':time.strftime("%Y-%m-%d %H:%M:%S"), 'last_used_date':time.strftime("%Y-%m-%d %H:%M:%S")} #add new data to memory
-            return {'status' : status}
-        elif (allow_multiple and target not in existing_targets): #if tu with the same sourcetext doesn't exist...or if allow multiple and there isn't one already with same source and target...simply add it
-            tu_id = self.data_mgr.add_tu(tm_id, source, target, user, user)
-            self.data[source].append({'tm_id':tm_id, 'tu_id':tu_id, 'sourcetext':source, 'targettext':target,
-                                      'created_by':user, 'changed_by':user, 'created_date':time.strftime("%Y-%m-%d %H:%M:%S"),
-                                      'changed_date':time.strftime("%Y-%m-%d %H:%M:%S"), 'last_used_date':time.time()}) #add new data to memory
-            return {'status' : 'tu added'}
-        
-        
+        statuses = self.add_or_update_tus(tm_id, [(source, target)], user, allow_multiple, overwrite_with_new)
+        return {'status' : statuses[0]}
+    
+    def add_or_update_tus(self, tm_id, pairs, user, allow_multiple=False, overwrite_with_new=True):
+        """Adds or updates a list of (source text, target text) pairs in the specified translation memory,
+        in one DB transaction, as well as in the in-memory TM if it is loaded. 
+        Existing TUs are looked up in bulk, and each pair is then handled like add_or_update_tu:
+        a pair whose source and target already exist is skipped; otherwise, if not allow_multiple 
+        and overwrite_with_new, existing TUs with the same source are replaced. Returns a list 
+        with the status of each pair"""
+        tm_id = int(tm_id)
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        statuses = []
+        added = {} #tu_id: tu
+        deleted = {} #tu_id: tu
+        with datamodel.write_turns.short_write(): #gets in between the commits of any import running
+            cnx = self.data_mgr.get_connection()
+            try:
+                existing = self.data_mgr.get_tus_from_sourcetexts(tm_id, [source for source, target in pairs], cnx)
+                for source, target in pairs:
+                    existing_tus = existing.setdefault(source, [])
+                    if target in [x['targettext'] for x in existing_tus]: #skip if there is a TU with the same source and target
+                        statuses.append('tu not added or updated because one with the same source text and target text already exists')
+                        continue
+                    if (not existing_tus) or (not allow_multiple):
+                        status = 'TU added'
+                        if existing_tus and overwrite_with_new: #if the source exists and overwrite = true, we are going to delete all existing TUs with that source and add this as new
+                            self.data_mgr.delete_tus_by_tu_ids([x['tu_id'] for x in existing_tus], cnx)
+                            for tu in existing_tus:
+                                if added.pop(tu['tu_id'], None) is None: #added earlier in this batch...just don't add it to memory
+                                    deleted[tu['tu_id']] = tu
+                            del existing_tus[:]
+                            status = 'TU(s) updated'
+                    else: #allow multiple and there isn't one already with same source and target...simply add it
+                        status = 'tu added'
+                    tu_id = self.data_mgr.add_tu(tm_id, source, target, user, user, now, now, now, cnx)
+                    tu = datamodel.TranslationUnit(tu_id, tm_id, source, target, user, now, user, now, now)
+                    existing_tus.append(tu)
+                    added[tu_id] = tu
+                    statuses.append(status)
+                cnx.commit()
+            except:
+                cnx.rollback()
+                raise
+            finally:
+                cnx.close()
+        #now the in-memory tm...only touched if this TM is loaded
+        if tm_id in self.tms:
+            self.snapshot = self.snapshot.without_tus(deleted.values()).with_tus(added.values())
+        return statuses
+    
+    def add_tus_to_memory(self, tus):
+        """Adds TUs to the in-memory data and its indexes, skipping any that are already loaded"""
+        self.snapshot = self.snapshot.with_tus(tus)
+    
+    def remove_tus_from_memory(self, tus):
+        """Removes TUs, matched by tu_id, from the in-memory data and its indexes"""
+        self.snapshot = self.snapshot.without_tus(tus)
+    
+    def remove_tm_from_memory(self, tm_id):
+        """Removes all of a TM's TUs from the in-memory data. Only touches that TM's entries"""
+        self.snapshot = self.snapshot.without_tus(list(self.tm_index.get(int(tm_id), {}).values()))
+    
+    def clear_memory(self):
+        """Removes all TUs from the in-memory data, leaving the list of loaded TMs as is"""
+        self.snapshot = self.snapshot.cleared()
+
+    def create_tm_from_memory(self, tm_name, sourcelang, targetlang, owner, job=None):
+        """Creates a new TM holding all the TUs of the TMs currently loaded in memory.
+        The TUs are copied inside the DB rather than sent back one by one from memory"""
+        return self.merge_tms(list(self.tms.keys()), tm_name, owner, sourcelang=sourcelang, targetlang=targetlang,
+                              orig_filename="from_memory", job=job)
 
-    def create_tm_from_memory(self, tm_name, sourcelang, targetlang, owner, data):
-        """Creates a new TM and adds all the TUs in memory to it in the DB, 
-        the 'data' parameter should be a dict whose keys are source texts and values are dicts of TU data"""
-        tm_id = self.data_mgr.add_tm(tm_name, "from_memory", sourcelang, targetlang, owner) 
+    def merge_tms(self, tm_ids, tm_name, owner, dedupe=False, sourcelang=None, targetlang=None, orig_filename=None, job=None):
+        """Creates a new TM from the TUs of one or more existing TMs, copied inside the DB with INSERT ... SELECT.
+        With dedupe, TUs with the same source and target text are only copied once.
+        The languages default to those of the first TM"""
+        tm_ids = [int(x) for x in tm_ids]
+        all_tms = self.data_mgr.get_tms()
+        missing = [str(x) for x in tm_ids if x not in all_tms]
+        if not tm_ids:
+            raise ValueError("no TMs to merge")
+        if missing:
+            raise ValueError("no TM with ID of '{0}' exists".format(", ".join(missing)))
+        first = all_tms[tm_ids[0]]
+        if orig_filename is None:
+            orig_filename = "merged from tm_ids {0}".format(", ".join(str(x) for x in tm_ids))
         starttime=time.time()
-        logging.info("started import from in-memory tm to DB, tm_id: {0}".format(tm_id))
-        #open a data connection to keep open and send TUs one-by-one...to be committed and closed later when done
+        tm_id = self.data_mgr.add_tm(tm_name, orig_filename, sourcelang or first.sourcelang, 
+                                     targetlang or first.targetlang, owner)
+        logging.info("started copying TUs from tm_ids {0} to tm_id {1}".format(tm_ids, tm_id))
+        if job:
+            job.set_progress(0, tm_id=tm_id)
         cnx = self.data_mgr.get_connection()
-        num_tus=0
-        for key in data:
-            value = data[key]
-            for i in range(len(value)):
-                tu = dict(value[i])
-                self.data_mgr.add_tu(tm_id, tu['sourcetext'], tu['targettext'], user, user, 
-                                     time.strftime("%Y-%m-%d %H:%M:%S"), time.strftime("%Y-%m-%d %H:%M:%S"), time.strftime("%Y-%m-%d %H:%M:%S"), cnx)
-                num_tus+=1
-        endtime = time.time() 
-        logging.info("processed {0} TUs\ntime: {1}".format(num_tus, endtime - starttime))
-        #commit and close
-        cnx.commit()
-        cnx.cursor().close()
+        try:
+            #skip the per-row tms.last_updated_datetime trigger while copying...one update is done at the end instead
+            self.data_mgr.begin_bulk_import(tm_id, cnx)
+            num_tus = self.data_mgr.copy_tus(tm_ids, tm_id, dedupe, cnx)
+            cnx.commit()
+        except Exception:
+            cnx.rollback()
+            cnx.close()
+            self.data_mgr.delete_partial_import(tm_id) #rather than leave an empty TM
+            raise
+        self.data_mgr.end_bulk_import(tm_id, cnx)
         cnx.close()
-        return {'status' : 'success. processed {0} TUs'.format(num_tus)}
+        if job:
+            job.set_progress(num_tus)
+        logging.info("copied {0} TUs\ntime: {1}".format(num_tus, time.time() - starttime))
+        return {'status' : 'success. processed {0} TUs'.format(num_tus), 'tm_id' : tm_id, 'num_tus' : num_tus}
+
+    def copy_tm(self, tm_id, tm_name, owner, dedupe=False, job=None):
+        """Creates a new TM with a copy of the TUs of an existing TM, copied inside the DB"""
+        return self.merge_tms([tm_id], tm_name, owner, dedupe, job=job)
 
     def normalize_time_tmx_to_iso(self, timestring):
         """deals with differences in handling of iso8601, time...
            i.e., the DBs seem to choke with the T and the Z"""
-        #string e.g.: 20140204T184725Z has to become 2014-02-04 18:47:25 
-        y = timestring[0:4]
-        mon = timestring[4:6]
-        d = timestring[6:8]
-        h = timestring[9:11]
-        min = timestring[11:13]
-        s = timestring[13:15]
-        result = "{0}-{1}-{2} {3}:{4}:{5}".format(y,mon,d,h,min,s)
-        return result
+        return tmx.normalize_time_tmx_to_iso(timestring)
         
-    def load_tmx_to_db(self, tmxfile, tm_name, owner):
-        """Takes a previously uploaded TMX file and parses it, adding the translation units 
-           and info about the TM into the DB"""
+    def load_tmx_to_db(self, tmxfile, tm_name, owner, orig_filename=None, job=None):
+        """Parses a TMX file (a filename or a readable stream), adding the translation units 
+           and info about the TM into the DB. The document is parsed once, in a producer thread
+           that hands batches of TUs to this thread over a bounded queue for DB insertion.
+           If run as a background job, progress is reported to the job after each batch, and a 
+           cancelled job stops the import. If the import is cancelled or fails partway through (e.g.
+           a parse or DB error), the partially imported TM is removed, so it never shows up half done.
+           A TM left behind by a server restart mid-import is removed when the server starts again"""
 
         starttime=time.time()
         logging.info("started TMX import...")
         #TODO: check if TM already exists and error handling?????
         #TODO: check for empty string name and return...i.e. make required
 
-        header = "";
-        srclang=""
-        num_tus = 0
-        srclang = None
-        tgtlang = None
-        parser = ET.iterparse(tmxfile)
-        for event, element in parser:
-            if element.tag == 'header':
-                srclang = element.attrib["srclang"]
-            if element.tag == 'tu':
-                tuvs = element.findall("tuv")
-                #determine which is source and which is target...and put into tm insert
-                lang0 = tuvs[0].attrib['{http://www.w3.org/XML/1998/namespace}lang']
-                lang1 = tuvs[1].attrib['{http://www.w3.org/XML/1998/namespace}lang']
-                if lang0 == srclang:
-                    tgtlang = lang1
-                else:
-                    tgtlang = lang1
-                break
-        
-        #insert a new TM into the DB and return the id of the newly inserted tm
-        tm_id=self.data_mgr.add_tm(tm_name, tmxfile, srclang, tgtlang, owner)    
-        
-        #now insert TUs for the new TM
-        #open a data connection to keep open and send TUs one-by-one...to be committed and closed later when done
-        cnx = self.data_mgr.get_connection()
-        
-        #parse the rest of the doc
-        parser = ET.iterparse(tmxfile)
-        for event, element in parser:
-            if element.tag == 'tu':
-                tuvs = element.findall("tuv")
-                lang0 = tuvs[0].attrib['{http://www.w3.org/XML/1998/namespace}lang']
-                if lang0 == srclang:
-                    segtext = tuvs[0].find("seg").text
-                    trgtext = tuvs[1].find("seg").text
-                else:
-                    segtext = tuvs[1].find("seg").text
-                    trgtext = tuvs[0].find("seg").text
-                created_by = element.attrib['creationid'] if 'creationid' in element.attrib else owner
-                #strip out the 'T' in tmx datetime stamp b/c mysql doesn't understand it
-                created_date = self.normalize_time_tmx_to_iso(element.attrib['creationdate']) if 'creationdate' in element.attrib else time.strftime("%Y-%m-%d %H:%M:%S")
-                changed_by = element.attrib['changeid'] if 'changeid' in element.attrib else owner
-                changed_date = self.normalize_time_tmx_to_iso(element.attrib['changedate']) if 'changedate' in element.attrib else time.strftime("%Y-%m-%d %H:%M:%S")
-                last_used_date = self.normalize_time_tmx_to_iso(element.attrib['lastusagedate']) if 'lastusagedate' in element.attrib else time.strftime("%Y-%m-%d %H:%M:%S")
-                #insert the tu...By passing the current connection, the connection will stay open without the single insert being committed
-                self.data_mgr.add_tu(tm_id=tm_id, sourcetext=str.strip(segtext), 
-                           targettext=str.strip(trgtext),
-                           created_by=created_by, created_date=created_date, 
-                           changed_by=changed_by, changed_date=changed_date, last_used_date=last_used_date, connection=cnx)
-                element.clear()
-                num_tus+=1    
+        parser = tmx.TmxParser(tmxfile, owner)
+        batches = queue.Queue(self.import_queue_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self.parse_tmx_batches, args=(parser, batches, stop))
+        producer.daemon = True
+        producer.start()
+        try:
+            #the first batch can't arrive before the header and first TU have been read, so the languages are known by then
+            batch = self.get_tmx_batch(batches)
+            #insert a new TM into the DB and return the id of the newly inserted tm
+            tm_id=self.data_mgr.add_tm(tm_name, orig_filename or str(tmxfile), parser.srclang, parser.tgtlang, owner)    
+            
+            #now insert TUs for the new TM
+            #open a data connection to keep open and send TUs in batches...each batch is committed, and the connection closed when done
+            num_tus = 0
+            cnx = self.data_mgr.get_connection()
+            try:
+                #skip the per-row tms.last_updated_datetime trigger while importing...one update is done at the end instead
+                self.data_mgr.begin_bulk_import(tm_id, cnx)
+                while batch is not None:
+                    #commit at least every import_commit_seconds (and after each batch) to release the write lock, 
+                    #and let any short writes waiting for it in before going on
+                    committed = time.time()
+                    for i in range(0, len(batch), self.import_commit_rows):
+                        self.data_mgr.add_tus([(tm_id,) + row for row in batch[i:i+self.import_commit_rows]], cnx)
+                        if time.time() - committed >= self.import_commit_seconds or i + self.import_commit_rows >= len(batch):
+                            cnx.commit()
+                            datamodel.write_turns.yield_to_writers()
+                            committed = time.time()
+                    num_tus += len(batch)
+                    if job:
+                        job.set_progress(num_tus, tm_id=tm_id)
+                        job.check_cancelled()
+                    batch = self.get_tmx_batch(batches)
+            except Exception as e:
+                cnx.rollback() #a failed batch leaves its transaction open, which would block the deletes
+                cnx.close()
+                self.data_mgr.delete_partial_import(tm_id)
+                if job and job.cancel_requested:
+                    raise
+                raise TmxImportFailed("the import failed after {0} TUs, so the partially imported TM was removed: {1}".format(
+                                      num_tus, str(e) or type(e).__name__)) from e
+            self.data_mgr.end_bulk_import(tm_id, cnx)
+            cnx.close()
+        finally:
+            stop.set() #lets the producer exit if we bailed out early
         endtime = time.time() 
-        logging.info("processed {0} TUs\ntime: {1}".format(num_tus, endtime - starttime))
-        #commit and close
-        cnx.commit()
-        cnx.cursor().close()
-        cnx.close()
-        
+        rows_per_second = num_tus / (endtime - starttime) if endtime > starttime else 0
+        logging.info("processed {0} TUs\ntime: {1}\nrows/sec: {2:.0f}".format(num_tus, endtime - starttime, rows_per_second))
+        metrics.import_rows.inc(num_tus)
+        metrics.import_seconds.inc(endtime - starttime)
+        metrics.import_rows_per_second.set(rows_per_second)
+        return {'status' : 'success', 'tm_id' : tm_id, 'num_tus' : num_tus, 'rows_per_second' : rows_per_second}
+
+    def parse_tmx_batches(self, parser, batches, stop):
+        """Producer side of the TMX import: puts lists of up to import_batch_size parsed TUs on the queue,
+           then None when done. A parse error is put on the queue to be raised by the consumer"""
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
         
+        batch = []
+        try:
+            for row in parser:
+                batch.append(row)
+                if len(batch) >= self.import_batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def get_tmx_batch(self, batches):
+        """Consumer side of the TMX import: returns the next batch of TUs, or None when parsing is done"""
+        batch = batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
     
-    def import_tmx_file(self, file, tm_name, owner):
-        """Starts an upload of a TMX file and then calls the import to DB method"""
+    def import_tmx_file(self, file, tm_name, owner, job=None):
+        """Imports an uploaded TMX file, parsing straight from the upload stream. 
+           .tmx.gz, .tmx.bz2, .tmx.xz and single-file .zip uploads are decompressed on the fly.
+           A copy of the file (as uploaded, i.e. still compressed) is only written to upload/ 
+           if save_uploads is set in the config"""
         #TODO: check for empty strings on args
         #TODO: deal with file locking issues here in case 2 people are trying to load the same filename...also prevent overwriting in this case
-        starttime=time.time()
-        logging.info("started TMX import...")
-        size = 0
-        localfilename="{0}/upload/{1}".format(absDir, file.filename)
-        localfile = open(localfilename, 'wb')
-        while True:
-            data = file.file.read(8192)
-            localfile.write(data)
-            if not data:
-                break
-            size += len(data)
-        
-        localfile.close()
-        endtime = time.time() - starttime
-        logging.info("finished TMX upload...time elapsed: {0}".format(endtime))
         logging.info("started TMX parsing / DB insertion")
-        self.load_tmx_to_db(localfilename, tm_name, owner)
+        stream = file.file
+        localfile = None
+        if self.save_uploads:
+            localfilename="{0}/upload/{1}".format(absDir, os.path.basename(file.filename))
+            localfile = open(localfilename, 'wb')
+            if str.lower(file.filename).endswith('.zip'):
+                #zipfile needs to seek, so this one can't be saved during the parse pass
+                shutil.copyfileobj(stream, localfile)
+                stream.seek(0)
+            else:
+                stream = tmx.TeeReader(stream, localfile) #saved as it is parsed...no separate copy pass
+        try:
+            tmxstream = tmx.open_tmx_stream(stream, file.filename)
+            return self.load_tmx_to_db(tmxstream, tm_name, owner, file.filename, job)
+        finally:
+            if localfile:
+                localfile.close()
         
 
-    def export_tmx_file(self, tm_id):
-        """Retrieves the specified TM and exports it as a TMX file"""
+    def export_tmx_file(self, tm_id, compress=False):
+        """Retrieves the specified TM and exports it as a TMX file. Returns the TM info 
+           and a generator of (optionally gzipped) TMX chunks, read from the DB as they are written,
+           or None for both if the TM doesn't exist"""
+        tm = self.data_mgr.get_tms().get(int(tm_id))
+        if not tm:
+            return None, None
         logging.info("started TMX export...")
-        #TODO: put in logic to export to TMX
+        chunks = tmx.write_tmx(tm, self.data_mgr.iter_tus(tm.tm_id, self.export_chunk_size))
+        if compress:
+            chunks = tmx.gzip_stream(chunks)
+        return tm, chunks
             
-    def search(self, searchtext, threshold=.75, maxresults=0, casecost=.2):
+    def search(self, searchtext, threshold=.75, maxresults=0, casecost=.2, direction='source', priority='interactive'):
         """The whole point...searches for exact and fuzzy matches;
            rates and ranks, returning in descending order of match %.
            threshold is the minimum match score to return.
            maxresults is the maximum number of results to return (0 means no max)
            casecost is the cost applied to replacements consisting of merely a case change
            in the Levenshtein distance calc.  A casecost of less than one warps results in favor
-           of strings with merely case differences."""
+           of strings with merely case differences.
+           direction 'target' matches searchtext against the target text instead, if the target index is kept.
+           priority 'batch' (e.g. for pre-translation) lets interactive searches go first when the server is busy;
+           searches for long texts are always batch ones.
+           Identical searches running at the same time on the same TUs, from any session, share one computation,
+           which an interactive search joining a batch one that is still waiting moves up to interactive priority."""
 
         #type convert in case necessary
         threshold=float(threshold)
         casecost=float(casecost)
         maxresults=int(maxresults)
-         
+        snapshot = self.snapshot #used throughout, even if a writer swaps in a new one meanwhile
+        if direction=='target':
+            if snapshot.target_data is None:
+                raise ValueError("target text is not indexed; set target_index in the config to search by target text")
+        elif direction!='source':
+            raise ValueError("direction must be 'source' or 'target'")
+        if priority not in ('interactive', 'batch'):
+            raise ValueError("priority must be 'interactive' or 'batch'")
+        if len(searchtext) > self.batch_search_chars:
+            priority = 'batch'
+        #leading/trailing whitespace is stripped by Scorer.score, so it doesn't make a search different
+        key = (str.strip(searchtext), threshold, maxresults, casecost, direction, snapshot.content_key())
+        return self.search_flights.do(key, self.scheduled_search, SearchTicket(priority), snapshot, searchtext, threshold, 
+                                      maxresults, casecost, direction, on_join=partial(self.join_search, priority))
+    
+    def scheduled_search(self, ticket, *args):
+        """Runs search_snapshot once the server's search scheduler admits it (at once if there isn't one)"""
+        if self.search_scheduler is None:
+            return self.search_snapshot(*args)
+        return self.search_scheduler.run(ticket, self.search_snapshot, *args)
+    
+    def join_search(self, priority, ticket, *args):
+        """Called when a search joins an identical one that is running or waiting, so it doesn't wait at a lower priority than its own"""
+        if self.search_scheduler is not None:
+            self.search_scheduler.promote(ticket, priority)
+    
+    def search_snapshot(self, snapshot, searchtext, threshold, maxresults, casecost, direction='source'):
+        """Does the actual search, of one snapshot of the in-memory data"""
         logging.info("searching with Levenshtein...")
         lev_start_time = time.time()
-        sourcelist = list(self.data.keys())
+        index = snapshot.target_data if direction=='target' else snapshot.data #text: TUs
+        if TmProvider.scorer is None:
+            TmProvider.scorer = scorers.select_scorer()
+        scorer = TmProvider.scorer
+        prepared = scorer.get_prepared(index, (snapshot.content_key(), direction)) #only done for the first search of this content
         searchresults = {'data':{'matches':[]}}
         pre_endtime = time.time()
         logging.info("Pre-processing took {0} seconds\n".format(pre_endtime - lev_start_time))
-        if self.num_cores==0:
-            p = Pool() #uses max available
+        metrics.search_phase_seconds.observe(pre_endtime - lev_start_time, 'prepare')
+        if scorer.batched:
+            results = scorer.score(searchtext, threshold, casecost, prepared) #(text, score) pairs
         else:
-            p = Pool(self.num_cores)
-        results = set(p.map(partial(get_lev_ratio, searchtext, threshold, casecost), sourcelist)) #this has to be a list of hashable objects i think??
-        p.close()
+            if self.search_scheduler is not None:
+                p = self.search_scheduler.get_pool() #shared, so concurrent searches don't each start numcores processes
+            elif self.num_cores==0:
+                p = Pool() #uses max available
+            else:
+                p = Pool(self.num_cores)
+            chunks = scorer.chunks(prepared, self.num_cores or os.cpu_count())
+            results = [x for chunk in p.map(partial(scorer.score, searchtext, threshold, casecost), chunks) for x in chunk]
+            if self.search_scheduler is None:
+                p.close()
         endtime = time.time()
-        logging.info("Levenshtein lookup took {0} seconds\n".format(endtime - pre_endtime))
+        logging.info("Levenshtein lookup ({0}) took {1} seconds\n".format(scorer.name, endtime - pre_endtime))
+        metrics.search_phase_seconds.observe(endtime - pre_endtime, 'score')
+        metrics.search_candidates.inc(len(index), 'scanned')
+        metrics.search_candidates.inc(len(results), 'matched')
 
-        results.remove(None) #there will be one 'None'' element...see get_lev_ratio ..r/t multiprocessing and speed...need to return small set...is it possible to do an intermediate processing step in the map???
         results = sorted(results, key=itemgetter(1), reverse=True) #sort results descending by score
         count=0
+        used_tu_ids=[]
         for result in results:
             if maxresults !=0:
                 if count >= maxresults: break
                 count+=1
-            sourcetext = result[0]
-            tus = self.data[sourcetext] #for now this is only going to return one...but we should prob change it to allow miltiple source entries
-            for tu in tus: #if there are multiple tus for a given shourcetext the tu select will return more than one record
+            tus = index[result[0]] #for now this is only going to return one...but we should prob change it to allow miltiple source entries
+            for tu in tus: #if there are multiple tus for a given shourcetext (or targettext) the tu select will return more than one record
                 #TODO: make option to retrieve editops?
                 #editops = Levenshtein.editops(str.strip(searchtext),str.strip(sourcetext))
                 score = result[1]
-                match = {'sourcetext':sourcetext, 'targettext':tu['targettext'], 'matchscore':score, 
+                match = {'sourcetext':tu['sourcetext'], 'targettext':tu['targettext'], 'matchscore':score, 
                          'created_by':tu['created_by'], 'created_date':str(tu['created_date']), 
                          'changed_by':tu['changed_by'], 'changed_date':str(tu['changed_date']),
                          'last_used_date':str(tu['last_used_date'])}
                 searchresults['data']['matches'].append(match)
-        logging.info("post-processing took {0} seconds\n".format(time.time() - endtime))
+                used_tu_ids.append(tu['tu_id'])
+        if self.usage_recorder and used_tu_ids:
+            self.usage_recorder.record(used_tu_ids) #buffered...written to tus.last_used_date in the background
+        post_seconds = time.time() - endtime
+        logging.info("post-processing took {0} seconds\n".format(post_seconds))
+        metrics.search_phase_seconds.observe(post_seconds, 'postprocess')
+        if self.slow_search_log is not None:
+            self.slow_search_log.record(snapshot, {'searchtext' : searchtext, 'threshold' : threshold, 'maxresults' : maxresults,
+                                                   'casecost' : casecost, 'direction' : direction, 'scorer' : scorer.name},
+                                        {'prepare' : pre_endtime - lev_start_time, 'score' : endtime - pre_endtime, 'postprocess' : post_seconds},
+                                        {'scanned' : len(index), 'matched' : len(results), 'returned' : len(searchresults['data']['matches'])})
         return searchresults
         
         
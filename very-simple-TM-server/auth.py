@@ -21,9 +21,52 @@
 import datamodel
 import cherrypy
 import hashlib
+import threading
+import time
 
 SESSION_KEY = '_cp_username'
 
+class SessionSnapshots(object):
+    """Process-wide registry of the last state written to each session: session id: (username, tm_provider).
+       Requests that change the session publish it here once their handler is done, and read-only
+       requests use it instead of loading (and locking) the session, so they can run in parallel 
+       with each other and with a writer in the same session. A provider's TMs are held in an immutable
+       TmSnapshot that writers replace rather than change, so a reader always sees a consistent version"""
+    
+    def __init__(self):
+        self.entries = {} #session id: (refreshed time, username, tm_provider)
+        self.lock = threading.Lock()
+    
+    def get(self, session_id, max_age):
+        """Returns (username, tm_provider) if published less than max_age seconds ago, otherwise None"""
+        entry = self.entries.get(session_id)
+        if entry and entry[0] > time.time() - max_age:
+            return entry[1:]
+        return None
+    
+    def publish(self, session_id, username, tm_provider, timeout):
+        """Publishes the session's state, dropping entries not refreshed within timeout seconds 
+           (i.e. whose sessions have expired). Sessions without a logged-in user aren't kept"""
+        now = time.time()
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry[0] < now - timeout:
+                    self.entries.pop(key, None)
+            if username:
+                self.entries[session_id] = (now, username, tm_provider)
+            else:
+                self.entries.pop(session_id, None)
+        return username, tm_provider
+    
+    def discard(self, session_id):
+        with self.lock:
+            self.entries.pop(session_id, None)
+    
+    def __len__(self):
+        return len(self.entries)
+
+session_snapshots = SessionSnapshots()
+
 def check_credentials(username, password):
     """Verifies credentials for username and password.
     Returns None on success or a string describing the error on failure"""
@@ -41,6 +84,8 @@ def check_credentials(username, password):
     
 
 def get_current_username():
+    if cherrypy.request.login: #already resolved by check_auth, or from the session snapshot for read-only handlers
+        return cherrypy.request.login
     username = cherrypy.session.get(SESSION_KEY)
     if username:
         return cherrypy.session.get(SESSION_KEY)
@@ -53,7 +98,8 @@ def check_auth(*args, **kwargs):
     conditions that the user must fulfill"""
     conditions = cherrypy.request.config.get('auth.require', None)
     if conditions is not None:
-        username = cherrypy.session.get(SESSION_KEY)
+        #read-only handlers get the username from the session snapshot, without loading the session
+        username = cherrypy.request.login or cherrypy.session.get(SESSION_KEY)
         if username:
             cherrypy.request.login = username
             for condition in conditions:
@@ -86,14 +132,32 @@ def require(*conditions):
 #
 # Define those at will however suits the application.
 
+# Permissions are resolved by TmData.get_tm_permissions, which caches them per (user, tm_id)
+
+def user_can_read_tm(dm, tm_id, username):
+    return dm.get_tm_permissions(tm_id, username)['can_read']
+
 def can_read_tm():
     def check():
         dm = datamodel.TmData(cherrypy.request.app.config['/'])
         tm_id = cherrypy.request.params.get("tm_id")
         username = cherrypy.request.login
-        return ((dm.get_owner(tm_id) == username) or
-            (username in dm.get_tm_read_group_users(tm_id)) or
-            (username in dm.get_admin_users()))
+        return user_can_read_tm(dm, tm_id, username)
+    return check
+
+def can_read_tms():
+    """For methods taking a comma-separated list of 'tm_ids'; the user must be able to read all of them.
+       Methods where tm_ids is optional have to limit themselves to the TMs the user can read when it isn't given"""
+    def check():
+        dm = datamodel.TmData(cherrypy.request.app.config['/'])
+        if not cherrypy.request.params.get("tm_ids"):
+            return True
+        tm_ids = str(cherrypy.request.params.get("tm_ids", "")).split(",")
+        username = cherrypy.request.login
+        for tm_id in tm_ids:
+            if not user_can_read_tm(dm, str.strip(tm_id), username):
+                return "The current user cannot read the TM with id '{0}'".format(str.strip(tm_id))
+        return True
     return check
 
 def can_write_to_tm():
@@ -101,9 +165,7 @@ def can_write_to_tm():
         dm = datamodel.TmData(cherrypy.request.app.config['/'])
         tm_id = cherrypy.request.params.get("tm_id")
         username = cherrypy.request.login
-        return ((dm.get_owner(tm_id) == username) or
-            (username in dm.get_tm_read_write_group_users(tm_id)) or
-            (username in dm.get_admin_users()))
+        return dm.get_tm_permissions(tm_id, username)['can_write']
     return check
 
 def can_delete_tm():
@@ -111,13 +173,21 @@ def can_delete_tm():
         dm = datamodel.TmData(cherrypy.request.app.config['/'])
         tm_id = cherrypy.request.params.get("tm_id")
         username = cherrypy.request.login
-        return ((dm.get_owner(tm_id) == username) or
-            (username in dm.get_admin_users()))
+        return dm.get_tm_permissions(tm_id, username)['can_delete']
+    return check
+
+def can_manage_job():
+    def check():
+        dm = datamodel.TmData(cherrypy.request.app.config['/'])
+        job_id = cherrypy.request.params.get("job_id")
+        username = cherrypy.request.login
+        return ((dm.get_job_owner(job_id) == username) or
+            dm.get_tm_permissions(None, username)['is_admin'])
     return check
 
 def owns_tm():
     def check():
-        result = datamodel.TmData(cherrypy.request.app.config['/']).get_owner(cherrypy.request.params.get("tm_id")) == cherrypy.request.login
+        result = datamodel.TmData(cherrypy.request.app.config['/']).get_tm_permissions(cherrypy.request.params.get("tm_id"), cherrypy.request.login)['is_owner']
         if result:
             return result
         else:
@@ -126,8 +196,8 @@ def owns_tm():
 
 def is_admin():
     def check():
-        result = datamodel.TmData(cherrypy.request.app.config['/']).get_admin_users()
-        if cherrypy.request.login in result:
+        result = datamodel.TmData(cherrypy.request.app.config['/']).get_tm_permissions(None, cherrypy.request.login)['is_admin']
+        if result:
             return True
         else:
             return 'The current user does not have admin permissions'
@@ -186,6 +256,7 @@ class AuthController(object):
         if error_msg:
             return self.get_loginform(username, error_msg, destination)
         else:
+            session_snapshots.discard(cherrypy.session.id)
             cherrypy.session.regenerate() #thwart potential session fixation
             cherrypy.session[SESSION_KEY] = cherrypy.request.login = username
             self.on_login(username)
@@ -196,6 +267,7 @@ class AuthController(object):
         sess = cherrypy.session
         username = sess.get(SESSION_KEY, None)
         sess[SESSION_KEY] = None
+        session_snapshots.discard(sess.id)
         if username:
             cherrypy.request.login = None
             self.on_logout(username)
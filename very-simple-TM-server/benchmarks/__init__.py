@@ -0,0 +1,20 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+#benchmarks for TMX import, loading TMs to memory and search, run against a local sqlite DB:
+#    python -m benchmarks run --out results.json        (from the very-simple-TM-server directory)
+#    python -m benchmarks compare base.json results.json
+#    python -m benchmarks loadtest --users 20 --duration 60 --out load.json
+#    python -m benchmarks concurrency
+#    python -m benchmarks generate synthetic.tmx --tus 100000
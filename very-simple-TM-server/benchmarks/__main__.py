@@ -0,0 +1,151 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import argparse
+import json
+import sys
+from benchmarks import concurrency, loadtest, suites, tmx_generator
+from benchmarks.compare import compare, print_comparison
+
+
+def numbers(kind):
+    return lambda value: [kind(x) for x in value.split(",")]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="Benchmarks TMX import, TM loading and search, and load tests the server")
+    commands = parser.add_subparsers(dest='command')
+    
+    run = commands.add_parser('run', help="run the benchmarks and save the results as JSON")
+    run.add_argument('--out', help="the results file (otherwise they are only printed)")
+    run.add_argument('--sizes', type=numbers(int), default=[10000, 50000], help="TM sizes, in TUs (comma-separated)")
+    run.add_argument('--thresholds', type=numbers(float), default=[.5, .75, .9])
+    run.add_argument('--maxresults', type=numbers(int), default=[0, 10])
+    run.add_argument('--numcores', type=numbers(int), default=[1], help="only used by scorers that aren't batched")
+    run.add_argument('--queries', type=int, default=50, help="searches per combination of params")
+    run.add_argument('--repeat', type=int, default=3, help="runs of each measurement; the median is kept")
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--scorer', default='auto', help="the Levenshtein backend (see scorers.py)")
+    run.add_argument('--workdir', help="where to keep the generated TMX files and DB (a temporary directory otherwise)")
+    add_generator_args(run)
+    
+    comparison = commands.add_parser('compare', help="compare two results files, flagging regressions")
+    comparison.add_argument('base')
+    comparison.add_argument('new')
+    comparison.add_argument('--tolerance', type=float, default=.1, help="the fraction a metric can get worse by before it is a regression")
+    comparison.add_argument('--only-changes', action='store_true')
+    
+    load = commands.add_parser('loadtest', help="run simulated translators concurrently against a local server")
+    load.add_argument('--out', help="the results file (otherwise they are only printed)")
+    load.add_argument('--users', type=int, default=20)
+    load.add_argument('--duration', type=float, default=60, help="seconds")
+    load.add_argument('--ramp-up', type=float, default=5, help="seconds over which the users log in")
+    load.add_argument('--think-time', type=float, default=.5, help="mean seconds between a user's requests")
+    load.add_argument('--mix', type=weights, default=loadtest.default_mix, 
+                      help="relative weights of the users' requests, e.g. search=60,add_or_update_tu=20,import_tmx=1 (of {0})".format(
+                          ", ".join(sorted(loadtest.default_mix))))
+    load.add_argument('--tm-sizes', type=numbers(int), default=[20000], help="the TMs to seed the DB with, in TUs (comma-separated)")
+    load.add_argument('--tms-per-user', type=int, default=1, help="TMs each user loads")
+    load.add_argument('--import-tus', type=int, default=2000, help="TUs in the TMX file the users import")
+    load.add_argument('--seed', type=int, default=1)
+    load.add_argument('--numcores', type=int, default=1)
+    load.add_argument('--scorer', default='auto')
+    load.add_argument('--search-slots', type=int, default=0, help="the server's search_slots, i.e. searches computed at once (0: one per processor core)")
+    load.add_argument('--thread-pool', type=int, help="the server's worker threads (CherryPy's default otherwise)")
+    load.add_argument('--timeout', type=float, default=60, help="seconds before a request counts as an error")
+    load.add_argument('--max-error-rate', type=float, help="exit with 1 if the overall error rate is higher")
+    load.add_argument('--workdir', help="where to keep the DB, sessions and server log (a temporary directory otherwise)")
+    add_generator_args(load)
+    
+    check = commands.add_parser('concurrency', help="check that imports, writes and the session lock don't block other requests")
+    check.add_argument('--out', help="the results file (otherwise they are only printed)")
+    check.add_argument('--readers', type=int, default=4, help="threads searching in parallel in one session (their searches per second are compared with 1 thread's)")
+    check.add_argument('--tm-tus', type=int, default=100000, help="TUs of the TM loaded while the session's searches run")
+    check.add_argument('--import-tus', type=int, default=200000, help="TUs of the TMX file imported while other requests run")
+    check.add_argument('--max-latency', type=float, default=2, help="seconds a request may take before it counts as blocked")
+    check.add_argument('--timeout', type=float, default=600, help="seconds to wait for the import")
+    check.add_argument('--seed', type=int, default=1)
+    check.add_argument('--numcores', type=int, default=1)
+    check.add_argument('--scorer', default='auto')
+    check.add_argument('--workdir', help="where to keep the DB, sessions and server log (a temporary directory otherwise)")
+    
+    generate = commands.add_parser('generate', help="write a synthetic TMX file")
+    generate.add_argument('path')
+    generate.add_argument('--tus', type=int, default=10000)
+    generate.add_argument('--seed', type=int, default=1)
+    add_generator_args(generate)
+    
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = suites.run(args.sizes, args.thresholds, args.maxresults, args.numcores, args.queries, args.repeat,
+                             args.seed, args.scorer, args.workdir, generator_params(args))
+        if args.out:
+            with open(args.out, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=1)
+        return 0
+    elif args.command == 'loadtest':
+        results = loadtest.run(args.users, args.duration, args.ramp_up, args.think_time, args.mix, args.tm_sizes, 
+                               args.tms_per_user, args.import_tus, args.seed, args.numcores, args.scorer, args.search_slots,
+                               args.thread_pool, args.timeout, args.workdir, generator_params(args))
+        loadtest.print_results(results)
+        if args.out:
+            with open(args.out, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=1)
+        overall = results['results'][-1]['metrics'] if results['results'] else None
+        if args.max_error_rate is not None and (overall is None or overall['error_rate'] > args.max_error_rate):
+            return 1
+        return 0
+    elif args.command == 'concurrency':
+        results = concurrency.run(args.readers, args.tm_tus, args.import_tus, args.max_latency, args.timeout, args.seed, 
+                                  args.numcores, args.scorer, args.workdir)
+        if args.out:
+            with open(args.out, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=1)
+        return 0 if results['passed'] else 1
+    elif args.command == 'compare':
+        with open(args.base, encoding='utf-8') as f:
+            base = json.load(f)
+        with open(args.new, encoding='utf-8') as f:
+            new = json.load(f)
+        for name, results in (('base', base), ('new', new)):
+            print("{0}: {1}".format(name, ", ".join("{0}={1}".format(k, v) for k, v in sorted(results['environment'].items()))))
+        regressions = print_comparison(compare(base, new, args.tolerance), args.only_changes)
+        return 1 if regressions else 0 #so a CI step fails on a regression
+    elif args.command == 'generate':
+        tmx_generator.generate_tmx(args.path, args.tus, args.seed, **generator_params(args))
+        return 0
+    parser.print_help()
+    return 2
+
+def weights(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in loadtest.default_mix:
+            raise argparse.ArgumentTypeError("unknown request: " + name)
+        mix[name] = float(weight)
+    return mix
+
+def add_generator_args(parser):
+    parser.add_argument('--mean-words', type=float, default=12, help="median words per segment (log-normal)")
+    parser.add_argument('--sigma', type=float, default=.6, help="spread of the words per segment (log-normal)")
+    parser.add_argument('--max-words', type=int, default=80)
+    parser.add_argument('--duplicate-rate', type=float, default=.05, help="fraction of segments repeating an earlier one")
+    parser.add_argument('--variant-rate', type=float, default=.1, help="fraction of segments that are an earlier one slightly changed")
+
+def generator_params(args):
+    return {'mean_words' : args.mean_words, 'sigma' : args.sigma, 'max_words' : args.max_words,
+            'duplicate_rate' : args.duplicate_rate, 'variant_rate' : args.variant_rate}
+
+if __name__ == '__main__':
+    sys.exit(main())
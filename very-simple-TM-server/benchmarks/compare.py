@@ -0,0 +1,63 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+higher_is_better = set(['rows_per_second', 'searches_per_second', 'requests_per_second'])
+ignored = set(['matches_per_search', 'requests']) #describes the workload rather than performance...a change means the runs differ
+
+
+def result_key(result):
+    return (result['benchmark'], tuple(sorted(result['params'].items())))
+
+def compare(base, new, tolerance=.1):
+    """Compares the metrics of the benchmarks in both runs. A metric that got worse by more than tolerance 
+       (a fraction) is a regression. Returns a list of (benchmark, params, metric, base value, new value, 
+       change, 'regression'/'improvement'/None), where change is positive when the new run is better"""
+    base_results = dict((result_key(result), result) for result in base['results'])
+    rows = []
+    for result in new['results']:
+        base_result = base_results.get(result_key(result))
+        if base_result is None:
+            continue
+        for metric, value in result['metrics'].items():
+            base_value = base_result['metrics'].get(metric)
+            if metric in ignored or base_value is None:
+                continue
+            if base_value == 0:
+                #only flagged when it was none and now isn't, e.g. a load test that starts getting errors
+                if value and metric not in higher_is_better:
+                    rows.append((result['benchmark'], result['params'], metric, base_value, value, float('-inf'), 'regression'))
+                continue
+            if metric in higher_is_better:
+                change = value / base_value - 1
+            else:
+                change = base_value / value - 1 if value else float('inf')
+            flag = None
+            if change < -tolerance:
+                flag = 'regression'
+            elif change > tolerance:
+                flag = 'improvement'
+            rows.append((result['benchmark'], result['params'], metric, base_value, value, change, flag))
+    return rows
+
+def print_comparison(rows, only_changes=False):
+    for benchmark, params, metric, base_value, value, change, flag in rows:
+        if only_changes and flag is None:
+            continue
+        print("{0:<18} {1:<60} {2:<18} {3:>12.4g} {4:>12.4g} {5:>+8.1%} {6}".format(
+            benchmark, ", ".join("{0}={1}".format(k, v) for k, v in sorted(params.items())), metric, 
+            base_value, value, change, (flag or '').upper()))
+    regressions = sum(1 for row in rows if row[6] == 'regression')
+    improvements = sum(1 for row in rows if row[6] == 'improvement')
+    print("{0} metrics compared: {1} regressions, {2} improvements".format(len(rows), regressions, improvements))
+    return regressions
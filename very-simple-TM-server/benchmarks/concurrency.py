@@ -0,0 +1,273 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+from benchmarks.loadtest import Client, LoadStats, multipart, seed_db, start_server, free_port
+from benchmarks.suites import environment, percentile
+from benchmarks.tmx_generator import generate_tmx
+
+
+class Worker(threading.Thread):
+    """Calls action(client) over and over until stop is set, keeping (start time, seconds, code) for each call"""
+    def __init__(self, name, client, action, stop):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.client = client
+        self.action = action
+        self.stop = stop
+        self.calls = []
+
+    def run(self):
+        while not self.stop.is_set():
+            starttime = time.time()
+            self.action(self.client)
+            self.calls.append((starttime, time.time() - starttime, self.client.last_code))
+
+def ok(code):
+    return isinstance(code, int) and code < 400
+
+def summarize(calls):
+    latencies = [seconds for starttime, seconds, code in calls]
+    return {'requests' : len(calls), 'errors' : sum(1 for call in calls if not ok(call[2])),
+            'p95_ms' : percentile(latencies, 95) * 1000 if latencies else None, 
+            'max_ms' : max(latencies) * 1000 if latencies else None}
+
+def searcher(queries):
+    state = {'i' : 0}
+    def search(client):
+        state['i'] += 1
+        client.request('search', {'searchtext' : queries[state['i'] % len(queries)], 'threshold' : .75, 'maxresults' : 10})
+    return search
+
+class SlowUpload(object):
+    """A request body sent in parts over upload_seconds, as from a client on a slow link"""
+    def __init__(self, body, upload_seconds, parts=5):
+        self.body = body
+        self.upload_seconds = upload_seconds
+        self.parts = parts
+
+    def __iter__(self):
+        size = len(self.body) // self.parts + 1
+        for i in range(0, len(self.body), size):
+            time.sleep(self.upload_seconds / self.parts)
+            yield self.body[i:i+size]
+
+def slow_searcher(queries, upload_seconds):
+    """Searches POSTed with a body that takes upload_seconds to arrive...the server waits on the client rather than
+       the processor, so parallel requests can overlap even on one core, unless something serializes them"""
+    state = {'i' : 0}
+    def search(client):
+        state['i'] += 1
+        body = urllib.parse.urlencode({'searchtext' : queries[state['i'] % len(queries)], 'threshold' : .75, 
+                                       'maxresults' : 10}).encode('utf-8')
+        client.request('search', data=SlowUpload(body, upload_seconds), content_type='application/x-www-form-urlencoded',
+                       headers={'Content-Length' : str(len(body))})
+    return search
+
+def searches_per_second(base_url, stats, cookies, queries, readers, seconds, upload_seconds, timeout):
+    """Runs readers threads doing slow_searcher searches in the session of cookies for seconds. 
+       Returns the searches per second and the calls"""
+    stop = threading.Event()
+    workers = [Worker("check-session-scaling-{0}".format(i), Client(base_url, stats, cookies, timeout), 
+                      slow_searcher(queries[i::readers] or queries, upload_seconds), stop) for i in range(readers)]
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    calls = [call for worker in workers for call in worker.calls]
+    return len(calls) / seconds, calls
+
+def writer(tm_id, prefix):
+    state = {'i' : 0}
+    def add_or_update_tu(client):
+        state['i'] += 1
+        client.request('add_or_update_tu', data={'tm_id' : tm_id, 'source' : "{0} {1}".format(prefix, state['i']), 
+                                                 'target' : "{0} {1} translation".format(prefix, state['i'])})
+    add_or_update_tu.state = state
+    return add_or_update_tu
+
+def check_import(base_url, tm_id, queries, import_content, max_latency, timeout, log=print):
+    """While a TMX import runs (as a background job, committing batch by batch to the WAL mode sqlite DB),
+       other users log in, list TMs, search, add TUs and run concordance searches, each in a loop of its own.
+       Passes if the import finishes, and each of those ran during the import with no errors and none 
+       taking more than max_latency seconds, i.e. none was blocked by the import's writes"""
+    stats = LoadStats()
+    importer = Client(base_url, stats, timeout=timeout)
+    importer.login('user0')
+    actions = {'auth/login' : lambda client: client.login('user1'),
+               'list_tms' : lambda client: client.request('list_tms'),
+               'search' : searcher(queries),
+               'add_or_update_tu' : writer(tm_id, "import check"),
+               'concordance' : lambda client: client.request('concordance', {'query' : str.split(queries[0])[0], 'limit' : 20})}
+    stop = threading.Event()
+    workers = {}
+    for i, (name, action) in enumerate(actions.items()):
+        client = Client(base_url, stats, timeout=timeout)
+        client.login("user{0}".format(i + 1))
+        client.request('load_tm', {'tm_id' : tm_id})
+        workers[name] = Worker("check-import-" + name, client, action, stop)
+    for worker in workers.values():
+        worker.start()
+    body, content_type = multipart({'tm_name' : "concurrency check import"}, {'file' : ('check.tmx', import_content)})
+    started = time.time()
+    response = importer.request('import_tmx', data=body, content_type=content_type)
+    status = None
+    if response is not None:
+        job_id = json.loads(response)['job_id']
+        while time.time() < started + timeout:
+            time.sleep(.5)
+            result = importer.request('job_status', {'job_id' : job_id})
+            status = json.loads(result)['status']['status'] if result is not None else None
+            if status not in ('queued', 'running'):
+                break
+    finished = time.time()
+    stop.set()
+    for worker in workers.values():
+        worker.join()
+    problems = []
+    if status != 'finished':
+        problems.append("the import didn't finish (status {0})".format(status))
+    endpoints = {}
+    for name, worker in workers.items():
+        during = [call for call in worker.calls if started <= call[0] < finished]
+        endpoints[name] = summarize(during)
+        if not during:
+            problems.append("no {0} request ran during the import".format(name))
+        elif endpoints[name]['errors']:
+            problems.append("{0} {1} requests failed during the import".format(endpoints[name]['errors'], name))
+        elif endpoints[name]['max_ms'] > max_latency * 1000:
+            problems.append("a {0} request took {1:.0f} ms during the import".format(name, endpoints[name]['max_ms']))
+    return {'check' : 'import', 'passed' : not problems, 'problems' : problems, 
+            'import_seconds' : finished - started, 'endpoints' : endpoints}
+
+def check_session(base_url, tm_id, big_tm_id, queries, readers, max_latency, timeout, log=print, 
+                  scaling_seconds=4, upload_seconds=.05):
+    """First measures one session's search throughput with 1 and then readers threads searching, 
+       each search's request body taking upload_seconds to arrive, as from translators on a slow link. 
+       That is time spent waiting, not computing, so the searches overlap even on a single core unless 
+       the session serializes them (as it did when searches held the session lock, which was taken 
+       before the body was read): the readers must do at least max(1.5, readers/2) times the searches 
+       per second of 1 reader (ideally readers times). 
+       Then readers threads search in parallel while another adds TUs, and the session loads
+       a large TM (a writer, holding the session lock while it reads the TM). Passes if searches completed
+       while load_tm ran, with no errors and none taking more than max_latency seconds (i.e. searches 
+       read the session's snapshot without waiting for the session lock or for the writers), and the 
+       TUs added are found by a search afterwards"""
+    stats = LoadStats()
+    session = Client(base_url, stats, timeout=timeout)
+    session.login('user1')
+    session.request('load_tm', {'tm_id' : tm_id})
+    problems = []
+    session.request('search', {'searchtext' : queries[0], 'threshold' : .75, 'maxresults' : 10}) #prepares the index
+    rates = {}
+    scaling_calls = []
+    for n in sorted(set((1, readers))):
+        rates[n], calls = searches_per_second(base_url, stats, session.cookies, queries, n, scaling_seconds, upload_seconds, timeout)
+        scaling_calls += calls
+        log("searches per second in one session with {0} reader(s): {1:.1f}".format(n, rates[n]))
+    speedup = rates[readers] / rates[1] if rates[1] else 0
+    if readers < 2:
+        problems.append("search throughput scaling needs at least 2 readers")
+    elif speedup < max(1.5, readers / 2.0):
+        problems.append("{0} readers did {1:.1f} searches per second, only {2:.2f} times 1 reader's {3:.1f}".format(
+            readers, rates[readers], speedup, rates[1]))
+    failed = sum(1 for call in scaling_calls if not ok(call[2]))
+    if failed:
+        problems.append("{0} searches failed while measuring the throughput".format(failed))
+    stop = threading.Event()
+    workers = [Worker("check-session-search-{0}".format(i), Client(base_url, stats, session.cookies, timeout), 
+                      searcher(queries[i::readers] or queries), stop) for i in range(readers)]
+    add = writer(tm_id, "session check")
+    workers.append(Worker("check-session-write", Client(base_url, stats, session.cookies, timeout), add, stop))
+    for worker in workers:
+        worker.start()
+    time.sleep(1)
+    started = time.time()
+    session.request('load_tm', {'tm_id' : big_tm_id})
+    load_code = session.last_code
+    finished = time.time()
+    time.sleep(1)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    if not ok(load_code):
+        problems.append("load_tm failed ({0})".format(load_code))
+    searches = [call for worker in workers[:-1] for call in worker.calls]
+    during = [call for call in searches if started <= call[0] and call[0] + call[1] <= finished]
+    writes = workers[-1].calls
+    if finished - started < .5:
+        problems.append("load_tm took {0:.2f} s, too short to tell whether searches wait for it (use a larger TM)".format(finished - started))
+    if not during:
+        problems.append("no search completed while load_tm held the session lock")
+    failed = sum(1 for call in searches + writes if not ok(call[2]))
+    if failed:
+        problems.append("{0} searches or writes failed".format(failed))
+    slowest = max(call[1] for call in searches) if searches else 0
+    if slowest > max_latency:
+        problems.append("a search took {0:.0f} ms".format(slowest * 1000))
+    last = add.state['i'] - 1 #the one before the last attempted, which may have been cut short
+    if last > 0:
+        response = session.request('search', {'searchtext' : "session check {0}".format(last), 'threshold' : 1})
+        matches = json.loads(response)['data']['matches'] if response is not None else []
+        if not matches:
+            problems.append("a TU added during the check wasn't found by a search")
+    return {'check' : 'session', 'passed' : not problems, 'problems' : problems, 
+            'searches_per_second' : dict((str(n), rate) for n, rate in rates.items()), 'speedup' : speedup,
+            'load_tm_seconds' : finished - started,
+            'searches_during_load' : len(during), 'searches' : summarize(searches), 'writes' : summarize(writes)}
+
+def run(readers=4, tm_tus=100000, import_tus=200000, max_latency=2, timeout=600, seed=1, numcores=1, scorer='auto', 
+        workdir=None, log=print):
+    """Seeds a DB, starts the server and runs check_import and check_session against it. Returns the results,
+       with 'passed' only if every check did"""
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix='vstm-concurrency-')
+    os.makedirs(workdir, exist_ok=True)
+    process = None
+    try:
+        config, tm_ids, queries = seed_db(workdir, (5000, tm_tus), 8, seed, numcores, {}, log=log)
+        import_path = os.path.join(workdir, 'import.tmx')
+        generate_tmx(import_path, import_tus, seed + 2)
+        with open(import_path, 'rb') as f:
+            import_content = f.read()
+        port = free_port()
+        process = start_server(workdir, config, port, scorer)
+        base_url = "http://127.0.0.1:{0}/".format(port)
+        checks = []
+        for check in (lambda: check_import(base_url, tm_ids[0], queries, import_content, max_latency, timeout, log),
+                      lambda: check_session(base_url, tm_ids[0], tm_ids[1], queries, readers, max_latency, timeout, log)):
+            checks.append(check())
+            log("{0}: {1}{2}".format(checks[-1]['check'], 'passed' if checks[-1]['passed'] else 'FAILED', 
+                                     "".join("\n    " + problem for problem in checks[-1]['problems'])))
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {'environment' : environment(scorer), 
+            'params' : {'readers' : readers, 'tm_tus' : tm_tus, 'import_tus' : import_tus, 'max_latency' : max_latency, 
+                        'seed' : seed, 'numcores' : numcores},
+            'passed' : all(check['passed'] for check in checks), 'checks' : checks}
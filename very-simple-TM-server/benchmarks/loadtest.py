@@ -0,0 +1,355 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import collections
+import hashlib
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import datamodel
+from TmProvider import TmProvider
+from benchmarks.suites import localDir, make_config, make_queries, percentile, environment
+from benchmarks.tmx_generator import generate_tmx
+
+default_mix = {'search' : 60, 'add_or_update_tu' : 20, 'concordance' : 10, 'check_server_status' : 9, 'import_tmx' : 1}
+password = 'loadtest'
+group = 'loadtest'
+
+
+class LoadStats:
+    """Latencies and response codes per endpoint, shared by the simulated users"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.codes = collections.defaultdict(collections.Counter)
+
+    def record(self, endpoint, seconds, code):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.codes[endpoint][code] += 1
+
+    def results(self, duration):
+        """A result per endpoint, and one for all of them, as saved by the loadtest command (so compare 
+           can diff two runs). Errors are responses other than 2xx/3xx, or no response (code 'error');
+           503s, i.e. searches turned away by admission control, are also counted on their own"""
+        with self.lock:
+            latencies = dict((endpoint, list(values)) for endpoint, values in self.latencies.items())
+            codes = dict((endpoint, collections.Counter(counter)) for endpoint, counter in self.codes.items())
+        latencies['all'] = [x for values in latencies.values() for x in values]
+        codes['all'] = sum(codes.values(), collections.Counter())
+        results = []
+        for endpoint in sorted(latencies, key=lambda endpoint: (endpoint == 'all', endpoint)):
+            values = latencies[endpoint]
+            if not values:
+                continue
+            count = len(values)
+            errors = sum(n for code, n in codes[endpoint].items() if not (isinstance(code, int) and code < 400))
+            results.append({'benchmark' : 'loadtest', 'params' : {'endpoint' : endpoint},
+                            'metrics' : {'requests' : count, 'requests_per_second' : count / duration,
+                                         'p50_ms' : percentile(values, 50) * 1000, 'p95_ms' : percentile(values, 95) * 1000,
+                                         'p99_ms' : percentile(values, 99) * 1000, 'max_ms' : max(values) * 1000,
+                                         'error_rate' : errors / count, 'rejected_rate' : codes[endpoint][503] / count},
+                            'codes' : dict((str(code), n) for code, n in sorted(codes[endpoint].items(), key=str))})
+        return results
+
+
+def multipart(fields, files):
+    """Encodes fields ({name: value}) and files ({name: (filename, bytes)}) as multipart/form-data. 
+       Returns the body and its content type"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'.format(boundary, name, value).encode('utf-8'))
+    for name, (filename, content) in files.items():
+        parts.append('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, name, filename).encode('utf-8'))
+        parts.append(content)
+        parts.append(b'\r\n')
+    parts.append('--{0}--\r\n'.format(boundary).encode('utf-8'))
+    return b''.join(parts), 'multipart/form-data; boundary=' + boundary
+
+
+class Client(object):
+    """Sends requests to the server in a session of its own, or in a shared one if given its cookies
+       (e.g. for requests in parallel in the same session), recording each in stats"""
+    def __init__(self, base_url, stats, cookies=None, timeout=60):
+        self.base_url = base_url
+        self.stats = stats
+        self.timeout = timeout
+        self.cookies = cookies if cookies is not None else http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+        self.last_code = None
+
+    def request(self, endpoint, params=None, data=None, content_type=None, path=None, headers=None):
+        """Sends a GET, or a POST if there's data (a dict is form-encoded). Returns the body, or None on an error
+           (last_code is then the HTTP status, or 'error' if there was no response)"""
+        url = self.base_url + (path or endpoint)
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        if isinstance(data, dict):
+            data = urllib.parse.urlencode(data).encode('utf-8')
+        request = urllib.request.Request(url, data=data)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            request.add_header(name, value)
+        starttime = time.time()
+        body = None
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                body = response.read()
+                code = response.status
+        except urllib.error.HTTPError as e:
+            code = e.code
+            e.close()
+        except (urllib.error.URLError, OSError):
+            code = 'error'
+        self.last_code = code
+        self.stats.record(endpoint, time.time() - starttime, code)
+        return body
+
+    def login(self, username):
+        return self.request('auth/login', data={'username' : username, 'password' : password, 
+                                                'destination' : '/check_server_status'})
+
+
+class SimulatedUser(threading.Thread):
+    """A translator: logs in, loads a TM or two, then until stop_time runs requests picked at random
+       (weighted by mix) with a think time (exponentially distributed around think_time seconds) between them.
+       Every request is recorded in stats; a failed login or load_tm ends the session"""
+    def __init__(self, base_url, username, tm_ids, queries, mix, think_time, import_content, stats, stop_time,
+                 seed, tms_per_user=1, timeout=60):
+        threading.Thread.__init__(self, name="loadtest-" + username, daemon=True)
+        self.client = Client(base_url, stats, timeout=timeout)
+        self.username = username
+        self.tm_ids = tm_ids
+        self.queries = queries
+        self.actions = list(mix.keys())
+        self.weights = list(mix.values())
+        self.think_time = think_time
+        self.import_content = import_content
+        self.stop_time = stop_time
+        self.random = random.Random(seed)
+        self.tms_per_user = tms_per_user
+        self.loaded = []
+        self.count = 0
+
+    def run(self):
+        if self.client.login(self.username) is None:
+            return
+        for tm_id in self.random.sample(self.tm_ids, min(self.tms_per_user, len(self.tm_ids))):
+            if self.client.request('load_tm', {'tm_id' : tm_id}) is None:
+                return
+            self.loaded.append(tm_id)
+        while True:
+            pause = self.random.expovariate(1 / self.think_time) if self.think_time else 0
+            if time.time() + pause >= self.stop_time:
+                break
+            time.sleep(pause)
+            self.count += 1
+            action = self.random.choices(self.actions, self.weights)[0]
+            getattr(self, action)()
+
+    def search(self):
+        self.client.request('search', {'searchtext' : self.random.choice(self.queries), 'threshold' : .75, 'maxresults' : 10})
+
+    def concordance(self):
+        words = [word for word in str.split(self.random.choice(self.queries)) if len(word) > 3]
+        self.client.request('concordance', {'query' : self.random.choice(words) if words else 'the', 
+                                     'tm_ids' : ",".join(str(tm_id) for tm_id in self.loaded), 'limit' : 20})
+
+    def add_or_update_tu(self):
+        #a confirmed segment: mostly new TUs, sometimes a retranslation of an existing one
+        source = self.random.choice(self.queries)
+        if self.random.random() < .7:
+            source = "{0} ({1} {2})".format(source, self.username, self.count)
+        self.client.request('add_or_update_tu', data={'tm_id' : self.random.choice(self.loaded), 'source' : source,
+                                               'target' : "{0} {1} translation".format(self.username, self.count)})
+
+    def check_server_status(self):
+        self.client.request('check_server_status')
+
+    def import_tmx(self):
+        body, content_type = multipart({'tm_name' : "loadtest {0} {1}".format(self.username, self.count)},
+                                       {'file' : ('loadtest.tmx', self.import_content)})
+        self.client.request('import_tmx', data=body, content_type=content_type)
+
+
+def add_user(dm, username, is_admin=False):
+    h = hashlib.md5()
+    h.update(password.encode('utf-8'))
+    dm.execute_and_commit("INSERT INTO users (username, password, is_admin) VALUES(" + dm.placeholder + ", " +
+                          dm.placeholder + ", " + dm.placeholder + ")", (username, h.hexdigest(), int(is_admin)))
+
+def seed_db(workdir, tm_sizes, users, seed, numcores, generator_params, queries_per_tm=200, log=print):
+    """A new sqlite DB in workdir with a TM per size (synthetic TMX imported), an admin and users 
+       that can read and write all the TMs (through a group, so permissions are checked as they would be).
+       Returns the config, the TM ids and queries made from the TMs' segments"""
+    config = make_config(os.path.join(workdir, 'db'), numcores)
+    dm = datamodel.TmData(config)
+    add_user(dm, 'loadtest-admin', True)
+    dm.execute_and_commit("INSERT INTO groups (group_name) VALUES(" + dm.placeholder + ")", (group,))
+    for i in range(users):
+        add_user(dm, "user{0}".format(i))
+        dm.add_group_membership(group, "user{0}".format(i))
+    tm_ids = []
+    queries = []
+    for i, size in enumerate(tm_sizes):
+        tmx_path = os.path.join(workdir, "synthetic_{0}_{1}.tmx".format(size, seed + i))
+        generate_tmx(tmx_path, size, seed + i, **generator_params)
+        tm_id = TmProvider(config).load_tmx_to_db(tmx_path, "loadtest {0}".format(i), 'loadtest-admin')['tm_id']
+        dm.set_tm_groups(tm_id, group, group)
+        provider = TmProvider(config)
+        provider.load_tm_to_memory(tm_id)
+        queries.extend(make_queries(provider.data.keys(), queries_per_tm, seed + i))
+        tm_ids.append(tm_id)
+        log("seeded TM {0} with {1} TUs".format(tm_id, size))
+    return config, tm_ids, queries
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(workdir, config, port, scorer='auto', search_slots=0, thread_pool=None, startup_timeout=60):
+    """Runs the server in a separate process (so the simulated users don't compete with it for the GIL),
+       configured as in very_simple_TM_server.py but for the DB and a sessions directory in workdir.
+       Returns the process once the port accepts connections"""
+    appconfig = dict(config)
+    appconfig.update({'import_workers' : 2, 'last_used_flush_interval' : 30, 'permission_cache_ttl' : 60,
+                      'scorer' : scorer, 'search_slots' : search_slots, 'search_queue_timeout' : 10, 
+                      'search_max_queue' : 8, 'profile_path' : os.path.join(workdir, 'profiles'), 'max_profiles' : 20,
+                      'slow_search_seconds' : 2, 'slow_search_log' : os.path.join(workdir, 'slow_searches.jsonl'),
+                      'tools.json_out.on' : True})
+    serverconfig = {'tools.sessions.on' : True, 'tools.sessions.storage_type' : "file",
+                    'tools.sessions.storage_path' : os.path.join(workdir, 'sessions'), 'tools.sessions.locking' : 'early',
+                    'tools.auth.on' : True, 'server.socket_host' : '127.0.0.1', 'server.socket_port' : port,
+                    'engine.autoreload.on' : False, 'log.screen' : False, 'log.error_file' : os.path.join(workdir, 'server.log')}
+    if thread_pool:
+        serverconfig['server.thread_pool'] = thread_pool
+    os.makedirs(serverconfig['tools.sessions.storage_path'], exist_ok=True)
+    config_file = os.path.join(workdir, 'server.json')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump({'server' : serverconfig, 'app' : appconfig}, f)
+    with open(os.path.join(workdir, 'server.out'), 'ab') as out:
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.loadtest', config_file], cwd=localDir, 
+                                   stdout=out, stderr=subprocess.STDOUT)
+    deadline = time.time() + startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited on startup (see {0})".format(os.path.join(workdir, 'server.out')))
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process
+        except OSError:
+            time.sleep(.2)
+    process.kill()
+    raise RuntimeError("the server didn't start within {0} seconds".format(startup_timeout))
+
+def serve(config_file):
+    """The server process of start_server"""
+    import cherrypy
+    from very_simple_TM_server import VsTmServer
+    with open(config_file, encoding='utf-8') as f:
+        config = json.load(f)
+    cherrypy.config.update(config['server'])
+    cherrypy.tree.mount(VsTmServer(config['app']), '/', {'/' : config['app'], '/auth' : {'tools.json_out.on' : False}})
+    cherrypy.engine.signals.subscribe() #stops cleanly (pools, import workers) on SIGTERM
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+
+def run(users=20, duration=60, ramp_up=5, think_time=.5, mix=None, tm_sizes=(20000,), tms_per_user=1, import_tus=2000,
+        seed=1, numcores=1, scorer='auto', search_slots=0, thread_pool=None, timeout=60, workdir=None, 
+        generator_params=None, log=print):
+    """Seeds a DB, starts the server and runs users simulated translators against it for duration seconds
+       (their logins spread over ramp_up seconds). Returns the results, as saved by the loadtest command, 
+       including the server's search queue and coalescing stats at the end"""
+    mix = mix or default_mix
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix='vstm-loadtest-')
+    os.makedirs(workdir, exist_ok=True)
+    generator_params = generator_params or {}
+    process = None
+    try:
+        config, tm_ids, queries = seed_db(workdir, tm_sizes, users, seed, numcores, generator_params, log=log)
+        import_path = os.path.join(workdir, 'import.tmx')
+        generate_tmx(import_path, import_tus, seed + len(tm_sizes), **generator_params)
+        with open(import_path, 'rb') as f:
+            import_content = f.read()
+        port = free_port()
+        process = start_server(workdir, config, port, scorer, search_slots, thread_pool)
+        base_url = "http://127.0.0.1:{0}/".format(port)
+        log("server started on port {0}; running {1} users for {2} seconds".format(port, users, duration))
+        stats = LoadStats()
+        starttime = time.time()
+        stop_time = starttime + duration
+        simulated = []
+        for i in range(users):
+            user = SimulatedUser(base_url, "user{0}".format(i), tm_ids, queries, mix, think_time, import_content, 
+                                 stats, stop_time, seed * 1000 + i, tms_per_user, timeout)
+            simulated.append(user)
+            user.start()
+            if ramp_up and i < users - 1:
+                time.sleep(ramp_up / users)
+        for user in simulated:
+            user.join()
+        elapsed = time.time() - starttime
+        admin = Client(base_url, LoadStats())
+        admin.login('loadtest-admin')
+        server_status = json.loads(admin.request('check_server_status') or b'{}').get('status', {})
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {'environment' : environment(scorer), #the name configured...the server picks the backend for 'auto'
+            'params' : {'users' : users, 'duration' : duration, 'ramp_up' : ramp_up, 'think_time' : think_time, 
+                        'mix' : mix, 'tm_sizes' : list(tm_sizes), 'tms_per_user' : tms_per_user, 'import_tus' : import_tus,
+                        'seed' : seed, 'numcores' : numcores, 'search_slots' : search_slots, 'thread_pool' : thread_pool,
+                        'generator' : generator_params},
+            'elapsed' : elapsed,
+            'server' : {'search_queue' : server_status.get('search_queue'), 'search_coalescing' : server_status.get('search_coalescing')},
+            'results' : stats.results(elapsed)}
+
+def print_results(results):
+    print("{0:<20} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9} {7:>8}  {8}".format(
+        'endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'errors', 'codes'))
+    for result in results['results']:
+        metrics = result['metrics']
+        print("{0:<20} {1:>9} {2:>9.2f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>9.1f} {7:>8.1%}  {8}".format(
+            result['params']['endpoint'], metrics['requests'], metrics['requests_per_second'], metrics['p50_ms'],
+            metrics['p95_ms'], metrics['p99_ms'], metrics['max_ms'], metrics['error_rate'],
+            " ".join("{0}:{1}".format(code, n) for code, n in result['codes'].items())))
+    for name in ('search_queue', 'search_coalescing'):
+        if results['server'].get(name):
+            print("{0}: {1}".format(name, ", ".join("{0}={1}".format(k, v) for k, v in sorted(results['server'][name].items()))))
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
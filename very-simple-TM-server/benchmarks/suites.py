@@ -0,0 +1,173 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import cherrypy
+import datamodel
+import scorers
+from TmProvider import TmProvider
+from BackgroundTask import SearchScheduler
+from benchmarks.tmx_generator import generate_tmx
+
+localDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_config(workdir, numcores=1):
+    """A config for a new, empty sqlite DB in workdir"""
+    os.makedirs(workdir, exist_ok=True)
+    config = {'db_name' : 'benchmark', 'sqlite_db_path' : workdir, 'use_mysql' : False, 'numcores' : numcores,
+              'sql_scripts_path' : os.path.join(localDir, 'sql_scripts')}
+    db_file = os.path.join(workdir, 'benchmark.db')
+    for filename in (db_file, db_file + '-wal', db_file + '-shm'):
+        if os.path.exists(filename):
+            os.remove(filename)
+    datamodel.create_sqlite_db(db_file, os.path.join(localDir, 'sql_scripts', 'sqlite.sql'))
+    return config
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def bench_import(workdir, tmx_path, repeat):
+    """Imports the TMX file into a new DB repeat times. Returns the metrics and the config of the last DB"""
+    runs = []
+    for i in range(repeat):
+        config = make_config(workdir)
+        starttime = time.time()
+        result = TmProvider(config).load_tmx_to_db(tmx_path, 'benchmark', 'benchmark')
+        runs.append((time.time() - starttime, result['num_tus']))
+    seconds = statistics.median(run[0] for run in runs)
+    return {'seconds' : seconds, 'rows_per_second' : runs[0][1] / seconds if seconds else 0}, config, result['tm_id']
+
+def bench_load(config, tm_id, repeat):
+    """Times load_tm_to_memory, then measures the memory it takes in a separate run (tracemalloc slows it down)"""
+    runs = []
+    for i in range(repeat):
+        provider = TmProvider(config)
+        starttime = time.time()
+        provider.load_tm_to_memory(tm_id)
+        runs.append(time.time() - starttime)
+    provider = None
+    tracemalloc.start()
+    provider = TmProvider(config)
+    provider.load_tm_to_memory(tm_id)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tus = len(provider.tu_index)
+    return {'seconds' : statistics.median(runs), 'retained_mb' : retained / 1e6, 'peak_mb' : peak / 1e6, 
+            'bytes_per_tu' : retained / tus if tus else 0}, provider
+
+def make_queries(texts, n, seed=1):
+    """Segments of a TM (its source texts) with a word or two changed (fuzzy matches), a few unchanged 
+       (exact ones), and a few made of its words shuffled (mostly no matches)"""
+    r = random.Random(seed)
+    texts = sorted(text for text in texts if str.strip(text))
+    queries = []
+    for i in range(n):
+        words = str.split(r.choice(texts))
+        kind = i % 5
+        if kind == 0:
+            pass
+        elif kind == 4:
+            r.shuffle(words)
+        else:
+            for _ in range(r.randint(1, 2)):
+                position = r.randrange(len(words))
+                words[position] = str.split(r.choice(texts))[0]
+        queries.append(" ".join(words))
+    return queries
+
+def bench_search(provider, queries, threshold, maxresults, repeat):
+    """Runs each query repeat times through TmProvider.search; latencies are the median per query"""
+    provider.search(queries[0], threshold, maxresults) #the first search of a snapshot prepares the index for the scorer
+    latencies = []
+    matches = 0
+    for query in queries:
+        runs = []
+        for i in range(repeat):
+            starttime = time.time()
+            result = provider.search(query, threshold, maxresults)
+            runs.append(time.time() - starttime)
+        latencies.append(statistics.median(runs))
+        matches += len(result['data']['matches'])
+    return {'p50_ms' : percentile(latencies, 50) * 1000, 'p95_ms' : percentile(latencies, 95) * 1000,
+            'mean_ms' : statistics.mean(latencies) * 1000, 'searches_per_second' : len(latencies) / sum(latencies) if sum(latencies) else 0,
+            'matches_per_search' : matches / len(queries)}
+
+def environment(scorer=None):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=localDir, 
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'datetime' : time.strftime("%Y-%m-%d %H:%M:%S"), 'commit' : commit, 'python' : platform.python_version(),
+            'platform' : platform.platform(), 'cpu_count' : os.cpu_count(), 'scorer' : scorer or TmProvider.scorer.name}
+
+def run(sizes=(10000, 50000), thresholds=(.5, .75, .9), maxresults=(0, 10), numcores=(1,), queries=50, repeat=3, 
+        seed=1, scorer='auto', workdir=None, generator_params=None, log=print):
+    """Runs the import, load and search benchmarks for each TM size, in a scratch directory (removed afterwards
+       unless given). numcores only matters to scorers that aren't batched, so for batched ones (e.g. rapidfuzz)
+       only the first value is run. Returns the results, as saved by the run command"""
+    TmProvider.scorer = scorers.select_scorer(scorer)
+    if TmProvider.scorer.batched:
+        numcores = numcores[:1]
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix='vstm-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    generator_params = generator_params or {}
+    results = []
+    def add(benchmark, params, metrics):
+        results.append({'benchmark' : benchmark, 'params' : params, 'metrics' : metrics})
+        log("{0} {1}: {2}".format(benchmark, params, ", ".join("{0}={1:.4g}".format(k, v) for k, v in metrics.items())))
+    try:
+        for size in sizes:
+            #named after everything it is generated from, so a kept workdir's file is only reused for the same TMX
+            tmx_path = os.path.join(workdir, "synthetic_{0}_{1}{2}.tmx".format(size, seed, 
+                                    "".join("_{0}{1}".format(k, v) for k, v in sorted(generator_params.items()))))
+            if not os.path.exists(tmx_path):
+                generate_tmx(tmx_path, size, seed, **generator_params)
+            metrics, config, tm_id = bench_import(os.path.join(workdir, 'db'), tmx_path, repeat)
+            add('import', {'tus' : size}, metrics)
+            metrics, provider = bench_load(config, tm_id, repeat)
+            add('load_tm_to_memory', {'tus' : size}, metrics)
+            query_list = make_queries(provider.data.keys(), queries, seed)
+            for cores in numcores:
+                provider.num_cores = cores
+                #searches use a shared process pool in the server...so the pool isn't started per search here either
+                TmProvider.search_scheduler = SearchScheduler(cherrypy.engine, 1, 600, 1, cores)
+                try:
+                    for threshold in thresholds:
+                        for maxresult in maxresults:
+                            add('search', {'tus' : size, 'threshold' : threshold, 'maxresults' : maxresult, 'numcores' : cores},
+                                bench_search(provider, query_list, threshold, maxresult, repeat))
+                finally:
+                    TmProvider.search_scheduler.stop()
+                    TmProvider.search_scheduler = None
+            provider = None
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {'environment' : environment(), 
+            'params' : {'sizes' : list(sizes), 'thresholds' : list(thresholds), 'maxresults' : list(maxresults), 
+                        'numcores' : list(numcores), 'queries' : queries, 'repeat' : repeat, 'seed' : seed, 
+                        'generator' : generator_params},
+            'results' : results}
@@ -0,0 +1,103 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import bisect
+import itertools
+import math
+import random
+import time
+import tmx
+
+
+class SegmentGenerator(object):
+    """Generates the same synthetic source/target segment pairs for the same params: words from a made-up
+       vocabulary, picked with a Zipf distribution like the words of real text (with some capitalized, so 
+       casecost matters), in segments whose number of words is log-normally distributed around mean_words.
+       duplicate_rate of the segments repeat an earlier one exactly, and variant_rate are an earlier one with
+       a word or two changed, like the fuzzy matches a real TM is full of"""
+    
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'te', 'vo', 'zi', 'da', 'fen', 'gor', 'hal', 'jin', 'pra', 'str', 'ou', 'ei']
+    
+    def __init__(self, seed=1, vocabulary_size=20000, mean_words=12, sigma=.6, max_words=80, 
+                 duplicate_rate=.05, variant_rate=.1):
+        self.random = random.Random(seed)
+        self.mean_words = mean_words
+        self.sigma = sigma
+        self.max_words = max_words
+        self.duplicate_rate = duplicate_rate
+        self.variant_rate = variant_rate
+        self.source_words = self.make_vocabulary(vocabulary_size)
+        self.target_words = self.make_vocabulary(vocabulary_size)
+        self.cumulative_weights = list(itertools.accumulate(1 / (rank ** 1.1) for rank in range(1, vocabulary_size + 1)))
+        self.history = [] #word indexes of earlier segments, for duplicates and variants
+    
+    def make_vocabulary(self, size):
+        words = []
+        seen = set()
+        while len(words) < size:
+            word = "".join(self.random.choice(self.syllables) for _ in range(self.random.randint(1, 4)))
+            if word in seen:
+                continue
+            seen.add(word)
+            words.append(str.capitalize(word) if self.random.random() < .1 else word)
+        return words
+    
+    def random_words(self, n):
+        total = self.cumulative_weights[-1]
+        return [bisect.bisect_left(self.cumulative_weights, self.random.random() * total) for _ in range(n)]
+    
+    def text(self, words, vocabulary, end):
+        text = " ".join(vocabulary[i] for i in words)
+        return text[:1].upper() + text[1:] + end
+    
+    def segments(self, n):
+        """Yields n (source text, target text) pairs"""
+        for _ in range(n):
+            choice = self.random.random()
+            if self.history and choice < self.duplicate_rate:
+                words = self.random.choice(self.history)
+            elif self.history and choice < self.duplicate_rate + self.variant_rate:
+                words = list(self.random.choice(self.history))
+                for _ in range(self.random.randint(1, 2)):
+                    position = self.random.randrange(len(words))
+                    edit = self.random.random()
+                    if edit < .5 or len(words) == 1:
+                        words[position] = self.random_words(1)[0]
+                    elif edit < .75:
+                        words.insert(position, self.random_words(1)[0])
+                    else:
+                        del words[position]
+                words = tuple(words)
+            else:
+                length = int(round(self.random.lognormvariate(math.log(self.mean_words), self.sigma)))
+                words = tuple(self.random_words(min(self.max_words, max(1, length))))
+            if len(self.history) < 100000:
+                self.history.append(words)
+            else:
+                self.history[self.random.randrange(len(self.history))] = words
+            end = "?" if len(words) % 7 == 0 else "."
+            yield self.text(words, self.source_words, end), self.text(words, self.target_words, end)
+
+def generate_tmx(path, num_tus, seed=1, sourcelang='en-US', targetlang='de-DE', **params):
+    """Writes a TMX file of num_tus synthetic TUs (see SegmentGenerator for params) to path. 
+       The same seed and params always give the same file"""
+    generator = SegmentGenerator(seed, **params)
+    tm = {'sourcelang' : sourcelang, 'targetlang' : targetlang}
+    created = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(1400000000)) #fixed, so the file is too
+    rows = ((i, None, source, target, 'benchmark', created, 'benchmark', created, None) 
+            for i, (source, target) in enumerate(generator.segments(num_tus)))
+    with open(path, 'wb') as f:
+        for chunk in tmx.write_tmx(tm, rows):
+            f.write(chunk)
+    return path
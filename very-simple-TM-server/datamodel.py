@@ -12,11 +12,19 @@
 #See the License for the specific language governing permissions and
 #limitations under the License.
 
+import argparse
 import logging
 from mysql.connector import (connection)
 import sqlite3
 import time
 import os
+import re
+import threading
+import functools
+from contextlib import contextmanager
+import metrics
+
+_sqlite_journal_mode_set = set() #db file paths whose journal mode has already been set by this process
 
 def create_sqlite_db(db_filename, sql_script_file):
     """Creates an sqlite db to store translation memory data"""
@@ -75,8 +83,205 @@ def create_mysql_db_unless_exists(sql_script_file, user, password,
     conn.close()
     return {'result':'db created'}
 
+def read_create_statements(sql_script_file):
+    """The CREATE TABLE and CREATE TRIGGER statements of a create script, as (kind, name, statement) tuples"""
+    script_file = open(sql_script_file, 'r')
+    script_data = script_file.read()
+    script_file.close()
+    statements = []
+    for command in script_data.split(";\n\n"):
+        command = str.strip(command)
+        match = re.match(r'CREATE\s+(?:VIRTUAL\s+)?(TABLE|TRIGGER)\s+["`]?(\w+)', command, re.IGNORECASE)
+        if match:
+            statements.append((match.group(1).upper(), match.group(2), command))
+    return statements
+
+def same_sql(a, b):
+    """Whether two statements differ only in whitespace and a trailing semicolon"""
+    return ' '.join(a.rstrip('; \n').split()) == ' '.join(b.rstrip('; \n').split())
+
+def migrate_sqlite_db(db_filename, sql_script_file):
+    """Brings an sqlite db created by an older version of the create script up to date: creates the tables
+       it's missing (e.g. bulk_imports, jobs and the tus_fts full-text index) and re-creates the triggers that
+       differ from the script's. When tus_fts is created, it is built from the TUs already in the db.
+       All in one transaction, and safe to run any number of times...a db that is up to date is left as is"""
+    if not os.path.exists(db_filename):
+        return {'result':'db does not exist; not migrated', 'changes':[]}
+    conn = sqlite3.connect(db_filename, isolation_level=None)
+    changes = []
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        existing = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'trigger')"))
+        for kind, name, statement in read_create_statements(sql_script_file):
+            if name not in existing:
+                conn.execute(statement)
+                changes.append("created {0} {1}".format(kind.lower(), name))
+            elif kind == 'TRIGGER' and not same_sql(existing[name], statement):
+                conn.execute("DROP TRIGGER `{0}`".format(name))
+                conn.execute(statement)
+                changes.append("replaced trigger {0}".format(name))
+        if 'tus_fts' not in existing:
+            #the triggers only index TUs from now on...rebuild indexes the ones already there
+            conn.execute("INSERT INTO tus_fts(tus_fts) VALUES('rebuild')")
+            changes.append("built the full-text index of the TUs")
+        conn.execute("COMMIT")
+    except:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return {'result':'db migrated' if changes else 'db up to date', 'changes':changes}
+
+def migrate_mysql_db(sql_script_file, user, password, host, db_name):
+    """Brings a mysql db created by an older version of the create script up to date: creates the tables
+       it's missing (e.g. bulk_imports and jobs), adds the FULLTEXT keys missing from existing tables, which 
+       mysql builds from the rows already there, and re-creates the triggers that differ from the script's.
+       Safe to run any number of times...a db that is up to date is left as is. 
+       Note that mysql doesn't do DDL in transactions, so adding FULLTEXT keys to a large tus table locks it for a while"""
+    conn = connection.MySQLConnection(user=user, password=password, host=host)
+    cursor = conn.cursor()
+    cursor.execute("SELECT schema_name FROM information_schema.schemata WHERE schema_name = %s", (db_name,))
+    if not cursor.fetchall():
+        cursor.close()
+        conn.close()
+        return {'result':'db does not exist; not migrated', 'changes':[]}
+    cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = %s", (db_name,))
+    tables = set(row[0].lower() for row in cursor.fetchall())
+    cursor.execute("SELECT DISTINCT table_name, index_name FROM information_schema.statistics WHERE table_schema = %s", (db_name,))
+    indexes = set((row[0].lower(), row[1]) for row in cursor.fetchall())
+    cursor.execute("SELECT trigger_name, action_statement FROM information_schema.triggers WHERE trigger_schema = %s", (db_name,))
+    triggers = dict(cursor.fetchall())
+    cursor.execute("USE `{0}`".format(db_name)) #no need to escape here b/c not a user-passed value
+    changes = []
+    for kind, name, statement in read_create_statements(sql_script_file):
+        if kind == 'TABLE' and name.lower() not in tables:
+            cursor.execute(statement)
+            changes.append("created table {0}".format(name))
+        elif kind == 'TABLE':
+            for index_name, columns in re.findall(r'FULLTEXT KEY `(\w+)` \(([^)]*)\)', statement):
+                if (name.lower(), index_name) not in indexes:
+                    cursor.execute("ALTER TABLE `{0}` ADD FULLTEXT KEY `{1}` ({2})".format(name, index_name, columns))
+                    changes.append("added FULLTEXT key {0} to {1}".format(index_name, name))
+        elif name not in triggers or not same_sql(triggers[name], statement[statement.index('BEGIN'):]):
+            cursor.execute("DROP TRIGGER IF EXISTS `{0}`".format(name))
+            cursor.execute(statement)
+            changes.append("{0} trigger {1}".format('replaced' if name in triggers else 'created', name))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return {'result':'db migrated' if changes else 'db up to date', 'changes':changes}
+
+def migrate_db(config):
+    """Runs migrate_sqlite_db or migrate_mysql_db, whichever the config uses, with its create script"""
+    if config.get('use_mysql'):
+        return migrate_mysql_db("{0}/{1}.sql".format(config['sql_scripts_path'], 'mysql_for_python'), user=config['db_user'], 
+                                password=config['db_password'], host=config['db_host'], db_name=config['db_name'])
+    return migrate_sqlite_db("{0}/{1}.db".format(config['sqlite_db_path'], config['db_name']), 
+                             "{0}/{1}.sql".format(config['sql_scripts_path'], 'sqlite'))
+
+
+
+
+def parse_concordance_query(query):
+    """Splits a concordance query into the terms that must all match, as (text, is_prefix) tuples:
+       "quoted text" is a phrase, and a word (or phrase) ending in * matches as a prefix"""
+    terms = []
+    for phrase, phrase_prefix, word in re.findall(r'"([^"]*)"(\*?)|(\S+)', query):
+        if word:
+            text, is_prefix = word.rstrip('*'), word.endswith('*')
+        else:
+            text, is_prefix = phrase, phrase_prefix == '*'
+        text = str.strip(text)
+        if text:
+            terms.append((text, is_prefix))
+    return terms
+
+class WriteTurns(object):
+    """Lets short writes (e.g. add_or_update_tu) in between the commits of a long bulk write (e.g. a TMX import).
+       Sqlite has one writer at a time, and a connection waiting for the write lock only retries every so often
+       (up to 100 ms apart), so a bulk write that starts its next batch right after committing can keep it out
+       for many batches. Short writes are counted as waiting while they run (short_write), and the bulk write
+       calls yield_to_writers after each commit, which waits until they are done, for at most max_wait seconds
+       so a steady stream of them can't stall it either"""
+    
+    def __init__(self, max_wait=1):
+        self.max_wait = max_wait
+        self.waiting = 0
+        self.condition = threading.Condition()
+    
+    @contextmanager
+    def short_write(self):
+        with self.condition:
+            self.waiting += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.waiting -= 1
+                if not self.waiting:
+                    self.condition.notify_all()
+    
+    def yield_to_writers(self):
+        with self.condition:
+            if self.waiting:
+                self.condition.wait_for(lambda: not self.waiting, self.max_wait)
+
+write_turns = WriteTurns()
+
+def short_write(f):
+    """Decorator for TmData methods that are a short write transaction of their own (see WriteTurns)"""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with write_turns.short_write():
+            return f(*args, **kwargs)
+    return wrapper
 
+class PermissionCache(object):
+    """Caches resolved permissions per (username, tm_id) for ttl seconds, so the auth conditions
+       don't have to hit the DB on every request. TmData invalidates the affected entries whenever
+       it changes TM ownership or groups, group memberships, or admin flags"""
+    
+    def __init__(self, ttl=60, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {} #(username, tm_id): (expiry time, permissions dict)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, username, tm_id):
+        entry = self.entries.get((username, tm_id))
+        if entry and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+    
+    def put(self, username, tm_id, permissions):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[(username, tm_id)] = (time.time() + self.ttl, permissions)
+    
+    def invalidate(self, username=None, tm_id=None):
+        """Drops the entries for a user, for a TM, or (with neither) everything"""
+        with self.lock:
+            if username is None and tm_id is None:
+                self.entries.clear()
+                return
+            tm_id = str(tm_id) if tm_id is not None else None
+            for key in list(self.entries.keys()):
+                if key[0] == username or key[1] == tm_id:
+                    self.entries.pop(key, None)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits' : self.hits, 'misses' : self.misses, 'size' : len(self.entries),
+                'hit_rate' : float(self.hits) / lookups if lookups else None}
 
+permission_cache = PermissionCache()
 
 class TranslationMemory(dict):
     """A data object representing a translation memory document.
@@ -110,6 +315,24 @@ class TranslationUnit(dict):
         self.changed_date=self['changed_date']=changed_date
         self.last_used_date=self['last_used_date']=last_used_date
     
+class BackgroundJob(dict):
+    """A data object representing the persisted state of a background job
+        subclass of dict to allow JSON serialization"""
+    def __init__(self, job_id, owner, job_type, description, status, progress, message, tm_id,
+                 created_datetime, started_datetime, finished_datetime):
+        #add values as class properties, and as dict keys for serialization
+        self.job_id=self['job_id']=job_id
+        self.owner=self['owner']=owner
+        self.job_type=self['job_type']=job_type
+        self.description=self['description']=description
+        self.status=self['status']=status
+        self.progress=self['progress']=progress
+        self.message=self['message']=message
+        self.tm_id=self['tm_id']=tm_id
+        self.created_datetime=self['created_datetime']=str(created_datetime) if created_datetime else None
+        self.started_datetime=self['started_datetime']=str(started_datetime) if started_datetime else None
+        self.finished_datetime=self['finished_datetime']=str(finished_datetime) if finished_datetime else None
+    
 class TmData(object):
     """Used to map data and objects related to translation memory documents.
        Uses either sqlite or mysql depending on the values passed in the config"""
@@ -126,6 +349,12 @@ class TmData(object):
         if config.get('sql_scripts_path'):
             self.sqlite_scripts_path = "{0}/{1}.sql".format(config['sql_scripts_path'], 'sqlite')
             self.mysql_scripts_path = "{0}/{1}.sql".format(config['sql_scripts_path'], 'mysql')
+        #sqlite tuning...WAL lets readers (searches, logins, list_tms) keep going while an import holds the write lock
+        self.sqlite_journal_mode = config.get('sqlite_journal_mode', 'WAL')
+        self.sqlite_synchronous = config.get('sqlite_synchronous', 'NORMAL') #NORMAL is safe in WAL mode and avoids an fsync per commit
+        self.sqlite_cache_size = int(config.get('sqlite_cache_size', -64000)) #negative values are in KiB, i.e. ~64MB page cache
+        self.sqlite_mmap_size = int(config.get('sqlite_mmap_size', 268435456)) #256MB of the db file memory-mapped for reads
+        self.sqlite_busy_timeout = int(config.get('sqlite_busy_timeout', 30000)) #ms to wait on a locked db before raising
         
     
     def get_connection(self):
@@ -134,9 +363,22 @@ class TmData(object):
                                      host=self.DB_HOST,
                                      database=self.DB_NAME)
         else:
-            cnx = sqlite3.connect(self.sqlite_db_filepath)
+            cnx = sqlite3.connect(self.sqlite_db_filepath, timeout=self.sqlite_busy_timeout/1000)
+            self.set_sqlite_pragmas(cnx)
         return cnx
 
+    def set_sqlite_pragmas(self, cnx):
+        """Applies the per-connection pragmas. The journal mode is persistent in the db file,
+           so it only needs to be switched once per db per process"""
+        if self.sqlite_db_filepath not in _sqlite_journal_mode_set:
+            cnx.execute("PRAGMA journal_mode={0}".format(self.sqlite_journal_mode))
+            _sqlite_journal_mode_set.add(self.sqlite_db_filepath)
+        cnx.execute("PRAGMA synchronous={0}".format(self.sqlite_synchronous))
+        cnx.execute("PRAGMA cache_size={0}".format(self.sqlite_cache_size))
+        cnx.execute("PRAGMA mmap_size={0}".format(self.sqlite_mmap_size))
+        cnx.execute("PRAGMA busy_timeout={0}".format(self.sqlite_busy_timeout))
+
+    @metrics.db_query
     def get_user(self, username):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -155,6 +397,7 @@ class TmData(object):
         
         
     
+    @metrics.db_query
     def set_password(self, username, password):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -168,6 +411,7 @@ class TmData(object):
         conn.close()
         
 
+    @metrics.db_query
     def get_owner(self, tm_id):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -186,6 +430,7 @@ class TmData(object):
         
         
 
+    @metrics.db_query
     def get_tm_last_updated_datetime(self, tm_id):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -203,6 +448,17 @@ class TmData(object):
             return result[0][0] #gets the result from the index
         
         
+    @metrics.db_query
+    def count_tus(self, tm_id):
+        conn = self.get_connection()
+        cursor=conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM tus WHERE `tm_id` = "+self.placeholder, (tm_id,))
+        result = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return result[0][0]
+        
+    @metrics.db_query
     def get_tm_read_group_users(self, tm_id):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -215,6 +471,7 @@ class TmData(object):
         x = [x[0] for x in result]
         return x #gets the result from the index
 
+    @metrics.db_query
     def get_tm_read_write_group_users(self, tm_id):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -229,6 +486,7 @@ class TmData(object):
         conn.close()
         return x #gets the result from the index
     
+    @metrics.db_query
     def get_admin_users(self):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -245,8 +503,86 @@ class TmData(object):
             conn.close()
             return result[0] #gets the result from the index
 
+    def get_tm_permissions(self, tm_id, username):
+        """Resolves what a user may do with a TM in one query, cached in permission_cache.
+           tm_id can be None to only check the user's admin flag.
+           Returns a dict: {'is_admin':, 'is_owner':, 'can_read':, 'can_write':, 'can_delete':}"""
+        tm_id = str(tm_id) if tm_id is not None else None
+        permissions = permission_cache.get(username, tm_id)
+        if permissions is not None:
+            return permissions
+        result = self.select_tm_permissions(tm_id, username)
+        if not result:
+            is_admin = is_owner = in_read_group = in_write_group = False
+        else:
+            is_admin = bool(result[0][0])
+            is_owner = result[0][1] is not None and result[0][1] == username
+            in_read_group = bool(result[0][2])
+            in_write_group = bool(result[0][3])
+        permissions = {'is_admin' : is_admin, 'is_owner' : is_owner,
+                       'can_read' : is_owner or is_admin or in_read_group or in_write_group,
+                       'can_write' : is_owner or is_admin or in_write_group,
+                       'can_delete' : is_owner or is_admin}
+        permission_cache.put(username, tm_id, permissions)
+        return permissions
+
+    @metrics.db_query
+    def select_tm_permissions(self, tm_id, username):
+        """The row get_tm_permissions resolves permissions from: [(is_admin, owner, in read group, in readwrite group)], 
+           or [] if the user doesn't exist"""
+        conn = self.get_connection()
+        cursor=conn.cursor()
+        select_permissions = ("SELECT `users`.`is_admin`, `tms`.`owner`, "
+                              "EXISTS(SELECT 1 FROM `group_memberships` WHERE `group_memberships`.`user` = `users`.`username` "
+                              "AND `group_memberships`.`group` = `tms`.`readonly_group`), "
+                              "EXISTS(SELECT 1 FROM `group_memberships` WHERE `group_memberships`.`user` = `users`.`username` "
+                              "AND `group_memberships`.`group` = `tms`.`readwrite_group`) "
+                              "FROM `users` LEFT JOIN `tms` ON `tms`.`tm_id` = " + self.placeholder +
+                              " WHERE `users`.`username` = " + self.placeholder)
+        cursor.execute(select_permissions, (tm_id, username))
+        result = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return result
+
+    def set_tm_owner(self, tm_id, owner):
+        self.execute_and_commit("UPDATE tms SET owner=" + self.placeholder + 
+                                " WHERE tm_id=" + self.placeholder, (owner, tm_id))
+        permission_cache.invalidate(tm_id=tm_id)
+
+    def set_tm_groups(self, tm_id, readonly_group, readwrite_group):
+        self.execute_and_commit("UPDATE tms SET readonly_group=" + self.placeholder + 
+                                ", readwrite_group=" + self.placeholder +
+                                " WHERE tm_id=" + self.placeholder, (readonly_group, readwrite_group, tm_id))
+        permission_cache.invalidate(tm_id=tm_id)
+
+    def add_group_membership(self, group, username):
+        self.execute_and_commit("INSERT INTO group_memberships (`group`, `user`) VALUES(" + 
+                                self.placeholder + ", " + self.placeholder + ")", (group, username))
+        permission_cache.invalidate(username=username)
+
+    def delete_group_membership(self, group, username):
+        self.execute_and_commit("DELETE FROM group_memberships WHERE `group`=" + self.placeholder +
+                                " AND `user`=" + self.placeholder, (group, username))
+        permission_cache.invalidate(username=username)
+
+    def set_admin(self, username, is_admin):
+        self.execute_and_commit("UPDATE users SET is_admin=" + self.placeholder + 
+                                " WHERE username=" + self.placeholder, (1 if is_admin else 0, username))
+        permission_cache.invalidate(username=username)
+
+    @metrics.db_query
+    def execute_and_commit(self, statement, params):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(statement, params)
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    @metrics.db_query
     def get_tms(self):
-        #TODO: if using sqlite and this gets called (or anything else...) while a tm is loading in a bg task. there may be db lock errors
+        #with sqlite in WAL mode (the default, see set_sqlite_pragmas) this won't block on a tm being imported in a bg task
         conn = self.get_connection()
         cursor=conn.cursor()
         select_tm = ("SELECT * FROM tms")
@@ -257,6 +593,102 @@ class TmData(object):
         conn.close()
         return tms
 
+    @metrics.db_query
+    def get_readable_tms(self, username, sourcelang=None, targetlang=None, name_prefix=None, after_tm_id=None, limit=0):
+        """Returns the TMs the user can read, in tm_id order, with 'can_read' and 'can_write' set, 
+           resolving the permissions for all TMs in a single query. Optionally filtered by language pair
+           and name prefix, and paged: after_tm_id is the last tm_id of the previous page, limit the page size (0 for all)"""
+        conn = self.get_connection()
+        cursor=conn.cursor()
+        in_group = ("EXISTS(SELECT 1 FROM `group_memberships` WHERE `group_memberships`.`user` = `users`.`username` "
+                    "AND `group_memberships`.`group` = `tms`.`{0}`)")
+        can_write = "(`users`.`is_admin` = 1 OR `tms`.`owner` = `users`.`username` OR " + in_group.format('readwrite_group') + ")"
+        select_tms = ("SELECT * FROM (SELECT `tms`.`tm_id`, `tms`.`name`, `tms`.`orig_filename`, `tms`.`sourcelang`, `tms`.`targetlang`, "
+                      "`tms`.`created_datetime`, `tms`.`last_updated_datetime`, " + 
+                      can_write + " AS can_write, "
+                      "(" + can_write + " OR " + in_group.format('readonly_group') + ") AS can_read "
+                      "FROM `tms` INNER JOIN `users` ON `users`.`username` = " + self.placeholder + ") AS permitted "
+                      "WHERE can_read = 1")
+        params = [username]
+        if sourcelang:
+            select_tms += " AND sourcelang = " + self.placeholder
+            params.append(sourcelang)
+        if targetlang:
+            select_tms += " AND targetlang = " + self.placeholder
+            params.append(targetlang)
+        if name_prefix:
+            select_tms += " AND name LIKE " + self.placeholder + " ESCAPE '!'"
+            params.append(name_prefix.replace('!', '!!').replace('%', '!%').replace('_', '!_') + '%')
+        if after_tm_id is not None:
+            select_tms += " AND tm_id > " + self.placeholder
+            params.append(int(after_tm_id))
+        select_tms += " ORDER BY tm_id"
+        if limit:
+            select_tms += " LIMIT " + str(int(limit))
+        cursor.execute(select_tms, tuple(params))
+        result = cursor.fetchall()
+        tms = []
+        for x in result:
+            tm = TranslationMemory(x[0], x[1], x[2], x[3], x[4], x[5], x[6])
+            tm['can_write'] = bool(x[7])
+            tm['can_read'] = bool(x[8])
+            tms.append(tm)
+        cursor.close()
+        conn.close()
+        return tms
+
+    @metrics.db_query
+    def search_concordance(self, query, fields='both', tm_ids=None, after_tu_id=None, limit=50):
+        """Returns the TUs, in tu_id order, whose text contains all the terms of the query (see parse_concordance_query),
+           using the full-text index (FTS5 in sqlite, FULLTEXT indexes in mysql) rather than scanning.
+           fields is 'source', 'target' or 'both'; tm_ids restricts the TMs searched (None for all). 
+           Paged: after_tu_id is the last tu_id of the previous page, limit the page size"""
+        columns = {'source' : 'sourcetext', 'target' : 'targettext', 'both' : None}.get(fields, '')
+        if columns == '':
+            raise ValueError("fields must be 'source', 'target' or 'both'")
+        terms = parse_concordance_query(query)
+        if not terms or tm_ids == []:
+            return []
+        params = []
+        if self.use_mysql:
+            #mysql boolean mode: +"phrase" must be there; prefixes can't be quoted, so operator characters are dropped instead
+            against = []
+            for text, is_prefix in terms:
+                words = re.sub(r'[-+<>()~*"@]+', ' ', text).split()
+                if is_prefix and len(words) == 1:
+                    against.append("+" + words[0] + "*")
+                elif words: #a phrase ending in * is matched as a whole phrase
+                    against.append('+"' + " ".join(words) + '"')
+            if not against:
+                return []
+            match_columns = "`tus`.`{0}`".format(columns) if columns else "`tus`.`sourcetext`, `tus`.`targettext`"
+            select_tus = ("SELECT `tus`.* FROM `tus` "
+                          "WHERE MATCH(" + match_columns + ") AGAINST (" + self.placeholder + " IN BOOLEAN MODE)")
+            params.append(" ".join(against))
+            id_column = "`tus`.`tu_id`"
+        else:
+            #fts5: every term quoted as a phrase, so nothing in it is taken as query syntax
+            match = " ".join('"' + text.replace('"', '""') + '"' + (" *" if is_prefix else "") for text, is_prefix in terms)
+            select_tus = ("SELECT `tus`.* FROM `tus_fts` INNER JOIN `tus` ON `tus`.`tu_id` = `tus_fts`.rowid "
+                          "WHERE `tus_fts`" + (".`{0}`".format(columns) if columns else "") + " MATCH " + self.placeholder)
+            params.append(match)
+            id_column = "`tus_fts`.rowid" #lets fts5 skip straight to the page
+        if tm_ids is not None:
+            select_tus += " AND `tus`.`tm_id` IN (" + ", ".join([self.placeholder]*len(tm_ids)) + ")"
+            params.extend(int(x) for x in tm_ids)
+        if after_tu_id is not None:
+            select_tus += " AND " + id_column + " > " + self.placeholder
+            params.append(int(after_tu_id))
+        select_tus += " ORDER BY " + id_column + " LIMIT " + str(int(limit))
+        conn = self.get_connection()
+        cursor=conn.cursor()
+        cursor.execute(select_tus, tuple(params))
+        tus = [TranslationUnit(x[0], x[1], x[2], x[3], x[4], x[5], x[6], x[7], x[8]) for x in cursor.fetchall()]
+        cursor.close()
+        conn.close()
+        return tus
+
+    @metrics.db_query
     def get_tus(self, tm_id, tus=None):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -276,6 +708,38 @@ class TmData(object):
         conn.close()
         return tus
     
+    def iter_tus(self, tm_id, chunk_size=10000):
+        """Yields the TUs of a TM as row tuples, fetching chunk_size rows at a time
+           so the whole TM is never held in memory. With mysql the default cursor is unbuffered,
+           i.e. the rows stay on the server until fetched"""
+        chunks = self.iter_tu_chunks(tm_id, chunk_size)
+        try:
+            for rows in chunks:
+                yield from rows
+        finally:
+            chunks.close()
+    
+    @metrics.db_query
+    def iter_tu_chunks(self, tm_id, chunk_size=10000):
+        """Yields the TUs of a TM as lists of up to chunk_size row tuples...what iter_tus uses, so only
+           fetching the rows is timed, rather than what the caller does with them"""
+        conn = self.get_connection()
+        cursor=conn.cursor()
+        try:
+            select_tus = ("SELECT * FROM tus "
+                              "WHERE tm_id="+self.placeholder+
+                              " ORDER BY tu_id")
+            cursor.execute(select_tus, (tm_id,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+            conn.close()
+    
+    @metrics.db_query
     def get_tus_from_sourcetext(self, tm_id, sourcetext):
         conn = self.get_connection()
         cursor=conn.cursor()
@@ -300,6 +764,34 @@ class TmData(object):
             conn.close()
             return tus
     
+    @metrics.db_query
+    def get_tus_from_sourcetexts(self, tm_id, sourcetexts, connection=None, chunk_size=500):
+        """Bulk version of get_tus_from_sourcetext. Returns {sourcetext: list of tu objects with that sourcetext}
+           for the given sourcetexts, looked up chunk_size at a time (sqlite limits the number of placeholders)"""
+        close=False
+        if connection==None:
+            close=True
+            conn=self.get_connection()
+        else:
+            conn=connection
+        cursor=conn.cursor()
+        sourcetexts = list(set(sourcetexts))
+        tus={}
+        for i in range(0, len(sourcetexts), chunk_size):
+            chunk = sourcetexts[i:i+chunk_size]
+            select_tus = ("SELECT * FROM tus "
+                              "WHERE tm_id="+self.placeholder +
+                              " AND sourcetext IN (" + ", ".join([self.placeholder] * len(chunk)) + ")")
+            cursor.execute(select_tus, (tm_id,) + tuple(chunk))
+            for x in cursor.fetchall():
+                tu = TranslationUnit(x[0], x[1], x[2], x[3], x[4], x[5], x[6], x[7], x[8])
+                tus.setdefault(x[2], []).append(tu)
+        cursor.close()
+        if close:
+            conn.close()
+        return tus
+    
+    @metrics.db_query
     def add_tm(self, tm_name, orig_filename, sourcelang, targetlang, owner, 
                created_datetime=time.strftime("%Y-%m-%d %H:%M:%S"), last_updated_datetime=time.strftime("%Y-%m-%d %H:%M:%S")):
         conn = self.get_connection()
@@ -326,8 +818,10 @@ class TmData(object):
         conn.commit()
         cursor.close()
         conn.close()
+        permission_cache.invalidate(tm_id=tm_id) #in case anyone's lack of access to this id was cached before it existed
         return tm_id
 
+    @metrics.db_query
     def add_tu(self, tm_id, sourcetext, targettext, created_by, changed_by, created_date=time.strftime("%Y-%m-%d %H:%M:%S"),
                changed_date=time.strftime("%Y-%m-%d %H:%M:%S"), last_used_date=time.strftime("%Y-%m-%d %H:%M:%S"), connection=None):
         
@@ -354,6 +848,84 @@ class TmData(object):
             conn.close()
         return tu_id
     
+    @metrics.db_query
+    def add_tus(self, tus, connection=None):
+        """Inserts many TUs with a single executemany call.
+           tus is a list of tuples: (tm_id, sourcetext, targettext, created_by, created_date,
+           changed_by, changed_date, last_used_date)"""
+        commit_and_close=False
+        if connection==None:
+            commit_and_close=True
+            conn=self.get_connection()
+        else:
+            conn=connection
+        
+        cursor=conn.cursor()
+        values_string = "VALUES(" + (self.placeholder + ", " ) * 7 + self.placeholder + ")"
+        add_tus = ("INSERT INTO tus "
+                       "(tm_id, sourcetext, targettext, created_by, created_date, "
+                       "changed_by, changed_date, last_used_date) "
+                       + values_string)
+        cursor.executemany(add_tus, tus)
+        cursor.close()
+        if commit_and_close:
+            conn.commit()
+            conn.close()
+        return len(tus)
+
+    @metrics.db_query
+    def begin_bulk_import(self, tm_id, connection):
+        """Suspends the per-row tms.last_updated_datetime updates done by the tus triggers for
+           the given TM. The triggers skip any tm_id listed in bulk_imports"""
+        cursor=connection.cursor()
+        cursor.execute("INSERT INTO bulk_imports (tm_id) VALUES(" + self.placeholder + ")", (tm_id,))
+        cursor.close()
+        connection.commit()
+
+    @metrics.db_query
+    def end_bulk_import(self, tm_id, connection):
+        """Re-enables the tus triggers for the given TM and does the one
+           last_updated_datetime update that they skipped"""
+        cursor=connection.cursor()
+        cursor.execute("DELETE FROM bulk_imports WHERE tm_id=" + self.placeholder, (tm_id,))
+        cursor.execute("UPDATE tms SET last_updated_datetime=" + self.placeholder + 
+                       " WHERE tm_id=" + self.placeholder, (time.strftime("%Y-%m-%d %H:%M:%S"), tm_id))
+        cursor.close()
+        connection.commit()
+
+    @metrics.db_query
+    def copy_tus(self, from_tm_ids, to_tm_id, dedupe=False, connection=None):
+        """Copies all the TUs of the from_tm_ids TMs to the to_tm_id TM with a single INSERT ... SELECT,
+           so no TU data passes through python. With dedupe, only the first TU (lowest tu_id) 
+           of each sourcetext/targettext pair is copied. Returns the number of TUs copied"""
+        commit_and_close=False
+        if connection==None:
+            commit_and_close=True
+            conn=self.get_connection()
+        else:
+            conn=connection
+        cursor=conn.cursor()
+        in_string = "(" + ", ".join([self.placeholder] * len(from_tm_ids)) + ")"
+        copy_tus = ("INSERT INTO tus "
+                    "(tm_id, sourcetext, targettext, created_by, created_date, "
+                    "changed_by, changed_date, last_used_date) "
+                    "SELECT " + self.placeholder + ", tus.sourcetext, tus.targettext, tus.created_by, tus.created_date, "
+                    "tus.changed_by, tus.changed_date, tus.last_used_date FROM tus ")
+        if dedupe:
+            copy_tus += ("INNER JOIN (SELECT MIN(tu_id) AS keep_id FROM tus WHERE tm_id IN " + in_string + 
+                         " GROUP BY sourcetext, targettext) AS keep ON tus.tu_id = keep.keep_id ")
+        else:
+            copy_tus += "WHERE tus.tm_id IN " + in_string + " "
+        copy_tus += "ORDER BY tus.tu_id"
+        cursor.execute(copy_tus, (to_tm_id,) + tuple(from_tm_ids))
+        num_tus = cursor.rowcount
+        cursor.close()
+        if commit_and_close:
+            conn.commit()
+            conn.close()
+        return num_tus
+
+    @metrics.db_query
     def update_tu_by_id(self, tu_id, sourcetext, targettext, created_by, changed_by, 
                         created_date=time.time(), changed_date=time.time(), last_used_date=time.time()):
         conn = self.get_connection()
@@ -373,6 +945,20 @@ class TmData(object):
         cursor.close()
         conn.close()
 
+    @metrics.db_query
+    @short_write
+    def set_last_used_dates(self, used_dates):
+        """Batched update of tus.last_used_date. used_dates is an iterable of (tu_id, last_used_date)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        update_tus = ("UPDATE tus SET last_used_date=" + self.placeholder +
+                      " WHERE tu_id=" + self.placeholder)
+        cursor.executemany(update_tus, [(used_date, tu_id) for tu_id, used_date in used_dates])
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    @metrics.db_query
     def delete_tm_by_id(self, tm_id):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -382,7 +968,9 @@ class TmData(object):
         conn.commit()
         cursor.close()
         conn.close()
+        permission_cache.invalidate(tm_id=tm_id)
     
+    @metrics.db_query
     def delete_tu_by_tu_id(self, tu_id):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -393,6 +981,24 @@ class TmData(object):
         cursor.close()
         conn.close()
 
+    @metrics.db_query
+    def delete_tus_by_tu_ids(self, tu_ids, connection=None):
+        commit_and_close=False
+        if connection==None:
+            commit_and_close=True
+            conn=self.get_connection()
+        else:
+            conn=connection
+        cursor = conn.cursor()
+        delete_tus = ("DELETE FROM tus WHERE "
+                        "`tu_id` = "+self.placeholder)
+        cursor.executemany(delete_tus, [(tu_id,) for tu_id in tu_ids])
+        cursor.close()
+        if commit_and_close:
+            conn.commit()
+            conn.close()
+
+    @metrics.db_query
     def delete_tus_by_tm_id(self, tm_id):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -402,3 +1008,113 @@ class TmData(object):
         conn.commit()
         cursor.close()
         conn.close()
+
+    @metrics.db_query
+    def delete_partial_import(self, tm_id):
+        """Removes a TM whose import or copy didn't finish, with its TUs and its bulk_imports row, in one transaction"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM tus WHERE `tm_id` = " + self.placeholder, (tm_id,))
+        cursor.execute("DELETE FROM tms WHERE `tm_id` = " + self.placeholder, (tm_id,))
+        cursor.execute("DELETE FROM bulk_imports WHERE `tm_id` = " + self.placeholder, (tm_id,))
+        conn.commit()
+        cursor.close()
+        conn.close()
+        permission_cache.invalidate(tm_id=tm_id)
+
+    @metrics.db_query
+    def delete_unfinished_imports(self):
+        """Removes the TMs left partially imported (e.g. by a server restart mid-import), i.e. still in bulk_imports.
+           Returns their tm_ids"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT tm_id FROM bulk_imports")
+        tm_ids = [x[0] for x in cursor.fetchall()]
+        cursor.close()
+        conn.close()
+        for tm_id in tm_ids:
+            self.delete_partial_import(tm_id)
+        return tm_ids
+
+    @metrics.db_query
+    @short_write
+    def add_job(self, owner, job_type, description):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        values_string = "VALUES(" + (self.placeholder + ", " ) * 4 + self.placeholder + ")"
+        add_job = ("INSERT INTO jobs "
+                       "(owner, job_type, description, status, created_datetime) "
+                       + values_string)
+        cursor.execute(add_job, (owner, job_type, description, 'queued', time.strftime("%Y-%m-%d %H:%M:%S")))
+        job_id = cursor.lastrowid
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return job_id
+
+    @metrics.db_query
+    @short_write
+    def update_job(self, job_id, **values):
+        """Updates the given columns of a job, e.g. update_job(1, status='running', progress=10)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        columns = sorted(values.keys()) #keys come from our own code, never from request params
+        update_job = ("UPDATE jobs SET " +
+                      ", ".join("`{0}`={1}".format(column, self.placeholder) for column in columns) +
+                      " WHERE job_id=" + self.placeholder)
+        cursor.execute(update_job, tuple(values[column] for column in columns) + (job_id,))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    @metrics.db_query
+    def get_job(self, job_id):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        select_job = ("SELECT job_id, owner, job_type, description, status, progress, message, tm_id, "
+                      "created_datetime, started_datetime, finished_datetime FROM jobs "
+                      "WHERE job_id=" + self.placeholder)
+        cursor.execute(select_job, (job_id,))
+        result = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        if not result:
+            return None
+        return BackgroundJob(*result[0])
+
+    def get_job_owner(self, job_id):
+        job = self.get_job(job_id)
+        return job.owner if job else None
+
+    @metrics.db_query
+    def fail_unfinished_jobs(self, message):
+        """Marks any jobs left queued or running (e.g. by a server restart) as failed"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        update_jobs = ("UPDATE jobs SET status='failed', message=" + self.placeholder +
+                       ", finished_datetime=" + self.placeholder +
+                       " WHERE status IN ('queued', 'running')")
+        cursor.execute(update_jobs, (message, time.strftime("%Y-%m-%d %H:%M:%S")))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    #the server migrates the DB at startup (unless migrate_db is off in the app config); this does it on its own, e.g. beforehand
+    localDir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Brings a DB created by an older version of the sql scripts up to date")
+    parser.add_argument('--sqlite-db-path', default="{0}/sqlitedb".format(localDir))
+    parser.add_argument('--db-name', default='vstmserver')
+    parser.add_argument('--use-mysql', action='store_true')
+    parser.add_argument('--db-user', default='vstmserver')
+    parser.add_argument('--db-password', default='vstmserver1')
+    parser.add_argument('--db-host', default='127.0.0.1')
+    parser.add_argument('--sql-scripts-path', default="{0}/sql_scripts".format(localDir))
+    args = parser.parse_args()
+    migration = migrate_db({'db_user' : args.db_user, 'db_password' : args.db_password, 'db_host' : args.db_host, 
+                            'db_name' : args.db_name, 'sqlite_db_path' : args.sqlite_db_path, 'use_mysql' : args.use_mysql,
+                            'sql_scripts_path' : args.sql_scripts_path})
+    print(migration['result'])
+    for change in migration['changes']:
+        print("  " + change)
@@ -0,0 +1,186 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import os
+import sys
+import threading
+import time
+from itertools import islice
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when loading a TM would take the TUs in memory past the server's memory budget"""
+
+
+def shards_bytes(index):
+    """The dicts of a ShardedDict (empty shards are one shared dict until written to)"""
+    return sum(sys.getsizeof(shard) for shard in dict((id(shard), shard) for shard in index.shards).values())
+
+def text_index_bytes(index, tus):
+    """A text index (text: tuple of TUs): its dicts, measured, and its tuples, which take a fixed
+       size plus a pointer per TU, so they can be counted from the number of texts and TUs alone"""
+    pointer = sys.getsizeof((None,)) - sys.getsizeof(())
+    return shards_bytes(index) + len(index) * sys.getsizeof(()) + tus * pointer
+
+def measure_tu(tu):
+    """(string bytes, other bytes) of a TU: its str values, then the TU itself (a dict, with its 
+       values also set as attributes, in a __dict__) and its other values (e.g. the tu_id)"""
+    string_bytes = 0
+    other_bytes = sys.getsizeof(tu) + sys.getsizeof(tu.__dict__)
+    for value in dict.values(tu):
+        if isinstance(value, str):
+            string_bytes += sys.getsizeof(value)
+        elif value is not None:
+            other_bytes += sys.getsizeof(value)
+    return string_bytes, other_bytes
+
+def process_memory():
+    """The process's resident set size now (Linux only, otherwise None) and at its peak, in bytes"""
+    rss = peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == 'darwin' else peak * 1024 #bytes on macOS, KB elsewhere
+    except (ImportError, OSError):
+        pass
+    return {'rss_bytes' : rss, 'peak_rss_bytes' : peak}
+
+
+class MemoryAccountant(object):
+    """Accounts for the memory taken by the TMs loaded in sessions (i.e. by a TmProvider's snapshot), per TM:
+       its TUs' strings, the TUs themselves, and its share of the indexes over them, plus the scorer's prepared 
+       texts (a cache per index). TU and string bytes are measured with sys.getsizeof, over all of a TM's TUs or,
+       for one of more than sample_tus, over that many of them and scaled up (marked as estimated), as are
+       the scorer's lowercased copies of the texts. TUs are
+       never changed, only added and deleted, so a TM's figures are cached by its content key, and sessions
+       with the same TUs loaded share them. Index bytes are measured from the dicts, with the tuples of TUs
+       sharing a text counted from their number. Objects referenced from elsewhere too (e.g. interned strings)
+       are counted as if only the TM held them, so this is an upper bound of what unloading it would free.
+       budget is the soft limit, in bytes (0 for none), on the total over all sessions that check_budget enforces"""
+    
+    default_bytes_per_tu = 1500 #when there's nothing loaded to go by...about what the load_tm_to_memory benchmark measures
+    
+    def __init__(self, sample_tus=2000, budget=0, max_entries=10000):
+        self.sample_tus = sample_tus
+        self.budget = budget
+        self.max_entries = max_entries
+        self.tm_cache = {} #TmSnapshot.tm_content_key: (tus, string bytes, tu bytes, estimated)
+        self.lock = threading.Lock()
+    
+    def tm_usage(self, snapshot, tm_id):
+        """TU count and the string and TU bytes of one TM of the snapshot"""
+        key = snapshot.tm_content_key(tm_id)
+        if key is None:
+            return {'tus' : 0, 'string_bytes' : 0, 'tu_bytes' : 0, 'estimated' : False}
+        count = key[1][0]
+        cached = self.tm_cache.get(key)
+        if cached is None:
+            #a ShardedDict's values come shard by shard, i.e. by tu_id modulo the number of shards, so the first ones
+            #are spread over the whole TM, rather than being e.g. its oldest TUs
+            sample = list(islice(snapshot.tm_index[tm_id].values(), self.sample_tus))
+            string_bytes = tu_bytes = 0
+            for tu in sample:
+                sizes = measure_tu(tu)
+                string_bytes += sizes[0]
+                tu_bytes += sizes[1]
+            scale = count / len(sample) if sample else 0
+            cached = (count, int(string_bytes * scale), int(tu_bytes * scale), len(sample) < count)
+            with self.lock:
+                if len(self.tm_cache) >= self.max_entries:
+                    self.tm_cache.clear()
+                self.tm_cache[key] = cached
+        return {'tus' : cached[0], 'string_bytes' : cached[1], 'tu_bytes' : cached[2], 'estimated' : cached[3]}
+    
+    def snapshot_usage(self, snapshot, scorer=None):
+        """Memory taken by a snapshot's TMs (tm_id: usage, with the shared indexes split between the TMs 
+           by their number of TUs) and the totals, including the scorer's prepared texts for the snapshot's indexes"""
+        tus = len(snapshot.tu_index)
+        shared_index_bytes = text_index_bytes(snapshot.data, tus) + shards_bytes(snapshot.tu_index)
+        if snapshot.target_data is not None:
+            shared_index_bytes += text_index_bytes(snapshot.target_data, tus)
+        tms = {}
+        for tm_id in snapshot.tms:
+            usage = self.tm_usage(snapshot, tm_id)
+            own_index = snapshot.tm_index.get(tm_id)
+            usage['index_bytes'] = ((shards_bytes(own_index) if own_index is not None else 0) + 
+                                    (shared_index_bytes * usage['tus'] // tus if tus else 0))
+            usage['total_bytes'] = usage['string_bytes'] + usage['tu_bytes'] + usage['index_bytes']
+            tms[tm_id] = usage
+        cache_bytes = 0
+        if scorer is not None:
+            cache_bytes = scorer.prepared_bytes(snapshot.data, self.sample_tus)
+            if snapshot.target_data is not None:
+                cache_bytes += scorer.prepared_bytes(snapshot.target_data, self.sample_tus)
+        usage = {'tms' : tms, 'tus' : tus, 'cache_bytes' : cache_bytes, 'estimated' : any(x['estimated'] for x in tms.values())}
+        for kind in ('string_bytes', 'tu_bytes', 'index_bytes'):
+            usage[kind] = sum(x[kind] for x in tms.values())
+        usage['total_bytes'] = usage['string_bytes'] + usage['tu_bytes'] + usage['index_bytes'] + cache_bytes
+        return usage
+    
+    def summary(self, sessions, scorer=None):
+        """Memory taken across sessions, given as (refreshed time, username, tm_provider): each session's usage, 
+           largest first, the usage per TM summed over the sessions that have it loaded, the totals, the budget
+           and the process's resident set size"""
+        by_session = []
+        by_tm = {}
+        for refreshed, username, provider in sessions:
+            if provider is None:
+                continue
+            usage = self.snapshot_usage(provider.snapshot, scorer)
+            for tm_id, tm_usage in usage['tms'].items():
+                total = by_tm.setdefault(tm_id, {'sessions' : 0, 'tus' : 0, 'total_bytes' : 0})
+                total['sessions'] += 1
+                total['tus'] += tm_usage['tus']
+                total['total_bytes'] += tm_usage['total_bytes']
+            usage['username'] = username
+            usage['refreshed_datetime'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(refreshed))
+            by_session.append(usage)
+        by_session.sort(key=lambda usage: usage['total_bytes'], reverse=True)
+        totals = dict((kind, sum(x[kind] for x in by_session)) for kind in ('tus', 'string_bytes', 'tu_bytes', 'index_bytes', 
+                                                                           'cache_bytes', 'total_bytes'))
+        return {'sessions' : by_session, 'tms' : by_tm, 'totals' : totals, 'budget_bytes' : self.budget, 
+                'process' : process_memory()}
+    
+    def check_budget(self, sessions, scorer, tm_id, tus):
+        """Raises MemoryBudgetExceeded if loading tus TUs of tm_id would take the total over the sessions past
+           the budget. The TM's size is estimated from its bytes per TU where it is already loaded, or else
+           from the average of what is loaded. It's a soft limit: concurrent loads are each checked against
+           the total before either, and TUs added to loaded TMs aren't checked"""
+        if not self.budget:
+            return
+        summary = self.summary(sessions, scorer)
+        loaded = summary['tms'].get(tm_id)
+        if loaded and loaded['tus']:
+            bytes_per_tu = loaded['total_bytes'] / loaded['tus']
+        elif summary['totals']['tus']:
+            bytes_per_tu = summary['totals']['total_bytes'] / summary['totals']['tus']
+        else:
+            bytes_per_tu = self.default_bytes_per_tu
+        needed = int(tus * bytes_per_tu)
+        if summary['totals']['total_bytes'] + needed > self.budget:
+            raise MemoryBudgetExceeded("loading the TM ({0} TUs, about {1:.1f} MB) would exceed the server's memory budget "
+                                       "({2:.1f} of {3:.1f} MB in use)".format(tus, needed / 1e6, summary['totals']['total_bytes'] / 1e6, 
+                                                                              self.budget / 1e6))
+    
+    def totals_by_kind(self, sessions, scorer=None):
+        """kind: bytes, over all sessions, for the metrics"""
+        totals = self.summary(sessions, scorer)['totals']
+        return dict(((kind[:-len('_bytes')],), totals[kind]) for kind in ('string_bytes', 'tu_bytes', 'index_bytes', 'cache_bytes'))
+
+memory_accountant = MemoryAccountant()
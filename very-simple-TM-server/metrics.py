@@ -0,0 +1,209 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+#seconds...from a cached search (~1ms) up to a large import
+default_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, escape_label(value)) for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """A named metric, with one value per combination of label values. Label values are passed
+       positionally, in the order of labelnames"""
+    
+    type = None
+    
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {} #label values: value
+        self.lock = threading.Lock()
+    
+    def samples(self):
+        """Returns [(name suffix, label values, extra (name, value) labels, value)]"""
+        with self.lock:
+            return [('', labels, (), value) for labels, value in sorted(self.values.items())]
+    
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.type)]
+        for suffix, labels, extra, value in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(self.name, suffix, format_labels(self.labelnames, labels, extra), format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    
+    type = 'counter'
+    
+    def __init__(self, name, help, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        if not self.labelnames:
+            self.values[()] = 0 #exported from the start, so rates work from the first increment
+    
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    
+    type = 'gauge'
+    
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+class CallbackGauge(Metric):
+    """A gauge read when the metrics are collected, so it costs nothing in between.
+       func returns the value or, if there are labels, a dict of label values: value"""
+    
+    type = 'gauge'
+    
+    def __init__(self, name, help, func, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.func = func
+    
+    def samples(self):
+        values = self.func()
+        if not self.labelnames:
+            values = {() : values}
+        return [('', labels, (), value) for labels, value in sorted(values.items())]
+
+class CallbackCounter(CallbackGauge):
+    """Like CallbackGauge, for a total kept elsewhere that only goes up"""
+    
+    type = 'counter'
+
+class Histogram(Metric):
+    """Counts observations per bucket, plus their sum, for latency percentiles"""
+    
+    type = 'histogram'
+    
+    def __init__(self, name, help, labelnames=(), buckets=default_buckets):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0]*(len(self.buckets) + 1) + [0.0] #per bucket (last is +Inf), then the sum
+            counts[i] += 1
+            counts[-1] += value
+    
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in sorted(self.values.items())]
+        samples = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', labels, (('le', format_value(float(bound))),), cumulative))
+            samples.append(('_sum', labels, (), counts[-1]))
+            samples.append(('_count', labels, (), cumulative))
+        return samples
+
+
+class Registry(object):
+    """The metrics of the process, rendered in the Prometheus text format"""
+    
+    def __init__(self):
+        self.metrics = {} #name: metric
+        self.lock = threading.Lock()
+    
+    def register(self, metric):
+        """Adds metric, replacing any registered under the same name, and returns it"""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+    
+    def render(self):
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+registry = Registry()
+
+http_request_seconds = registry.register(Histogram('vstm_http_request_duration_seconds', 
+    'Time to handle HTTP requests, by endpoint and status code', ('endpoint', 'code')))
+search_phase_seconds = registry.register(Histogram('vstm_search_phase_duration_seconds', 
+    'Time spent in each phase of searches: queue (waiting for a slot), prepare, score, postprocess', ('phase',)))
+search_candidates = registry.register(Counter('vstm_search_candidates_total', 
+    'Indexed texts considered by searches: scanned (all of them), pruned (skipped without computing a distance), '
+    'rescored (whose exact score was computed) and matched', ('outcome',)))
+import_rows = registry.register(Counter('vstm_import_rows_total', 'TUs imported from TMX files'))
+import_seconds = registry.register(Counter('vstm_import_duration_seconds_total', 'Time spent importing TMX files'))
+import_rows_per_second = registry.register(Gauge('vstm_import_last_rows_per_second', 'TUs per second of the last finished TMX import'))
+db_query_seconds = registry.register(Histogram('vstm_db_query_duration_seconds', 
+    'Time taken by DB operations, by TmData method', ('query',)))
+db_query_errors = registry.register(Counter('vstm_db_query_errors_total', 'DB operations that raised, by TmData method', ('query',)))
+
+def db_query(f):
+    """Decorator for TmData methods: counts and times their calls in db_query_seconds (and errors in db_query_errors).
+       For generators, only the time spent producing items is summed, not the caller's time in between 
+       (e.g. sending an export to the client), and observed once they are exhausted or closed. That takes 
+       two clock reads per item, so a generator of rows should yield them a chunk at a time (see TmData.iter_tu_chunks)"""
+    name = f.__name__
+    if inspect.isgeneratorfunction(f):
+        @functools.wraps(f)
+        def timed_generator(*args, **kwargs):
+            elapsed = 0.0
+            gen = f(*args, **kwargs)
+            try:
+                while True:
+                    start = time.time()
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.time() - start
+                    yield item
+            except Exception:
+                db_query_errors.inc(1, name)
+                raise
+            finally:
+                gen.close()
+                db_query_seconds.observe(elapsed, name)
+        return timed_generator
+    @functools.wraps(f)
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            db_query_errors.inc(1, name)
+            raise
+        finally:
+            db_query_seconds.observe(time.time() - start, name)
+    return timed
@@ -0,0 +1,133 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import collections
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+
+
+class RequestProfiler(object):
+    """Profiles requests with cProfile when an admin asks for it: the next count requests, or only 
+       those to a given endpoint and/or by a given user. Background jobs (e.g. TMX imports) are matched
+       by their job type, which is the name of the endpoint that queued them. The last max_profiles
+       profiles are kept as pstats files in path. One request is profiled at a time (cProfile can't 
+       run more than one profiler at once on all Python versions); others just run normally.
+       When nothing is asked for, the only cost is checking the armed flag"""
+    
+    def __init__(self, path=None, max_profiles=20):
+        self.path = path
+        self.max_profiles = max_profiles
+        self.armed = False
+        self.remaining = 0
+        self.endpoint = None
+        self.username = None
+        self.active = False
+        self.profiles = collections.OrderedDict() #profile_id: info, oldest first
+        self.next_id = 1
+        self.lock = threading.Lock()
+    
+    def arm(self, count, endpoint=None, username=None):
+        """Profiles the next count matching requests, replacing any earlier request...0 stops profiling"""
+        with self.lock:
+            self.remaining = count
+            self.endpoint = endpoint or None
+            self.username = username or None
+            self.armed = count > 0
+        return self.status()
+    
+    def status(self):
+        return {'armed' : self.armed, 'remaining' : self.remaining, 'endpoint' : self.endpoint, 'username' : self.username}
+    
+    def start(self, endpoint, username):
+        """Starts profiling the calling thread if it is armed and endpoint and username match. 
+           Returns (profile, info) to pass to finish, or None if not profiling"""
+        with self.lock:
+            if not self.armed or self.active:
+                return None
+            if (self.endpoint and endpoint != self.endpoint) or (self.username and username != self.username):
+                return None
+            self.remaining -= 1
+            self.armed = self.remaining > 0
+            self.active = True
+            info = {'profile_id' : self.next_id, 'endpoint' : endpoint, 'username' : username, 
+                    'started_datetime' : time.strftime("%Y-%m-%d %H:%M:%S"), 'started' : time.time()}
+            self.next_id += 1
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError: #another profiler (e.g. a debugger) is already running
+            with self.lock:
+                self.active = False
+            return None
+        return profile, info
+    
+    def finish(self, profile, info):
+        """Stops the profile started by start and saves it"""
+        profile.disable()
+        info['seconds'] = time.time() - info.pop('started')
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            profile.dump_stats(self.filename(info['profile_id']))
+        finally:
+            with self.lock:
+                self.active = False
+                self.profiles[info['profile_id']] = info
+                while len(self.profiles) > self.max_profiles:
+                    profile_id, old = self.profiles.popitem(last=False)
+                    try:
+                        os.remove(self.filename(profile_id))
+                    except OSError:
+                        pass
+    
+    def run(self, endpoint, username, func, *args, **kwargs):
+        """Calls func, profiling it if it matches"""
+        if not self.armed:
+            return func(*args, **kwargs)
+        started = self.start(endpoint, username)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if started is not None:
+                self.finish(*started)
+    
+    def filename(self, profile_id):
+        return os.path.join(self.path, "{0}.pstats".format(int(profile_id)))
+    
+    def list_profiles(self):
+        with self.lock:
+            return [dict(info) for info in reversed(self.profiles.values())]
+    
+    def get_profile(self, profile_id):
+        """Returns (info, pstats file path) or (None, None) if there is no such profile (any more)"""
+        with self.lock:
+            info = self.profiles.get(profile_id)
+        if info is None or not os.path.exists(self.filename(profile_id)):
+            return None, None
+        return dict(info), self.filename(profile_id)
+    
+    def report(self, profile_id, sort='cumulative', limit=50):
+        """Returns the profile as text: the limit functions that took the most time, by sort"""
+        info, filename = self.get_profile(profile_id)
+        if info is None:
+            return None
+        out = io.StringIO()
+        stats = pstats.Stats(filename, stream=out)
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+request_profiler = RequestProfiler()
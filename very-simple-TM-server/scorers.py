@@ -0,0 +1,309 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import logging
+import random
+import collections
+import sys
+import threading
+import time
+import weakref
+from itertools import chain, islice
+import metrics
+try:
+    import Levenshtein
+except ImportError:
+    Levenshtein = None
+try:
+    from rapidfuzz import process as rapidfuzz_process
+    from rapidfuzz.distance import Levenshtein as rapidfuzz_levenshtein
+except ImportError:
+    rapidfuzz_process = None
+
+
+def case_weighted_ratio(searchstring, comparestring, d1, d2, casecost):
+    """The match score of two (stripped) strings, given their Levenshtein distance d1 and the distance d2 
+       of their lowercased versions. The difference between the two is the number of replacements that are
+       merely a change of case, which cost casecost instead of 1. A casecost of less than 1 warps results 
+       in favor of strings differing only by case. Every scorer has to use this, so they all score the same"""
+    sumlen = len(searchstring) + len(comparestring)
+    diff = d1-d2
+    dresult = d2 + (diff*casecost)
+    return (sumlen-dresult) / sumlen
+
+def python_distance(s1, s2):
+    """Character-based Levenshtein distance, in pure python"""
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    previous = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1):
+        current = [i + 1]
+        for j, c2 in enumerate(s2):
+            current.append(min(previous[j + 1] + 1, current[j] + 1, previous[j] + (c1 != c2)))
+        previous = current
+    return previous[-1]
+
+
+class PreparedTexts(object):
+    """An index's texts as prepared by a scorer, and the bytes they take (measured when first asked for)"""
+    
+    __slots__ = ('texts', 'size', '__weakref__')
+    
+    def __init__(self, texts):
+        self.texts = texts
+        self.size = None
+
+
+class Scorer(object):
+    """Scores a search text against the texts of an index (e.g. the source texts of the loaded TMs),
+       returning the (text, score) pairs with a score of at least minscore. 
+       Subclasses are the different Levenshtein backends.
+       Prepared texts are cached per index, and also by the key of the index's content (see get_prepared):
+       a session stored in files is unpickled with new index objects, which would otherwise be prepared again.
+       The keep_recent most recently used are kept for keep_seconds even once no index holds them, 
+       so a session unpickled again soon after finds them. Those aren't counted by prepared_bytes"""
+    
+    name = None
+    batched = False #scores many texts per native call, so it gains nothing from a process pool
+    record_metrics = True #off for the startup benchmark, which isn't a search
+    keep_recent = 4
+    keep_seconds = 300
+    
+    def __init__(self):
+        self.prepared = weakref.WeakKeyDictionary() #index: PreparedTexts...indexes are never changed, so this stays valid
+        self.prepared_by_key = weakref.WeakValueDictionary() #content key: PreparedTexts, while an index (or recent) holds them
+        self.recent = collections.OrderedDict() #content key: (PreparedTexts, last used time), least recently used first
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def available(cls):
+        return True
+    
+    def get_prepared(self, index, key=None):
+        """The index's texts, prepared for scoring once per index rather than once per search.
+           key, if given, identifies the index's content (e.g. the snapshot's content key and which texts it indexes),
+           so an index with the same content, such as the same snapshot unpickled again, gets the same prepared texts"""
+        with self.lock:
+            prepared = self.prepared.get(index)
+            if prepared is None and key is not None:
+                prepared = self.prepared_by_key.get(key)
+                if prepared is not None:
+                    self.prepared[index] = prepared
+        if prepared is None:
+            prepared = PreparedTexts(self.prepare(index.keys())) #outside the lock, it can take a while
+            with self.lock:
+                self.prepared[index] = prepared
+                if key is not None:
+                    self.prepared_by_key[key] = prepared
+        if key is not None:
+            self.keep(key, prepared)
+        return prepared.texts
+    
+    def keep(self, key, prepared):
+        """Holds on to recently used prepared texts, dropping the ones past keep_recent or keep_seconds"""
+        now = time.time()
+        with self.lock:
+            self.recent.pop(key, None)
+            self.recent[key] = (prepared, now)
+            while self.recent and (len(self.recent) > self.keep_recent or next(iter(self.recent.values()))[1] < now - self.keep_seconds):
+                self.recent.popitem(last=False)
+    
+    def prepare(self, texts):
+        return list(texts)
+    
+    def prepared_bytes(self, index, sample=2000):
+        """Memory taken by the index's prepared texts beyond the index itself, or 0 if not prepared yet.
+           Texts made for it are measured, or estimated from sample of them if there are more"""
+        prepared = self.prepared.get(index)
+        if prepared is None:
+            return 0
+        if prepared.size is None:
+            prepared.size = self.measure_prepared(prepared.texts, sample)
+        return prepared.size
+    
+    def measure_prepared(self, prepared, sample):
+        return sys.getsizeof(prepared) #the texts are the index's own
+    
+    def chunks(self, prepared, n):
+        """Splits prepared texts for scoring in n processes"""
+        size = max(1, len(prepared) // n + 1)
+        return [prepared[i:i+size] for i in range(0, len(prepared), size)]
+    
+    def score(self, searchtext, minscore, casecost, prepared):
+        searchstring = str.strip(searchtext) #don't want to leave spaces and returns at ends
+        lowered = str.lower(searchstring)
+        results = []
+        for text in prepared:
+            comparestring = str.strip(text)
+            if not searchstring and not comparestring:
+                continue
+            d1 = self.distance(searchstring, comparestring)
+            d2 = self.distance(lowered, str.lower(comparestring))
+            ratio = case_weighted_ratio(searchstring, comparestring, d1, d2, casecost)
+            if ratio >= minscore:
+                results.append((text, ratio))
+        return results
+    
+    def __getstate__(self):
+        #sent to pool processes without the prepared indexes
+        return {}
+    
+    def __setstate__(self, state):
+        self.__init__()
+
+
+class LevenshteinScorer(Scorer):
+    """python-Levenshtein, one pair of strings per call"""
+    
+    name = 'levenshtein'
+    
+    @classmethod
+    def available(cls):
+        return Levenshtein is not None
+    
+    def distance(self, s1, s2):
+        return Levenshtein.distance(s1, s2)
+
+
+class PythonScorer(Scorer):
+    """Pure python...slow, but needs nothing installed and serves as the reference"""
+    
+    name = 'python'
+    
+    def distance(self, s1, s2):
+        return python_distance(s1, s2)
+
+
+class RapidFuzzScorer(Scorer):
+    """RapidFuzz, scoring the search text against a whole group of texts in one native call.
+       The texts are grouped by length, so each call can be given the largest lowercased distance
+       that could still reach minscore and skip everything else natively. Only those that could
+       are then scored exactly"""
+    
+    name = 'rapidfuzz'
+    batched = True
+    
+    @classmethod
+    def available(cls):
+        return rapidfuzz_process is not None
+    
+    def distance(self, s1, s2):
+        return rapidfuzz_levenshtein.distance(s1, s2)
+    
+    def prepare(self, texts):
+        """Returns ({stripped length: ([texts], [stripped lowercased texts])}, [texts lowercasing changes the length of])"""
+        by_length = {}
+        unaligned = []
+        for text in texts:
+            stripped = str.strip(text)
+            lowered = str.lower(stripped)
+            if len(lowered) != len(stripped):
+                unaligned.append(text)
+                continue
+            group = by_length.get(len(stripped))
+            if group is None:
+                group = by_length[len(stripped)] = ([], [])
+            group[0].append(text)
+            group[1].append(lowered)
+        return by_length, unaligned
+    
+    def measure_prepared(self, prepared, sample):
+        """The lists and the lowercased texts, which are copies (the texts are the index's own)"""
+        by_length, unaligned = prepared
+        size = sys.getsizeof(by_length) + sys.getsizeof(unaligned)
+        count = 0
+        for group in by_length.values():
+            size += sys.getsizeof(group) + sys.getsizeof(group[0]) + sys.getsizeof(group[1])
+            count += len(group[1])
+        #every step-th lowercased text, so the sample is spread over all the lengths
+        step = max(1, count // sample) if sample else 1
+        sampled = list(islice(chain.from_iterable(group[1] for group in by_length.values()), 0, None, step))
+        if sampled:
+            size += sum(sys.getsizeof(text) for text in sampled) * count // len(sampled)
+        return size
+    
+    def score(self, searchtext, minscore, casecost, prepared):
+        by_length, unaligned = prepared
+        searchstring = str.strip(searchtext)
+        lowered = str.lower(searchstring)
+        if casecost < 0 or len(lowered) != len(searchstring):
+            #the lowercased distance is only a lower bound of the score's distance with these
+            return Scorer.score(self, searchtext, minscore, casecost, [t for group in by_length.values() for t in group[0]] + unaligned)
+        results = Scorer.score(self, searchtext, minscore, casecost, unaligned)
+        pruned = 0
+        rescored = len(unaligned)
+        for length, (texts, lowered_texts) in by_length.items():
+            sumlen = len(searchstring) + length
+            if sumlen == 0:
+                continue
+            #the score's distance is at least the lowercased one, so anything further than this can't reach minscore
+            #(one more than the exact bound, against float rounding...the exact score is checked below anyway)
+            cutoff = int((1 - minscore) * sumlen) + 1
+            if abs(len(searchstring) - length) > cutoff:
+                pruned += len(texts)
+                continue
+            for lowered_text, d2, i in rapidfuzz_process.extract_iter(lowered, lowered_texts, scorer=rapidfuzz_levenshtein.distance, 
+                                                                     score_cutoff=cutoff):
+                comparestring = str.strip(texts[i])
+                d1 = rapidfuzz_levenshtein.distance(searchstring, comparestring)
+                rescored += 1
+                ratio = case_weighted_ratio(searchstring, comparestring, d1, d2, casecost)
+                if ratio >= minscore:
+                    results.append((texts[i], ratio))
+        if self.record_metrics:
+            metrics.search_candidates.inc(pruned, 'pruned')
+            metrics.search_candidates.inc(rescored, 'rescored')
+        return results
+    
+    def chunks(self, prepared, n):
+        return [prepared]
+
+
+scorers = {x.name : x for x in (RapidFuzzScorer, LevenshteinScorer, PythonScorer)}
+
+def benchmark_texts(n, seed=1):
+    r = random.Random(seed)
+    words = ['the', 'Translation', 'memory', 'server', 'Search', 'text', 'of', 'a', 'segment', 'Fuzzy', 'match', 'case']
+    return [" ".join(r.choice(words) for _ in range(r.randint(2, 14))) for _ in range(n)]
+
+def select_scorer(name='auto'):
+    """Returns the scorer backend called name or, for 'auto', the fastest available one, as found by
+       timing each on a sample of texts. A backend that doesn't score the sample exactly like the 
+       pure python reference is never picked"""
+    if name != 'auto':
+        if name not in scorers or not scorers[name].available():
+            raise ValueError("scorer '{0}' is not available".format(name))
+        return scorers[name]()
+    searchtext = "Fuzzy match of the Translation memory segment text"
+    sample = benchmark_texts(300)
+    reference = sorted(PythonScorer().score(searchtext, .5, .2, sample))
+    candidates = [x() for x in scorers.values() if x.available() and x is not PythonScorer]
+    timings = {}
+    texts = benchmark_texts(5000, seed=2)
+    for scorer in candidates:
+        scorer.record_metrics = False
+        if sorted(scorer.score(searchtext, .5, .2, scorer.prepare(sample))) != reference:
+            logging.warning("scorer '{0}' doesn't match the reference scores; not used".format(scorer.name))
+            continue
+        prepared = scorer.prepare(texts)
+        starttime = time.time()
+        for minscore in (.5, .75, .9):
+            scorer.score(searchtext, minscore, .2, prepared)
+        timings[scorer.name] = time.time() - starttime
+    if not timings:
+        logging.info("using the pure python scorer")
+        return PythonScorer()
+    name = min(timings, key=timings.get)
+    logging.info("scorer timings: {0}; using '{1}'".format(timings, name))
+    return scorers[name]()
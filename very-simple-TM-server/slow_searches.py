@@ -0,0 +1,161 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+#searches slower than a threshold are logged as JSON lines with what is needed to re-run them;
+#run this module to replay such a log against the same TMs, loaded from the DB into a local TmProvider:
+#    python slow_searches.py slow_searches.jsonl --sqlite-db-path sqlitedb --db-name vstmserver
+
+import argparse
+import collections
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+
+localDir = os.path.dirname(os.path.abspath(__file__))
+
+
+class SlowSearchLog(object):
+    """Appends a JSON line to path for each search that took at least threshold seconds: 
+       its params, the loaded TMs (with the fingerprint of the TUs loaded from each, to tell whether 
+       a replay searches the same TUs), the candidate counts, and the time of each phase"""
+    
+    def __init__(self, path, threshold=2.0):
+        self.path = path
+        self.threshold = threshold
+        self.lock = threading.Lock()
+    
+    def record(self, snapshot, search, phases, candidates):
+        """search is a dict of the search params, phases one of phase: seconds"""
+        seconds = sum(phases.values())
+        if seconds < self.threshold:
+            return
+        entry = dict(search)
+        entry.update({'datetime' : time.strftime("%Y-%m-%d %H:%M:%S"), 'seconds' : seconds, 'phases' : phases,
+                      'candidates' : candidates, 
+                      'tms' : [{'tm_id' : tm_id, 'name' : tm.name, 'last_updated_datetime' : str(tm.last_updated_datetime),
+                                'tus' : snapshot.tm_fingerprints.get(tm_id, (0, 0))[0],
+                                'fingerprint' : list(snapshot.tm_fingerprints.get(tm_id, (0, 0)))}
+                               for tm_id, tm in sorted(snapshot.tms.items())]})
+        self.write(entry)
+    
+    def write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+
+class ReplayCapture(SlowSearchLog):
+    """Keeps the record of the last search instead of writing it, for its phase timings"""
+    
+    def __init__(self):
+        SlowSearchLog.__init__(self, None, 0)
+        self.last = None
+    
+    def write(self, entry):
+        self.last = entry
+
+
+def read_log(path, limit=0):
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if str.strip(line):
+                records.append(json.loads(line))
+                if limit and len(records) >= limit:
+                    break
+    return records
+
+def replay(records, config, repeat=3):
+    """Re-runs the logged searches, grouped by the TMs they searched, which are loaded from the DB 
+       into a local TmProvider once per group. Each search is run repeat times; the median is reported.
+       Returns a list of dicts, one per record"""
+    from TmProvider import TmProvider #not needed just to write the log
+    capture = ReplayCapture()
+    TmProvider.slow_search_log = capture
+    groups = collections.OrderedDict()
+    for record in records:
+        groups.setdefault(tuple(tm['tm_id'] for tm in record['tms']), []).append(record)
+    results = []
+    for tm_ids, group in groups.items():
+        provider = TmProvider(config)
+        for tm_id in tm_ids:
+            status = provider.load_tm_to_memory(tm_id)['status']
+            if status != 'success':
+                logging.warning("couldn't load TM {0}: {1}".format(tm_id, status))
+        fingerprints = provider.snapshot.tm_fingerprints
+        for record in group:
+            #the TMs may have changed since the search was logged...then the timings aren't quite comparable
+            same_tus = all(list(fingerprints.get(tm['tm_id'], (0, 0))) == tm['fingerprint'] for tm in record['tms'])
+            direction = record.get('direction', 'source')
+            if direction == 'target' and provider.snapshot.target_data is None:
+                logging.warning("skipping a target text search...set target_index to replay it")
+                continue
+            runs = []
+            for i in range(repeat):
+                provider.search_snapshot(provider.snapshot, record['searchtext'], record['threshold'], record['maxresults'],
+                                         record['casecost'], direction)
+                runs.append(capture.last)
+            median = statistics.median(run['seconds'] for run in runs)
+            results.append({'searchtext' : record['searchtext'], 'tm_ids' : list(tm_ids), 'same_tus' : same_tus,
+                            'recorded_seconds' : record['seconds'], 'replay_seconds' : median,
+                            'recorded_phases' : record['phases'], 
+                            'replay_phases' : dict((phase, statistics.median(run['phases'][phase] for run in runs)) for phase in runs[0]['phases']),
+                            'recorded_candidates' : record['candidates'], 'replay_candidates' : runs[-1]['candidates']})
+    return results
+
+def print_report(results):
+    for result in results:
+        change = result['replay_seconds'] / result['recorded_seconds'] - 1 if result['recorded_seconds'] else 0
+        print("{0:8.3f}s -> {1:8.3f}s {2:+6.0%}{3} {4}".format(result['recorded_seconds'], result['replay_seconds'], change, 
+                                                           '' if result['same_tus'] else ' (TMs changed)', 
+                                                           result['searchtext'][:60].replace("\n", " ")))
+    if results:
+        recorded = sum(result['recorded_seconds'] for result in results)
+        replayed = sum(result['replay_seconds'] for result in results)
+        print("{0} searches: {1:.3f}s recorded, {2:.3f}s replayed; median speedup {3:.2f}x".format(
+            len(results), recorded, replayed, 
+            statistics.median(result['recorded_seconds'] / result['replay_seconds'] for result in results if result['replay_seconds'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replays a slow search log against the same TMs, loaded from the DB")
+    parser.add_argument('log', help="the slow search log (JSON lines)")
+    parser.add_argument('--sqlite-db-path', default="{0}/sqlitedb".format(localDir))
+    parser.add_argument('--db-name', default='vstmserver')
+    parser.add_argument('--use-mysql', action='store_true')
+    parser.add_argument('--db-user', default='vstmserver')
+    parser.add_argument('--db-password', default='vstmserver1')
+    parser.add_argument('--db-host', default='127.0.0.1')
+    parser.add_argument('--numcores', type=int, default=4)
+    parser.add_argument('--scorer', default='auto', help="the Levenshtein backend (see scorers.py)")
+    parser.add_argument('--target-index', action='store_true', help="also index the target text, to replay target text searches")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each search; the median is reported")
+    parser.add_argument('--limit', type=int, default=0, help="replay only the first this many searches")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    import scorers
+    from TmProvider import TmProvider
+    TmProvider.scorer = scorers.select_scorer(args.scorer)
+    config = {'db_user' : args.db_user, 'db_password' : args.db_password, 'db_host' : args.db_host, 'db_name' : args.db_name,
+              'sqlite_db_path' : args.sqlite_db_path, 'use_mysql' : args.use_mysql, 'numcores' : args.numcores, 
+              'target_index' : args.target_index}
+    results = replay(read_log(args.log, args.limit), config, args.repeat)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
@@ -0,0 +1,210 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+from itertools import chain
+import hashlib
+
+class ShardedDict(object):
+    """A dict that is never changed once built, split into shards by key hash.
+       update returns a new ShardedDict that shares every shard it doesn't touch with this one,
+       so changing a few keys of a large dict only copies the shards those keys are in"""
+    
+    num_shards = 256
+    
+    def __init__(self, shards=None, length=0):
+        self.shards = shards if shards is not None else ({},)*self.num_shards
+        self.length = length
+    
+    def get(self, key, default=None):
+        return self.shards[hash(key) % self.num_shards].get(key, default)
+    
+    def __getitem__(self, key):
+        return self.shards[hash(key) % self.num_shards][key]
+    
+    def __contains__(self, key):
+        return key in self.shards[hash(key) % self.num_shards]
+    
+    def __len__(self):
+        return self.length
+    
+    def __iter__(self):
+        return chain.from_iterable(self.shards)
+    
+    def keys(self):
+        return iter(self)
+    
+    def values(self):
+        return chain.from_iterable(shard.values() for shard in self.shards)
+    
+    def items(self):
+        return chain.from_iterable(shard.items() for shard in self.shards)
+    
+    def update(self, items=(), removed=()):
+        """Returns a new ShardedDict with the keys in removed dropped, then the (key, value) pairs in items set"""
+        shards = list(self.shards)
+        copied = set()
+        length = self.length
+        for key in removed:
+            i = hash(key) % self.num_shards
+            if key in shards[i]:
+                if i not in copied:
+                    shards[i] = dict(shards[i])
+                    copied.add(i)
+                del shards[i][key]
+                length -= 1
+        for key, value in items:
+            i = hash(key) % self.num_shards
+            if i not in copied:
+                shards[i] = dict(shards[i])
+                copied.add(i)
+            if key not in shards[i]:
+                length += 1
+            shards[i][key] = value
+        return ShardedDict(tuple(shards), length)
+    
+    def __getstate__(self):
+        #string hashes differ between processes, so the shards are rebuilt when unpickled (e.g. from a session file)
+        return list(self.items())
+    
+    def __setstate__(self, items):
+        rebuilt = ShardedDict().update(items)
+        self.shards = rebuilt.shards
+        self.length = rebuilt.length
+
+
+def add_to_text_index(index, field, tus):
+    """Returns the index (a ShardedDict of text: tuple of TUs) with the TUs added under their text in field"""
+    by_text = {}
+    for tu in tus:
+        by_text.setdefault(tu[field], []).append(tu)
+    return index.update((text, index.get(text, ()) + tuple(entries)) for text, entries in by_text.items())
+
+def remove_from_text_index(index, field, tus):
+    """Returns the index with the TUs removed, dropping texts left without any"""
+    by_text = {}
+    for tu in tus:
+        by_text[tu[field]] = tuple(x for x in by_text.get(tu[field], index.get(tu[field], ())) if x['tu_id'] != tu['tu_id'])
+    return index.update([x for x in by_text.items() if x[1]], [x[0] for x in by_text.items() if not x[1]])
+
+
+def tu_id_hash(tu_id):
+    """A tu_id's share of a TM's set hash...the set hash is the sum of these modulo 2**256, so it can be
+       kept up to date as TUs are added and removed, and the chance of two different sets of tu_ids
+       having the same one is negligible (unlike a plain sum or xor of the tu_ids, where e.g. {1, 6} and {2, 5} collide)"""
+    return int.from_bytes(hashlib.blake2b(str(tu_id).encode(), digest_size=32).digest(), 'big')
+
+set_hash_modulus = 2**256
+
+
+class TmSnapshot(object):
+    """One version of a provider's in-memory data: the loaded TMs, the TUs by source text, and its indexes.
+       A snapshot is never changed once built. The methods that change something return the next version,
+       which shares everything it didn't change with this one, so a search can keep using the snapshot
+       it started with while a writer builds and swaps in the next one"""
+    
+    def __init__(self, version=0, tms=None, data=None, tu_index=None, tm_index=None, tm_fingerprints=None, target_data=None):
+        self.version = version
+        self.tms = tms if tms is not None else {} #tm_id: TM...copied on change, there are only a few
+        self.data = data if data is not None else ShardedDict() #sourcetext: tuple of TUs
+        self.tu_index = tu_index if tu_index is not None else ShardedDict() #tu_id: TU, the same objects as in data
+        self.tm_index = tm_index if tm_index is not None else {} #tm_id: ShardedDict of tu_id: TU, so a TM's TUs can be found without scanning data
+        #tm_id: (number, set hash) of its loaded tu_ids...TUs are never changed, only added and deleted, so two snapshots 
+        #with the same fingerprints hold the same TUs, even in different sessions
+        self.tm_fingerprints = tm_fingerprints if tm_fingerprints is not None else {}
+        #targettext: tuple of TUs (the same objects as in data), for searching target to source...None if not kept
+        self.target_data = target_data
+    
+    def next_version(self, **changes):
+        values = {'tms' : self.tms, 'data' : self.data, 'tu_index' : self.tu_index, 'tm_index' : self.tm_index, 
+                  'tm_fingerprints' : self.tm_fingerprints, 'target_data' : self.target_data}
+        values.update(changes)
+        return TmSnapshot(self.version + 1, **values)
+    
+    def content_key(self):
+        """Identifies the TUs in this snapshot, e.g. for telling whether two searches would see the same data"""
+        return tuple(sorted(self.tm_fingerprints.items()))
+    
+    def tm_content_key(self, tm_id):
+        """Identifies the TUs loaded from one TM (None if there are none), e.g. for caching figures about them"""
+        fingerprint = self.tm_fingerprints.get(tm_id)
+        return (tm_id, fingerprint) if fingerprint is not None else None
+    
+    def with_tm(self, tm):
+        tms = dict(self.tms)
+        tms[tm.tm_id] = tm
+        return self.next_version(tms=tms)
+    
+    def without_tm(self, tm_id):
+        """Drops the TM from the loaded TMs, along with its TUs"""
+        removed = self.without_tus(list(self.tm_index.get(int(tm_id), ShardedDict()).values()))
+        tms = dict(removed.tms)
+        tms.pop(int(tm_id), None)
+        return removed.next_version(tms=tms)
+    
+    def with_tus(self, tus):
+        """Adds TUs, skipping any that are already loaded"""
+        added = {}
+        for tu in tus:
+            if tu['tu_id'] not in self.tu_index:
+                added[tu['tu_id']] = tu
+        if not added:
+            return self
+        by_tm = {}
+        for tu in added.values():
+            by_tm.setdefault(int(tu['tm_id']), []).append((tu['tu_id'], tu))
+        data = add_to_text_index(self.data, 'sourcetext', added.values())
+        target_data = add_to_text_index(self.target_data, 'targettext', added.values()) if self.target_data is not None else None
+        tm_index = dict(self.tm_index)
+        tm_fingerprints = dict(self.tm_fingerprints)
+        for tm_id, entries in by_tm.items():
+            tm_index[tm_id] = tm_index.get(tm_id, ShardedDict()).update(entries)
+            count, set_hash = tm_fingerprints.get(tm_id, (0, 0))
+            for tu_id, tu in entries:
+                set_hash += tu_id_hash(tu_id)
+            tm_fingerprints[tm_id] = (count + len(entries), set_hash % set_hash_modulus)
+        return self.next_version(data=data, tu_index=self.tu_index.update(added.items()), tm_index=tm_index,
+                                 tm_fingerprints=tm_fingerprints, target_data=target_data)
+    
+    def without_tus(self, tus):
+        """Removes TUs, matched by tu_id"""
+        removed = {}
+        for tu in tus:
+            tu = self.tu_index.get(tu['tu_id'])
+            if tu is not None:
+                removed[tu['tu_id']] = tu
+        if not removed:
+            return self
+        by_tm = {}
+        for tu in removed.values():
+            by_tm.setdefault(int(tu['tm_id']), []).append(tu['tu_id'])
+        data = remove_from_text_index(self.data, 'sourcetext', removed.values())
+        target_data = remove_from_text_index(self.target_data, 'targettext', removed.values()) if self.target_data is not None else None
+        tm_index = dict(self.tm_index)
+        tm_fingerprints = dict(self.tm_fingerprints)
+        for tm_id, tu_ids in by_tm.items():
+            tm_index[tm_id] = tm_index.get(tm_id, ShardedDict()).update(removed=tu_ids)
+            count, set_hash = tm_fingerprints.get(tm_id, (0, 0))
+            for tu_id in tu_ids:
+                set_hash -= tu_id_hash(tu_id)
+            tm_fingerprints[tm_id] = (count - len(tu_ids), set_hash % set_hash_modulus)
+            if not tm_index[tm_id]:
+                tm_index.pop(tm_id)
+                tm_fingerprints.pop(tm_id)
+        return self.next_version(data=data, tu_index=self.tu_index.update(removed=removed), tm_index=tm_index,
+                                 tm_fingerprints=tm_fingerprints, target_data=target_data)
+    
+    def cleared(self):
+        """Drops all TUs, leaving the list of loaded TMs as is"""
+        return self.next_version(data=ShardedDict(), tu_index=ShardedDict(), tm_index={}, tm_fingerprints={},
+                                 target_data=ShardedDict() if self.target_data is not None else None)
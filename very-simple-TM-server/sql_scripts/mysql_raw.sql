@@ -43,14 +43,39 @@ CREATE TABLE `tus` (
   `changed_by` varchar(200) DEFAULT NULL,
   `changed_date` datetime DEFAULT NULL,
   `last_used_date` datetime DEFAULT NULL,
-  PRIMARY KEY (`tu_id`)
+  PRIMARY KEY (`tu_id`),
+  FULLTEXT KEY `ft_sourcetext` (`sourcetext`),
+  FULLTEXT KEY `ft_targettext` (`targettext`),
+  FULLTEXT KEY `ft_sourcetext_targettext` (`sourcetext`, `targettext`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `bulk_imports` (
+  `tm_id` int(11) NOT NULL,
+  PRIMARY KEY (`tm_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `jobs` (
+  `job_id` int(11) NOT NULL AUTO_INCREMENT,
+  `owner` varchar(150) NOT NULL,
+  `job_type` varchar(50) NOT NULL,
+  `description` varchar(500) DEFAULT NULL,
+  `status` varchar(20) NOT NULL,
+  `progress` int(11) DEFAULT 0,
+  `message` text,
+  `tm_id` int(11) DEFAULT NULL,
+  `created_datetime` datetime NOT NULL,
+  `started_datetime` datetime DEFAULT NULL,
+  `finished_datetime` datetime DEFAULT NULL,
+  PRIMARY KEY (`job_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 DELIMITER $$
 CREATE TRIGGER `on_tus_delete` AFTER DELETE
 ON `tus` FOR EACH ROW
 BEGIN
-   UPDATE `tms` SET `last_updated_datetime`= NOW() WHERE `tm_id` = old.`tm_id`;
+   IF NOT EXISTS (SELECT 1 FROM `bulk_imports` WHERE `tm_id` = old.`tm_id`) THEN
+      UPDATE `tms` SET `last_updated_datetime`= NOW() WHERE `tm_id` = old.`tm_id`;
+   END IF;
 END
 $$
 DELIMITER ;
@@ -59,7 +84,12 @@ DELIMITER $$
 CREATE TRIGGER `on_tus_update` AFTER UPDATE 
 ON `tus` FOR EACH ROW
 BEGIN
-   UPDATE `tms` SET `last_updated_datetime`= NOW() WHERE `tm_id` = new.`tm_id`;
+   IF NOT EXISTS (SELECT 1 FROM `bulk_imports` WHERE `tm_id` = new.`tm_id`) 
+      AND NOT (old.`tm_id` <=> new.`tm_id` AND old.`sourcetext` <=> new.`sourcetext` AND old.`targettext` <=> new.`targettext`
+               AND old.`created_by` <=> new.`created_by` AND old.`created_date` <=> new.`created_date`
+               AND old.`changed_by` <=> new.`changed_by` AND old.`changed_date` <=> new.`changed_date`) THEN
+      UPDATE `tms` SET `last_updated_datetime`= NOW() WHERE `tm_id` = new.`tm_id`;
+   END IF;
 END
 $$
 DELIMITER ;
@@ -67,7 +97,9 @@ DELIMITER ;
 DELIMITER $$
 CREATE TRIGGER `tus_AFTER_INSERT` AFTER INSERT ON `tus` FOR EACH ROW
 BEGIN
-UPDATE `tms` SET `last_updated_datetime`= NOW() WHERE `tm_id` = new.`tm_id`;
+IF NOT EXISTS (SELECT 1 FROM `bulk_imports` WHERE `tm_id` = new.`tm_id`) THEN
+   UPDATE `tms` SET `last_updated_datetime`= NOW() WHERE `tm_id` = new.`tm_id`;
+END IF;
 END
 $$
 DELIMITER ;
\ No newline at end of file
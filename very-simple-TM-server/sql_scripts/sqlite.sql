@@ -50,6 +50,30 @@ CREATE TABLE "tus" (
   `last_used_date`          TEXT,
   FOREIGN KEY(tm_id) REFERENCES tms(tm_id));
 
+CREATE VIRTUAL TABLE "tus_fts" USING fts5(
+  `sourcetext`,
+  `targettext`,
+  content='tus', content_rowid='tu_id');
+
+CREATE TABLE "bulk_imports" (
+	`tm_id`	INTEGER NOT NULL,
+	PRIMARY KEY(tm_id)
+);
+
+CREATE TABLE "jobs" (
+	`job_id`	INTEGER PRIMARY KEY AUTOINCREMENT,
+	`owner`	TEXT NOT NULL,
+	`job_type`	TEXT NOT NULL,
+	`description`	TEXT,
+	`status`	TEXT NOT NULL,
+	`progress`	INTEGER DEFAULT 0,
+	`message`	TEXT,
+	`tm_id`	INTEGER,
+	`created_datetime`	TEXT NOT NULL,
+	`started_datetime`	TEXT,
+	`finished_datetime`	TEXT
+);
+
 CREATE TRIGGER log_tm_insert AFTER INSERT 
 ON `tms`
 BEGIN
@@ -59,18 +83,40 @@ END;
 
 CREATE TRIGGER on_tus_delete AFTER DELETE 
 ON `tus`
+WHEN old.`tm_id` NOT IN (SELECT `tm_id` FROM `bulk_imports`)
 BEGIN
    UPDATE `tms` SET `last_updated_datetime`=datetime('now') WHERE `tm_id` = old.`tm_id`;
 END;
 
-CREATE TRIGGER on_tus_update AFTER UPDATE 
+CREATE TRIGGER on_tus_update AFTER UPDATE OF `tm_id`, `sourcetext`, `targettext`, `created_by`, `created_date`, `changed_by`, `changed_date`
 ON `tus`
+WHEN new.`tm_id` NOT IN (SELECT `tm_id` FROM `bulk_imports`)
 BEGIN
    UPDATE `tms` SET `last_updated_datetime`=datetime('now') WHERE `tm_id` = new.`tm_id`;
 END;
 
 CREATE TRIGGER on_tus_insert AFTER INSERT 
 ON `tus`
+WHEN new.`tm_id` NOT IN (SELECT `tm_id` FROM `bulk_imports`)
 BEGIN
    UPDATE `tms` SET `last_updated_datetime`=datetime('now') WHERE `tm_id` = new.`tm_id`;
+END;
+
+CREATE TRIGGER tus_fts_insert AFTER INSERT 
+ON `tus`
+BEGIN
+   INSERT INTO `tus_fts`(rowid, `sourcetext`, `targettext`) VALUES (new.`tu_id`, new.`sourcetext`, new.`targettext`);
+END;
+
+CREATE TRIGGER tus_fts_delete AFTER DELETE 
+ON `tus`
+BEGIN
+   INSERT INTO `tus_fts`(`tus_fts`, rowid, `sourcetext`, `targettext`) VALUES ('delete', old.`tu_id`, old.`sourcetext`, old.`targettext`);
+END;
+
+CREATE TRIGGER tus_fts_update AFTER UPDATE OF `sourcetext`, `targettext`
+ON `tus`
+BEGIN
+   INSERT INTO `tus_fts`(`tus_fts`, rowid, `sourcetext`, `targettext`) VALUES ('delete', old.`tu_id`, old.`sourcetext`, old.`targettext`);
+   INSERT INTO `tus_fts`(rowid, `sourcetext`, `targettext`) VALUES (new.`tu_id`, new.`sourcetext`, new.`targettext`);
 END;
\ No newline at end of file
@@ -0,0 +1,170 @@
+﻿#Copyright 2015 Patrick Porter
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+## http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+import time
+import zlib
+import gzip
+import bz2
+import lzma
+import zipfile
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+def normalize_time_tmx_to_iso(timestring):
+    """deals with differences in handling of iso8601, time...
+       i.e., the DBs seem to choke with the T and the Z"""
+    #string e.g.: 20140204T184725Z has to become 2014-02-04 18:47:25 
+    y = timestring[0:4]
+    mon = timestring[4:6]
+    d = timestring[6:8]
+    h = timestring[9:11]
+    min = timestring[11:13]
+    s = timestring[13:15]
+    result = "{0}-{1}-{2} {3}:{4}:{5}".format(y,mon,d,h,min,s)
+    return result
+
+def normalize_time_iso_to_tmx(value):
+    """The reverse of normalize_time_tmx_to_iso, e.g. 2014-02-04 18:47:25 becomes 20140204T184725Z.
+       Returns None if the value doesn't hold a full date and time"""
+    digits = "".join(c for c in str(value) if c.isdigit())
+    if len(digits) < 14:
+        return None
+    return "{0}T{1}Z".format(digits[0:8], digits[8:14])
+
+class TmxParser(object):
+    """Streams the translation units out of a TMX document in a single pass.
+       tmxfile can be a filename or any object with a read() method, e.g. an upload stream.
+       Iterating yields one tuple per TU:
+       (sourcetext, targettext, created_by, created_date, changed_by, changed_date, last_used_date)
+       srclang is known once the header has been read and tgtlang once the first TU has been read"""
+    
+    def __init__(self, tmxfile, owner):
+        self.tmxfile = tmxfile
+        self.owner = owner #used for created_by/changed_by when the TU doesn't say
+        self.srclang = None
+        self.tgtlang = None
+    
+    def __iter__(self):
+        body = None
+        for event, element in ET.iterparse(self.tmxfile, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == 'header':
+                    self.srclang = element.attrib.get("srclang")
+                elif element.tag == 'body':
+                    body = element
+                continue
+            if element.tag == 'tu':
+                yield self.read_tu(element)
+                #drop the processed TU from the tree so memory stays flat for large files
+                if body is not None:
+                    body.clear()
+                else:
+                    element.clear()
+    
+    def read_tu(self, element):
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        tuvs = element.findall("tuv")
+        lang0 = tuvs[0].attrib[XML_LANG]
+        #determine which is source and which is target
+        if self.srclang is None:
+            self.srclang = lang0
+        if lang0 == self.srclang:
+            source, target = tuvs[0], tuvs[1]
+        else:
+            source, target = tuvs[1], tuvs[0]
+        if self.tgtlang is None:
+            self.tgtlang = target.attrib[XML_LANG]
+        segtext = source.find("seg").text or ""
+        trgtext = target.find("seg").text or ""
+        attrib = element.attrib
+        created_by = attrib.get('creationid', self.owner)
+        #strip out the 'T' in tmx datetime stamp b/c mysql doesn't understand it
+        created_date = normalize_time_tmx_to_iso(attrib['creationdate']) if 'creationdate' in attrib else now
+        changed_by = attrib.get('changeid', self.owner)
+        changed_date = normalize_time_tmx_to_iso(attrib['changedate']) if 'changedate' in attrib else now
+        last_used_date = normalize_time_tmx_to_iso(attrib['lastusagedate']) if 'lastusagedate' in attrib else now
+        return (str.strip(segtext), str.strip(trgtext), created_by, created_date,
+                changed_by, changed_date, last_used_date)
+
+def open_tmx_stream(stream, filename):
+    """Returns a readable stream of the TMX data in an uploaded file, decompressing on the fly 
+       based on the extension: .gz, .bz2, .xz, or a .zip holding a single file. Anything else is read as is.
+       Nothing is decompressed up front, so neither the compressed nor the decompressed data 
+       is ever fully in memory. A .zip needs a seekable stream"""
+    name = str.lower(filename or "")
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if name.endswith('.bz2'):
+        return bz2.BZ2File(stream, mode='rb')
+    if name.endswith('.xz'):
+        return lzma.LZMAFile(stream, mode='rb')
+    if name.endswith('.zip'):
+        archive = zipfile.ZipFile(stream)
+        entries = [x for x in archive.infolist() if not x.filename.endswith('/')]
+        if len(entries) != 1:
+            raise ValueError("a zipped TMX upload must contain exactly one file, found {0}".format(len(entries)))
+        return archive.open(entries[0])
+    return stream
+
+class TeeReader(object):
+    """Wraps a readable stream and writes everything read from it to a second file,
+       so an upload can be saved to disk during the same pass that parses it"""
+    
+    def __init__(self, stream, copyfile):
+        self.stream = stream
+        self.copyfile = copyfile
+    
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.copyfile.write(data)
+        return data
+
+def write_tmx(tm, tus, chunk_size=65536):
+    """Generates a TMX document for the given TM as utf-8 encoded chunks of about chunk_size bytes.
+       tus is an iterable of tus table rows (see TmData.iter_tus), consumed as the output is produced
+       so memory use doesn't depend on the size of the TM"""
+    srclang = quoteattr(tm['sourcelang'] or "")
+    tgtlang = quoteattr(tm['targetlang'] or "")
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<tmx version="1.4">\n'
+             '<header creationtool="very-simple-TM-server" creationtoolversion="1" segtype="sentence" '
+             'o-tmf="very-simple-TM-server" adminlang="en-US" datatype="plaintext" '
+             'srclang={0}/>\n<body>\n'.format(srclang)]
+    size = 0
+    for row in tus:
+        attribs = [('creationid', row[4]), ('creationdate', normalize_time_iso_to_tmx(row[5])),
+                   ('changeid', row[6]), ('changedate', normalize_time_iso_to_tmx(row[7])),
+                   ('lastusagedate', normalize_time_iso_to_tmx(row[8]))]
+        attribs = "".join(" {0}={1}".format(name, quoteattr(str(value))) for name, value in attribs if value is not None)
+        part = ('<tu{0}><tuv xml:lang={1}><seg>{2}</seg></tuv>'
+                '<tuv xml:lang={3}><seg>{4}</seg></tuv></tu>\n').format(
+                    attribs, srclang, escape(row[2] or ""), tgtlang, escape(row[3] or ""))
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield "".join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    parts.append('</body>\n</tmx>\n')
+    yield "".join(parts).encode('utf-8')
+
+def gzip_stream(chunks, level=6):
+    """Gzip-compresses a stream of byte chunks on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16) #the | 16 gives a gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
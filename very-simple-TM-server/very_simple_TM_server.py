@@ -15,9 +15,72 @@
 import logging
 import cherrypy
 import os
+import json
+import hmac
+import time
 from TmProvider import TmProvider
-from BackgroundTask import BackgroundTaskQueue
-from auth import AuthController, require, owns_tm, is_admin, can_read_tm, can_write_to_tm, can_delete_tm, get_current_username
+from BackgroundTask import JobScheduler, LastUsedRecorder, SearchScheduler, SearchRejected
+from auth import AuthController, require, owns_tm, is_admin, can_read_tm, can_read_tms, can_write_to_tm, can_delete_tm, can_manage_job, get_current_username
+from auth import SESSION_KEY, session_snapshots
+import datamodel
+import scorers
+import metrics
+from profiling import request_profiler
+from slow_searches import SlowSearchLog
+from memory import memory_accountant, MemoryBudgetExceeded
+
+
+def publish_session_snapshot():
+    """Makes the session's state, as left by the handler, visible to read-only handlers"""
+    sess = cherrypy.session
+    session_snapshots.publish(sess.id, sess.get(SESSION_KEY), sess.get('tm_provider'), sess.timeout*60)
+
+def start_request_timer():
+    cherrypy.request.metrics_start = time.time()
+    cherrypy.request.hooks.attach('on_end_request', record_request_time)
+
+def handler_endpoint():
+    """The path of the request's handler, i.e. without positional params, so the number of values stays bounded"""
+    request = cherrypy.serving.request
+    segments = [segment for segment in request.path_info.split('/') if segment]
+    return '/'.join(segments[:len(segments) - len(getattr(request.handler, 'args', ()))]) or 'index'
+
+def record_request_time():
+    request = cherrypy.serving.request
+    code = int(str(cherrypy.serving.response.status).split()[0])
+    endpoint = 'unknown' if code == 404 or request.handler is None else handler_endpoint()
+    metrics.http_request_seconds.observe(time.time() - request.metrics_start, endpoint, str(code))
+cherrypy.tools.metrics = cherrypy.Tool('on_start_resource', start_request_timer)
+
+def start_profiling(): #tool to profile the request if an admin asked for it (see profile_requests)
+    if not request_profiler.armed:
+        return
+    started = request_profiler.start(handler_endpoint(), cherrypy.request.login)
+    if started is not None:
+        profile, info = started
+        cherrypy.request.hooks.attach('on_end_request', request_profiler.finish, profile=profile, info=info) #after a streamed body too
+cherrypy.tools.profiler = cherrypy.Tool('before_handler', start_profiling, priority=70) #after auth, which sets the username
+
+def loaded_tm_sizes():
+    """tm_id: TUs in memory, summed over the sessions that have the TM loaded"""
+    sizes = {}
+    for refreshed, username, provider in list(session_snapshots.entries.values()):
+        if provider:
+            for tm_id, fingerprint in provider.snapshot.tm_fingerprints.items():
+                sizes[(tm_id,)] = sizes.get((tm_id,), 0) + fingerprint[0]
+    return sizes
+
+
+class ServiceUnavailable(cherrypy.HTTPError):
+    """A 503 with a Retry-After header...HTTPError removes any Retry-After set before it is raised"""
+    
+    def __init__(self, message, retry_after):
+        cherrypy.HTTPError.__init__(self, 503, message)
+        self.retry_after = retry_after
+    
+    def set_response(self):
+        cherrypy.HTTPError.set_response(self)
+        cherrypy.serving.response.headers['Retry-After'] = str(self.retry_after)
 
 
 class VsTmServer(object):
@@ -25,19 +88,110 @@ class VsTmServer(object):
        as well as for loading, deleting, and otherwise maintaining the data"""
     
     auth=AuthController()
+    _cp_config = {'tools.metrics.on': True, 'tools.profiler.on': True}
     
     def get_provider(): #tool to instantiate provider for session if null
         if not cherrypy.session.get('tm_provider'): #init new provider if new session
             cherrypy.session['tm_provider']=TmProvider(cherrypy.request.app.config['/'])
+        cherrypy.request.hooks.attach('before_finalize', publish_session_snapshot) #before the response goes out, so the client reads its own writes
     cherrypy.tools.getprovider = cherrypy.Tool('before_handler', get_provider)
 
-    def __init__(self):
+    def get_snapshot(): #tool for read-only handlers: the session's provider and username without holding the session lock
+        sess = cherrypy.session
+        snapshot = session_snapshots.get(sess.id, sess.timeout*30)
+        if snapshot is None:
+            #nothing published for this session yet (e.g. after a restart), or its expiry is due to be pushed back
+            #since read-only requests don't save the session: load it once under the lock, like a writer would
+            sess.acquire_lock()
+            if sess.get(SESSION_KEY) and not sess.get('tm_provider'):
+                sess['tm_provider']=TmProvider(cherrypy.request.app.config['/'])
+            snapshot = session_snapshots.publish(sess.id, sess.get(SESSION_KEY), sess.get('tm_provider'), sess.timeout*60)
+            sess.save() #releases the lock
+        cherrypy.serving.request._sessionsaved = True #never save at the end of the request..it could overwrite a concurrent writer's changes
+        cherrypy.request.login, cherrypy.request.tm_provider = snapshot
+    cherrypy.tools.getsnapshot = cherrypy.Tool('before_handler', get_snapshot, priority=40) #before auth, which uses the username
+
+    def read_only(f): #decorator for handlers that don't change the session: they use cherrypy.request.tm_provider
+        f = cherrypy.tools.getsnapshot()(f)
+        f._cp_config['tools.sessions.locking'] = 'explicit' #not locked before the handler, unlike the other handlers
+        return f
+
+    def __init__(self, config):
         """In the app config, cores is the max number of processor cores that will be used for
            Levenshtein calculation during search.
            use_mysql defaults to False (in which case sqlite is used), 
-           but if set to True will use MySql (DB must be already created/configured)"""
-        self.bgtask = BackgroundTaskQueue(cherrypy.engine)
-        self.bgtask.subscribe()
+           but if set to True will use MySql (DB must be already created/configured).
+           With migrate_db (the default), an existing DB created by an older version of the sql scripts
+           is brought up to date at startup (see datamodel.migrate_db).
+           import_workers is the number of background jobs (e.g. TMX imports) that can run at once.
+           last_used_flush_interval is how often, in seconds, the last_used_date of TUs returned 
+           by searches is written to the DB (0 turns the tracking off).
+           permission_cache_ttl is how long, in seconds, a user's resolved permissions for a TM are cached.
+           scorer is the Levenshtein backend used by searches: 'rapidfuzz', 'levenshtein' (python-Levenshtein), 
+           'python', or 'auto' (the default) for the fastest one installed, as timed at startup.
+           search_slots is the number of searches computed at once, server-wide (0, the default, is one per core);
+           up to search_max_queue more wait at most search_queue_timeout seconds for a slot, after which, 
+           or if the queue is full, the search gets a 503 with Retry-After.
+           metrics_token, if set, lets metrics be read with it as a bearer token, without logging in.
+           profile_path is where request profiles are saved (see profile_requests), the last max_profiles of them.
+           Searches taking at least slow_search_seconds (0 turns it off) are logged to slow_search_log, 
+           which slow_searches.py can replay.
+           memory_budget_mb, if set, is a soft limit on the memory taken by the TMs loaded in all sessions:
+           load_tm gets a 503 if loading the TM would go past it. TMs of more than memory_sample_tus TUs
+           have their memory estimated from a sample of that many of them (see memory.py)"""
+        TmProvider.scorer = scorers.select_scorer(str(config.get('scorer', 'auto')))
+        TmProvider.search_scheduler = SearchScheduler(cherrypy.engine, int(config.get('search_slots', 0)), 
+                                                      float(config.get('search_queue_timeout', 10)), 
+                                                      int(config.get('search_max_queue', 8)), int(config.get('numcores', 0)))
+        TmProvider.search_scheduler.subscribe()
+        datamodel.permission_cache.ttl = int(config.get('permission_cache_ttl', 60))
+        if config.get('migrate_db', True) and config.get('sql_scripts_path'):
+            migration = datamodel.migrate_db(config)
+            for change in migration['changes']:
+                logging.info("DB migration: {0}".format(change))
+        self.jobs = JobScheduler(cherrypy.engine, datamodel.TmData(config), workers=int(config.get('import_workers', 2)))
+        self.jobs.subscribe()
+        flush_interval = int(config.get('last_used_flush_interval', 30))
+        if flush_interval > 0:
+            TmProvider.usage_recorder = LastUsedRecorder(cherrypy.engine, datamodel.TmData(config), flush_interval,
+                                                         int(config.get('last_used_max_pending', 100000)))
+            TmProvider.usage_recorder.subscribe()
+        self.metrics_token = config.get('metrics_token')
+        request_profiler.path = config.get('profile_path', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+        request_profiler.max_profiles = int(config.get('max_profiles', 20))
+        slow_search_seconds = float(config.get('slow_search_seconds', 2))
+        if slow_search_seconds > 0:
+            TmProvider.slow_search_log = SlowSearchLog(config.get('slow_search_log', os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                                                                                   'slow_searches.jsonl')), slow_search_seconds)
+        memory_accountant.budget = int(float(config.get('memory_budget_mb', 0)) * 1e6)
+        memory_accountant.sample_tus = int(config.get('memory_sample_tus', 2000))
+        self.register_metrics()
+    
+    def register_metrics(self):
+        """Registers the metrics read from the server's state when they are collected"""
+        scheduler = TmProvider.search_scheduler
+        metrics.registry.register(metrics.CallbackGauge('vstm_search_queue_depth', 'Searches waiting for a slot, by priority',
+            lambda: dict(((priority,), queued) for priority, queued in scheduler.stats()['queued'].items()), ('priority',)))
+        metrics.registry.register(metrics.CallbackGauge('vstm_searches_running', 'Searches being computed',
+            lambda: scheduler.stats()['running']))
+        metrics.registry.register(metrics.CallbackGauge('vstm_search_slots', 'Searches that can be computed at once',
+            lambda: scheduler.slots))
+        metrics.registry.register(metrics.CallbackCounter('vstm_searches_rejected_total', 'Searches answered with a 503, by reason',
+            lambda: {('queue_full',) : scheduler.rejected_full, ('queue_timeout',) : scheduler.rejected_timeout}, ('reason',)))
+        metrics.registry.register(metrics.CallbackCounter('vstm_searches_coalesced_total', 
+            'Searches that shared the result of a concurrent identical one', lambda: TmProvider.search_flights.coalesced))
+        metrics.registry.register(metrics.CallbackGauge('vstm_jobs_queued', 'Background jobs (e.g. TMX imports) waiting for a worker',
+            self.jobs.queued_count))
+        metrics.registry.register(metrics.CallbackGauge('vstm_jobs_running', 'Background jobs running',
+            lambda: self.jobs.active_count() - self.jobs.queued_count()))
+        metrics.registry.register(metrics.CallbackGauge('vstm_last_used_pending', 'TU last_used_date updates waiting to be written',
+            lambda: len(TmProvider.usage_recorder.pending) if TmProvider.usage_recorder else 0))
+        metrics.registry.register(metrics.CallbackGauge('vstm_sessions', 'Logged-in sessions', lambda: len(session_snapshots)))
+        metrics.registry.register(metrics.CallbackGauge('vstm_loaded_tm_tus', 
+            'TUs of each TM in memory, summed over the sessions that loaded it', loaded_tm_sizes, ('tm_id',)))
+        metrics.registry.register(metrics.CallbackGauge('vstm_loaded_tm_bytes', 
+            'Memory taken by the TMs loaded in all sessions, by kind (string, tu, index, cache), as accounted for in memory.py',
+            lambda: memory_accountant.totals_by_kind(list(session_snapshots.entries.values()), TmProvider.scorer), ('kind',)))
     
     def load_single_tm(self, tm_id):
         """Loads data for a given translation memory document from DB to memory for faster searching"""
@@ -55,6 +209,12 @@ class VsTmServer(object):
         #first check if already loaded
         if provider.tms.get(int(tm_id)):
             return {'status' : 'tm already loaded...to update the in-memory TM, use a sync method'}
+        if memory_accountant.budget:
+            try:
+                memory_accountant.check_budget(list(session_snapshots.entries.values()), TmProvider.scorer, int(tm_id), 
+                                               provider.data_mgr.count_tus(int(tm_id)))
+            except MemoryBudgetExceeded as e:
+                raise cherrypy.HTTPError(503, str(e))
         result = self.load_single_tm(tm_id)
         if result['status']=='success':
             return result
@@ -62,42 +222,165 @@ class VsTmServer(object):
             raise cherrypy.HTTPError(500, result['status']);
     
     @cherrypy.expose(['save_in_memory_tms'])
-    @cherrypy.tools.getprovider()
+    @read_only
     @require()
     def save_in_memory_tms_to_db(self, tm_name, sourcelang=None, targetlang=None):
         """Saves all the translation units currently in memory, from all TMs in memory,
-            to one new translation memory in the DB."""
-        provider = cherrypy.session.get('tm_provider')
+            to one new translation memory in the DB. The TUs are copied inside the DB
+            by a background job, whose ID is returned."""
+        provider = cherrypy.request.tm_provider
         if len(provider.data)==0:
             return {'status' : 'no data currently in memory'}
         owner = get_current_username()
-        return provider.create_tm_from_memory(tm_name, sourcelang, targetlang, owner, data)
+        job_id = self.jobs.submit(owner, 'save_in_memory_tms', tm_name, 
+                                  provider.create_tm_from_memory, tm_name, sourcelang, targetlang, owner)
+        return {'status' : 'copying TUs to new TM', 'job_id' : job_id}
 
+    @cherrypy.expose
+    @read_only
+    @require(can_read_tms())
+    def merge_tms(self, tm_ids, tm_name, dedupe=False, **kwargs):
+        """Creates a new TM from the TUs of the TMs in tm_ids (comma-separated), copied inside the DB
+            by a background job, whose ID is returned. With dedupe, TUs with the same source
+            and target text are only copied once."""
+        dedupe = True if str.lower(str(dedupe))=='true' else False
+        try:
+            tm_ids = [int(x) for x in str(tm_ids).split(",")]
+        except ValueError:
+            raise cherrypy.HTTPError(400, "tm_ids must be a comma-separated list of TM IDs")
+        owner = get_current_username()
+        job_id = self.jobs.submit(owner, 'merge_tms', tm_name, 
+                                  cherrypy.request.tm_provider.merge_tms, tm_ids, tm_name, owner, dedupe)
+        return {'status' : 'merging TMs', 'job_id' : job_id}
 
     @cherrypy.expose
-    @cherrypy.tools.getprovider()
+    @read_only
+    @require(can_read_tm())
+    def copy_tm(self, tm_id, tm_name, dedupe=False, **kwargs):
+        """Creates a new TM with a copy of the TUs of an existing TM, copied inside the DB
+            by a background job, whose ID is returned."""
+        dedupe = True if str.lower(str(dedupe))=='true' else False
+        owner = get_current_username()
+        job_id = self.jobs.submit(owner, 'copy_tm', tm_name, 
+                                  cherrypy.request.tm_provider.copy_tm, tm_id, tm_name, owner, dedupe)
+        return {'status' : 'copying TM', 'job_id' : job_id}
+
+
+    @cherrypy.expose
+    @read_only
     @require()
     def check_server_status(self, **kwargs):
         """Checks which, if any, TMs have been loaded to memory, which is necessary for searching."""
         status = {}
-        provider = cherrypy.session.get('tm_provider')
-        importing = self.bgtask.q.unfinished_tasks>0 #is an import task running in the background? TODO: sometimes unreliable for some reason..
+        provider = cherrypy.request.tm_provider
+        importing = self.jobs.active_count()>0 #is an import job queued or running in the background?
         status['currently_importing_tmx'] = importing
-        loadedtms = tuple(provider.tms.keys());
-        status['loaded_tm_ids']  = loadedtms if provider.loaded and len(provider.data)>0 else None
+        snapshot = provider.snapshot
+        loadedtms = tuple(snapshot.tms.keys());
+        status['loaded_tm_ids']  = loadedtms if provider.loaded and len(snapshot.data)>0 else None
         status['currently_loading_to_memory'] = provider.currently_loading
+        status['permission_cache'] = datamodel.permission_cache.stats()
+        status['search_coalescing'] = TmProvider.search_flights.stats() #searches run vs. ones that shared a concurrent identical one's result
+        status['search_queue'] = TmProvider.search_scheduler.stats() #searches running and waiting for a slot, and how long they waited
+        status['memory'] = memory_accountant.snapshot_usage(snapshot, TmProvider.scorer) #this session's TMs: TUs, and string, TU, index and cache bytes
         return {'status': status}
 
+    @cherrypy.expose(['metrics'])
+    def export_metrics(self, **kwargs):
+        """Returns the server's metrics in the Prometheus text format, for an admin 
+           or a scraper sending the metrics_token (from the app config) as a bearer token"""
+        cherrypy.serving.request._sessionsaved = True #never saved, like read-only handlers' sessions...so scrapers don't leave session files either
+        authorization = cherrypy.request.headers.get('Authorization', '')
+        if not (self.metrics_token and hmac.compare_digest(authorization, 'Bearer ' + str(self.metrics_token))):
+            cherrypy.session.acquire_lock() #file sessions can't be loaded without it
+            try:
+                cherrypy.request.login = get_current_username()
+            finally:
+                cherrypy.session.release_lock()
+            if not cherrypy.request.login:
+                raise cherrypy.HTTPError(401, "Log in as an admin, or send the metrics token")
+            result = is_admin()()
+            if result != True:
+                raise cherrypy.HTTPError(403, result)
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.registry.render().encode('utf-8')
+    export_metrics._cp_config = {'tools.json_out.on': False, 'tools.sessions.locking': 'explicit'}
+
+    @cherrypy.expose
+    @read_only
+    @require(is_admin())
+    def profile_requests(self, count='1', endpoint=None, username=None, **kwargs):
+        """Profiles the next count requests with cProfile, or only those to endpoint (e.g. 'search') and/or 
+           by username. Background jobs (e.g. TMX imports) are matched by their job type, i.e. the endpoint 
+           that queued them. A count of 0 stops profiling. The profiles are listed by list_profiles"""
+        try:
+            count = int(count)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "count must be an integer")
+        if count < 0 or count > 100:
+            raise cherrypy.HTTPError(400, "count must be between 0 and 100")
+        return {'status' : request_profiler.arm(count, endpoint, username)}
+
+    @cherrypy.expose
+    @read_only
+    @require(is_admin())
+    def list_profiles(self, **kwargs):
+        """Lists the request profiles kept, newest first, and what is still to be profiled"""
+        return {'profiles' : request_profiler.list_profiles(), 'status' : request_profiler.status()}
+
+    @cherrypy.expose
+    @read_only
+    @require(is_admin())
+    def get_profile(self, profile_id, format='pstats', sort='cumulative', limit='50', **kwargs):
+        """Downloads a request profile as a pstats file (for pstats, snakeviz, etc.), 
+           or with format 'text', returns the limit functions that took the most time, by sort"""
+        try:
+            profile_id = int(profile_id)
+            limit = int(limit)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "profile_id and limit must be integers")
+        if format not in ('pstats', 'text'):
+            raise cherrypy.HTTPError(400, "format must be 'pstats' or 'text'")
+        info, filename = request_profiler.get_profile(profile_id)
+        if info is None:
+            raise cherrypy.HTTPError(404, "No such profile")
+        if format == 'text':
+            try:
+                report = request_profiler.report(profile_id, sort, limit)
+            except KeyError:
+                raise cherrypy.HTTPError(400, "unknown sort key")
+            cherrypy.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+            return report.encode('utf-8')
+        return cherrypy.lib.static.serve_file(filename, 'application/octet-stream', 'attachment', 
+                                              "profile_{0}_{1}.pstats".format(profile_id, info['endpoint'].replace('/', '_')))
+    get_profile._cp_config.update({'tools.json_out.on': False})
+
+    @cherrypy.expose
+    @read_only
+    @require(is_admin())
+    def memory_summary(self, **kwargs):
+        """Memory taken by the TMs loaded in all sessions: per session (largest first), per TM 
+           summed over sessions, and in total, along with the memory budget and the process's RSS"""
+        return memory_accountant.summary(list(session_snapshots.entries.values()), TmProvider.scorer)
+
     
     @cherrypy.expose(['list_tms'])
-    @cherrypy.tools.getprovider()
+    @read_only
     @require()
-    def list_tms(self, **kwargs):
+    def list_tms(self, sourcelang=None, targetlang=None, name_prefix=None, cursor=None, limit='0', **kwargs):
         """Lists the translation memory documents (TMX files) that have been imported into the database
-           and are available for loading into memory and searching."""
+           and are available for loading into memory and searching. Optionally filtered by language pair
+           and name prefix. With a limit, returns one page of results and the cursor for the next page."""
         user = get_current_username()
-        results = cherrypy.session.get('tm_provider').list_tms(user)
-        return results
+        try:
+            limit = int(limit)
+            cursor = int(cursor) if cursor else None
+        except ValueError:
+            raise cherrypy.HTTPError(400, "limit and cursor must be integers")
+        results, next_cursor = cherrypy.request.tm_provider.list_tms(user, sourcelang, targetlang, name_prefix, cursor, limit)
+        if not limit:
+            return results
+        return {'tms' : results, 'next_cursor' : next_cursor}
 
     
     @cherrypy.expose(['delete_tm'])
@@ -127,8 +410,31 @@ class VsTmServer(object):
         user = get_current_username()
         return cherrypy.session.get('tm_provider').add_or_update_tu(tm_id, source, target, user, allow_multiple, overwrite_with_new)
 
-    @cherrypy.expose(['import_tmx'])
+    @cherrypy.expose
+    @cherrypy.tools.json_in(force=False)
     @cherrypy.tools.getprovider()
+    @require(can_write_to_tm())
+    def add_or_update_tus(self, tm_id, tus=None, allow_multiple=False, overwrite_with_new=True, **kwargs):
+        """Adds or updates many source text/target text pairs in the specified translation memory in one
+           transaction, applying the same rules as add_or_update_tu to each pair.
+           tus is a JSON array of [source, target] arrays or {"source": ..., "target": ...} objects, passed
+           either as a parameter or as an application/json request body."""
+        allow_multiple = True if str.lower(str(allow_multiple))=='true' else False
+        overwrite_with_new = True if str.lower(str(overwrite_with_new))=='true' else False
+        try:
+            tus = json.loads(tus) if tus is not None else getattr(cherrypy.request, 'json', None)
+            pairs = [(x['source'], x['target']) if isinstance(x, dict) else (x[0], x[1]) for x in tus]
+        except (ValueError, TypeError, KeyError, IndexError):
+            raise cherrypy.HTTPError(400, "tus must be a JSON array of [source, target] pairs or {'source': ..., 'target': ...} objects")
+        user = get_current_username()
+        statuses = cherrypy.session.get('tm_provider').add_or_update_tus(tm_id, pairs, user, allow_multiple, overwrite_with_new)
+        added = statuses.count('TU added') + statuses.count('tu added')
+        updated = statuses.count('TU(s) updated')
+        return {'status' : 'processed {0} TUs'.format(len(statuses)), 'added' : added, 'updated' : updated,
+                'skipped' : len(statuses) - added - updated}
+
+    @cherrypy.expose(['import_tmx'])
+    @read_only
     @require()
     def import_file(self, file, tm_name, **kwargs):
         """Starts an upload of a TMX file and then imports its info and translation units
@@ -137,35 +443,102 @@ class VsTmServer(object):
 
         #TODO: validate for empty strings...here and elsewhere
         owner = get_current_username()
-        self.bgtask.put(cherrypy.session.get('tm_provider').import_tmx_file, file, tm_name, owner)
-        logging.info("importing TMX and loading to DB in subthread")
+        job_id = self.jobs.submit(owner, 'import_tmx', file.filename, 
+                                  cherrypy.request.tm_provider.import_tmx_file, file, tm_name, owner)
+        logging.info("importing TMX and loading to DB in background job {0}".format(job_id))
         status="parsing TMX and loading to DB"
-        info = {'filename' : file.filename, 'content-type' : file.content_type.value, 'status' : status}
+        info = {'filename' : file.filename, 'content-type' : file.content_type.value, 'status' : status, 'job_id' : job_id}
         return info
-    
+
     @cherrypy.expose
-    @cherrypy.tools.getprovider()
+    @read_only
+    @require(can_manage_job())
+    def job_status(self, job_id, **kwargs):
+        """Returns the status and progress of a background job, e.g. a TMX import.
+           progress is the number of TUs processed so far."""
+        status = self.jobs.job_status(job_id)
+        if not status:
+            raise cherrypy.HTTPError(404, "no job with ID of '{0}' exists".format(job_id))
+        return {'status' : status}
+
+    @cherrypy.expose
+    @read_only
+    @require(can_manage_job())
+    def cancel_job(self, job_id, **kwargs):
+        """Cancels a queued background job, or stops a running one. 
+           A cancelled import removes the partially imported TM."""
+        status = self.jobs.cancel(job_id)
+        if not status:
+            return {'status' : 'job is not queued or running'}
+        return {'status' : 'cancelled' if status=='cancelled' else 'cancelling'}
+    
+    @cherrypy.expose(['export_tmx'])
+    @read_only
     @require(can_read_tm())
-    def export_tmx_file(self, tm_id):
-        """Retrieves the specified TM and exports it as a TMX file."""
-        return {'not currently implemented'}
-        #TODO: put in logic to export to TMX
+    def export_tmx_file(self, tm_id, compress=False, **kwargs):
+        """Retrieves the specified TM and exports it as a TMX file.
+           The file is streamed as it is read from the DB, gzipped on the fly if compress is true."""
+        compress = True if str.lower(str(compress))=='true' else False
+        tm, chunks = cherrypy.request.tm_provider.export_tmx_file(tm_id, compress)
+        if not tm:
+            raise cherrypy.HTTPError(404, "no TM with ID of '{0}' exists".format(tm_id))
+        filename = "{0}.tmx".format(tm.name)
+        if compress:
+            filename += ".gz"
+            cherrypy.response.headers['Content-Type'] = 'application/gzip'
+        else:
+            cherrypy.response.headers['Content-Type'] = 'application/x-tmx+xml; charset=utf-8'
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename.replace('"', ''))
+        return chunks
+    export_tmx_file._cp_config.update({'response.stream': True, 'tools.json_out.on': False})
     
     @cherrypy.expose
-    @cherrypy.tools.getprovider()
+    @read_only
     @require()
-    def search(self, searchtext, threshold='.75', maxresults='0', casecost='.2', **kwargs):
+    def search(self, searchtext, threshold='.75', maxresults='0', casecost='.2', direction='source', priority='interactive', **kwargs):
         """The whole point...searches for exact and fuzzy matches;
            rates and ranks, returning in descending order of match %.
            threshold is the minimum match score to return.
            maxresults is the maximum number of results to return (0 means no max)
            casecost is the cost applied to replacements consisting of merely a case change
            in the Levenshtein distance calc.  A casecost of less than one warps results in favor
-           of strings with merely case differences."""
-        provider = cherrypy.session.get('tm_provider')
+           of strings with merely case differences.
+           direction 'target' searches the target text instead (back-translation checks), 
+           if the server keeps the target index (target_index in the config).
+           priority 'batch' is for searches nobody is waiting on (e.g. pre-translation), which yield to 
+           'interactive' ones when the server is busy. A busy server returns a 503 with Retry-After."""
+        provider = cherrypy.request.tm_provider
         if len(provider.data)==0:
             raise cherrypy.HTTPError(500, "No tm loaded");
-        return provider.search(searchtext, threshold, maxresults, casecost) 
+        try:
+            return provider.search(searchtext, threshold, maxresults, casecost, direction, priority)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        except SearchRejected as e:
+            raise ServiceUnavailable(str(e), e.retry_after)
+     
+    @cherrypy.expose
+    @read_only
+    @require(can_read_tms())
+    def concordance(self, query, tm_ids=None, fields='both', cursor=None, limit='50', **kwargs):
+        """Finds the TUs whose source and/or target text contain all the words and "quoted phrases" in query;
+           a word or phrase ending in * matches as a prefix. Uses the DB's full-text index, so the TMs don't
+           need to be loaded. tm_ids (comma-separated) restricts the TMs searched, which otherwise are all
+           the ones the user can read. fields is 'source', 'target' or 'both'. Returns one page of up to
+           limit matches, in tu_id order, and the cursor for the next page."""
+        try:
+            limit = int(limit)
+            cursor = int(cursor) if cursor else None
+            tm_ids = [int(x) for x in str(tm_ids).split(",")] if tm_ids else None
+        except ValueError:
+            raise cherrypy.HTTPError(400, "limit, cursor and tm_ids must be integers")
+        if limit < 1 or limit > 1000:
+            raise cherrypy.HTTPError(400, "limit must be between 1 and 1000")
+        if fields not in ('source', 'target', 'both'):
+            raise cherrypy.HTTPError(400, "fields must be 'source', 'target' or 'both'")
+        matches, next_cursor = cherrypy.request.tm_provider.concordance(get_current_username(), query, fields, 
+                                                                        tm_ids, cursor, limit)
+        return {'matches' : matches, 'next_cursor' : next_cursor}
      
     @cherrypy.expose()
     @cherrypy.tools.getprovider()
@@ -201,7 +574,7 @@ class VsTmServer(object):
         #clear provider data
         #TODO: possibly offer a check_sync first to allow user to check before deleting in case they want to save as TM
         provider = cherrypy.session.get('tm_provider')
-        provider.data = {}
+        provider.clear_memory()
         #now reload
         return self.sync_memory_add_only()
 
@@ -230,6 +603,7 @@ if __name__ == '__main__':
     absDir = os.path.join(os.getcwd(), localDir)
     sqlite_db_path = "{0}/sqlitedb".format(absDir)
     sessions_path = "{0}/sessions".format(absDir)    
+    profile_path = "{0}/profiles".format(absDir)
     sql_scripts_path = "{0}/sql_scripts".format(absDir)
 
     serverconfig = {
@@ -248,7 +622,22 @@ if __name__ == '__main__':
                 'db_name':'vstmserver',
                 'sqlite_db_path':sqlite_db_path,
                 'numcores':4,
+                'import_workers':2,
+                'last_used_flush_interval':30,
+                'permission_cache_ttl':60,
+                'target_index':False,
+                'scorer':'auto',
+                'search_slots':0,
+                'search_queue_timeout':10,
+                'search_max_queue':8,
+                'metrics_token':None,
+                'profile_path':profile_path,
+                'max_profiles':20,
+                'slow_search_seconds':2,
+                'slow_search_log':"{0}/slow_searches.jsonl".format(absDir),
+                'memory_budget_mb':0,
                 'use_mysql':False,
+                'migrate_db':True,
                 'sql_scripts_path' : sql_scripts_path,
                 'tools.json_out.on': True},
         '/auth' : {'tools.json_out.on': False}
@@ -256,7 +645,7 @@ if __name__ == '__main__':
         }
     
     cherrypy.config.update(serverconfig)
-    cherrypy.quickstart(VsTmServer(), '/', appconfig)
+    cherrypy.quickstart(VsTmServer(appconfig['/']), '/', appconfig)
     
 #TODO: allow config from file(s)
 #TODO: a UI would be good to manage auth stuff..usernames, passwords, groups, etc. at least a basic one